@@ -3,11 +3,12 @@ import shutil
 from pathlib import Path
 from traceback import format_exception
 from os.path import abspath, join, basename, splitext
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
 from datetime import datetime
-from typing import Union, List, Tuple, Dict
+from typing import Union, List, Tuple, Dict, Iterator, Callable
 import urllib, io
 import urllib.request
 import http.client as http
@@ -43,6 +44,8 @@ Roi = namedtuple('Roi', 'x1 x2 y1 y2 z1 z2')
 ORGAN_VOLUME_CSV_FILE = 'organ_volumes.csv'
 STAGING_INFO_FILENAME = 'staging_info_volume.csv'
 
+AVERAGE_METHODS = ('mean', 'trimmed_mean', 'median')
+
 lama_root_dir = Path(lama.__file__).parent
 
 
@@ -521,39 +524,141 @@ def get_inputs_from_file_list(file_list_path, config_dir):
     return filtered_paths
 
 
-def average(img_paths: List[Path]) -> sitk.Image:
+def average(img_paths: List[Path],
+            method: str = 'mean',
+            slab_size: int = None,
+            workers: int = 4,
+            trim: float = 0.1,
+            accumulator_dtype=np.float64) -> sitk.Image:
     """
-    Make a mean itensity volume given a list of volume paths
+    Make an average intensity volume given a list of volume paths.
+
+    Volumes are read in parallel with at most `workers` reads in flight and added to a floating point running total as
+    they arrive, so memory use does not depend on the number of volumes.
+
+    The robust methods (trimmed_mean and median) need all the specimen values for each voxel, so they are computed a
+    z-slab at a time. If slab_size is not given for these, it is chosen so a slab from every volume fits in a quarter
+    of the available memory.
+
+    Parameters
+    ----------
+    img_paths
+        The volumes to average. They must all be the same shape
+    method
+        One of AVERAGE_METHODS
+    slab_size
+        Number of z-slices to process at a time. If None and method is 'mean', whole volumes are streamed
+    workers
+        Number of volumes (or slabs) to read concurrently
+    trim
+        Proportion to cut from each end of the sorted values when method is 'trimmed_mean'
+    accumulator_dtype
+        np.float32 or np.float64
 
     Returns
     -------
-    Mean volume
+    Mean volume. This has the same pixel type as the first input volume
 
     """
-    img_paths = list(map(str, img_paths))
-
-    # sum all images together
-    first = LoadImage(img_paths[0])
+    if method not in AVERAGE_METHODS:
+        raise ValueError(f'average method should be one of {AVERAGE_METHODS}')
 
-    # Get the direction from the first image.
-    direction_cos = first.direction
+    img_paths = list(map(str, img_paths))
 
-    summed = sitk.GetArrayFromImage(sitk.ReadImage(img_paths[0]))
+    # Get the size, pixel type and direction from the header of the first image.
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img_paths[0])
+    reader.ReadImageInformation()
+    direction_cos = reader.GetDirection()
+    x, y, z = reader.GetSize()
+    out_dtype = sitk.GetArrayFromImage(sitk.Image([1, 1, 1], reader.GetPixelID())).dtype
+
+    if method != 'mean' and not slab_size:
+        slice_bytes = x * y * np.dtype(np.float32).itemsize * len(img_paths)
+        slab_size = max(1, int((available_memory() * 0.25) // slice_bytes))
+
+    if slab_size:
+        avg = np.zeros((z, y, x), dtype=accumulator_dtype)
+
+        for z_start in range(0, z, slab_size):
+            z_size = min(slab_size, z - z_start)
+            slabs = prefetch(lambda p: _read_slab(p, z_start, z_size), img_paths, workers)
+            avg[z_start: z_start + z_size] = _average_slabs(slabs, method, trim, accumulator_dtype)
+    else:
+        avg = _average_slabs(prefetch(read_array, img_paths, workers), method, trim, accumulator_dtype)
 
-    for image in img_paths[1:]:  # Ommit the first as that is in 'summed'
-        np_array = sitk.GetArrayFromImage(sitk.ReadImage(image))
-        try:
-            summed += np_array
-        except ValueError as e:
-            print(("Numpy can't average this volume {0}".format(image)))
+    if np.issubdtype(out_dtype, np.integer):
+        info = np.iinfo(out_dtype)
+        avg = np.clip(np.rint(avg), info.min, info.max)
 
-    # Now make average
-    summed //= len(img_paths)
-    avg_img = sitk.GetImageFromArray(summed)
+    avg_img = sitk.GetImageFromArray(avg.astype(out_dtype))
     avg_img.SetDirection(direction_cos)
 
     return avg_img
 
+
+def _average_slabs(slabs: Iterator[np.ndarray], method: str, trim: float, accumulator_dtype) -> np.ndarray:
+    """
+    Get the voxel-wise average of same-sized arrays.
+    For the mean, a running total is kept. The robust methods have to stack the arrays.
+    """
+    if method == 'mean':
+        summed = None
+        n = 0
+
+        for slab in slabs:
+            if summed is None:
+                summed = np.zeros(slab.shape, dtype=accumulator_dtype)
+            if slab.shape != summed.shape:
+                logging.warning(f"Can't average a volume of shape {slab.shape} with shape {summed.shape}. Skipping")
+                continue
+            summed += slab
+            n += 1
+
+        summed /= n
+        return summed
+
+    stacked = np.stack([slab.astype(np.float32) for slab in slabs])
+
+    if method == 'median':
+        return np.median(stacked, axis=0)
+
+    # trimmed_mean
+    stacked.sort(axis=0)
+    cut = int(trim * len(stacked))
+    return stacked[cut: len(stacked) - cut].mean(axis=0, dtype=accumulator_dtype)
+
+
+def _read_slab(path: str, z_start: int, z_size: int) -> np.ndarray:
+    """
+    Read z_size slices from an image starting at z_start. Formats that support streaming will only read that part of
+    the file from disk.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    x, y, _ = reader.GetSize()
+    reader.SetExtractIndex([0, 0, z_start])
+    reader.SetExtractSize([x, y, z_size])
+    return sitk.GetArrayFromImage(reader.Execute())
+
+
+def prefetch(func: Callable, items: List, workers: int) -> Iterator:
+    """
+    Yield func(item) for each item in order, running func on up to `workers` items ahead in a thread pool.
+    Image decoding in SimpleITK and filtering in scipy.ndimage release the GIL so threads give a speed up here.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        queue = deque()
+
+        for item in items:
+            queue.append(executor.submit(func, item))
+            if len(queue) >= workers:
+                yield queue.popleft().result()
+
+        while queue:
+            yield queue.popleft().result()
+
 #
 # def rebuid_subsamlped_output(array, shape, chunk_size):
 #     """
@@ -22,7 +22,7 @@ ELX_TFORM_NAME_RESOLUTION = 'TransformParameters.0.R{}.txt'  # resoltion number
 TRANSFORMIX_LOG = 'transformix.log'
 
 
-def make_deformations_at_different_scales(config: Union[LamaConfig, dict]):
+def make_deformations_at_different_scales(config: Union[LamaConfig, dict], threads: int = None):
     """
     Generate jacobian determinants ans optionaly defromation vectors
 
@@ -31,6 +31,8 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]):
     config:
         LamaConfig object if running from other lama module
         Path to config file if running this module independently
+    threads
+        The number of threads transformix should use. If None, use config['threads']
     """
     if isinstance(config, Path):
         config = LamaConfig(config)
@@ -77,7 +79,7 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]):
         log_jacobians_scale_dir.mkdir()
 
         generate_deformation_fields(reg_stage_dirs, resolutions, deformation_scale_dir, jacobians_scale_dir,
-                                    log_jacobians_scale_dir, make_vectors, threads=config['threads'], filetype=config['filetype'])
+                                    log_jacobians_scale_dir, make_vectors, threads=threads or config['threads'], filetype=config['filetype'])
 
 
 def generate_deformation_fields(registration_dirs: List,
@@ -1,19 +1,38 @@
 from lama import common
+from lama.utilities.config_checksum import md5, file_md5
 from logzero import logger as logging
 import sys
 from os.path import join, isdir, splitext, basename, relpath, exists, abspath, dirname, realpath
 import subprocess
 import os
 import shutil
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
-from typing import Union
+from typing import Union, List, Dict, Iterable
 import yaml
 import SimpleITK as sitk
+import numpy as np
 
 REOLSUTION_TP_PREFIX = 'TransformParameters.0.R'
 FULL_STAGE_TP_FILENAME = 'TransformParameters.0.txt'
 RESOLUTION_IMG_FOLDER = 'resolution_images'
+REG_DONE_FILE = 'reg_done.yaml'  # Written to a specimen registration folder on completion
+PAIRWISE_STATUS_FILE = 'pairwise_status.yaml'  # The outcome of each pair in a pairwise stage
+PAIRWISE_NEIGHBOURS_FILE = 'pairwise_neighbours.yaml'  # The partners chosen for each specimen in sparse pairwise mode
+NEIGHBOUR_IMG_SIZE = 64  # Images are shrunk to about this size along their longest axis for ranking similarity
+
+REGISTRATION_BACKENDS = ('elastix', 'simpleitk')
+# The elastix transforms that can be run with the SimpleITK backend
+SITK_TRANSFORMS = {'EulerTransform': sitk.Euler3DTransform,
+                   'SimilarityTransform': sitk.Similarity3DTransform,
+                   'AffineTransform': lambda: sitk.AffineTransform(3)}
+# The elastix optimizers that can be run with the SimpleITK backend
+SITK_OPTIMIZERS = ('AdaptiveStochasticGradientDescent', 'StandardGradientDescent', 'RegularStepGradientDescent')
+SITK_RANDOM_SEED = 121212  # Same default seed as the elastix samplers
+ELX_PIXEL_TYPES = {'char': np.int8, 'unsigned char': np.uint8, 'short': np.int16, 'unsigned short': np.uint16,
+                   'int': np.int32, 'unsigned int': np.uint32, 'float': np.float32, 'double': np.float64}
 
 
 class ElastixRegistration(object):
@@ -24,6 +43,8 @@ class ElastixRegistration(object):
                  filetype: str,
                  threads: int = None,
                  fixed_mask=None,
+                 workers: int = 1,
+                 resume: bool = False
                  ):
         """
 
@@ -41,6 +62,11 @@ class ElastixRegistration(object):
             How many threads to maximally use
         fixed_mask
             The binary mask for fixed image
+        workers
+            How many elastix processes to run at once. The threads are split between them
+        resume
+            If True, do not rerun registrations that have a current done file. The done files are only written when
+            resuming, as making the keys needs a read of every input and output volume
         """
 
         self.elxparam_file = elxparam_file
@@ -49,17 +75,114 @@ class ElastixRegistration(object):
         self.fixed_mask = fixed_mask
         self.filetype = filetype
         self.threads = threads
+        self.workers = workers if workers else 1
+        self.resume = resume
+        self._checksums = {}  # File checksums. The fixed image is used for every specimen so only hash it once
+        self.initial_transforms = {}  # specimen id: elastix transform parameter file to start from
+        self.downsample = 1  # Register at 1/downsample resolution
+        self.downsample_cache = None  # Where to keep the downsampled copies of the images
         # A subset of volumes from folder to register
 
-    def make_average(self, out_path):
+    def threads_per_worker(self) -> Union[int, None]:
+        """
+        Split the thread budget between the concurrently-running elastix processes
+        """
+        if not self.threads:
+            return None
+        return max(1, self.threads // self.workers)
+
+    def set_initial_transforms(self, initial_transforms: Dict[str, Path]):
+        """
+        Parameters
+        ----------
+        initial_transforms
+            specimen id: elastix transform parameter file to use as the initial transform for that specimen
+        """
+        self.initial_transforms = initial_transforms
+
+    def registration_key(self, mov: Path, fixed: Path) -> str:
+        """
+        Get a checksum of everything that determines the result of a single registration: the elastix parameters,
+        the fixed image (and mask) and the moving image.
+        """
+        with open(self.elxparam_file, 'r') as fh:
+            elx_params = fh.read()
+
+        inputs = {'elastix_parameters': elx_params,
+                  'fixed': self._file_checksum(fixed),
+                  'moving': self._file_checksum(mov)}
+        if self.fixed_mask is not None:
+            inputs['fixed_mask'] = self._file_checksum(self.fixed_mask)
+        if mov.stem in self.initial_transforms:
+            inputs['initial_transform'] = self._file_checksum(self.initial_transforms[mov.stem])
+        if self.downsample > 1:
+            inputs['downsample'] = self.downsample
+
+        return md5(inputs)
+
+    def _file_checksum(self, path: Path) -> str:
+        path = str(path)
+        if path not in self._checksums:
+            self._checksums[path] = file_md5(path)
+        return self._checksums[path]
+
+    def outputs_checksum(self) -> Union[str, None]:
+        """
+        Get a checksum of all the registered images in the stage from the done files.
+
+        Returns
+        -------
+        None if any specimen does not have a done file, which is always the case when not resuming
+        """
+        outputs = {}
+
+        for spec_dir in sorted(Path(self.stagedir).iterdir()):
+            if not spec_dir.is_dir():
+                continue
+            done_file = spec_dir / REG_DONE_FILE
+            if not done_file.is_file():
+                return None
+            with open(done_file, 'r') as fh:
+                outputs[spec_dir.name] = yaml.safe_load(fh)['output_md5']
+
+        return md5(outputs)
+
+    def remove_stale_dirs(self, out_dir: Path, current_ids: Iterable[str]):
+        """
+        When resuming, remove the registration folders of specimens that are no longer inputs, so they do not end up
+        in the stage average
+
+        Parameters
+        ----------
+        out_dir
+            The folder holding a registration folder per specimen
+        current_ids
+            The ids of the specimens in the current run
+        """
+        if not out_dir.is_dir():
+            return
+        keep = set(current_ids) | {RESOLUTION_IMG_FOLDER}
+        for spec_dir in out_dir.iterdir():
+            if spec_dir.is_dir() and spec_dir.name not in keep:
+                logging.info(f'Removing {spec_dir}. The specimen is no longer an input')
+                shutil.rmtree(spec_dir)
+
+    def make_average(self, out_path, method: str = 'mean'):
         """
         Create an average of the the input embryo volumes.
         This will search subfolders for all the registered volumes within them
+
+        Parameters
+        ----------
+        out_path
+            Where to write the average
+        method
+            One of common.AVERAGE_METHODS
         """
         vols = common.get_file_paths(self.stagedir, ignore_folder=RESOLUTION_IMG_FOLDER)
         #logging.info("making average from following volumes\n {}".format('\n'.join(vols)))
 
-        average = common.average(vols)
+        average = common.average(vols, method=method)
 
         sitk.WriteImage(average, out_path, True)
 
@@ -68,10 +191,26 @@ class TargetBasedRegistration(ElastixRegistration):
     def __init__(self, *args):
         super(TargetBasedRegistration, self).__init__(*args)
         self.fixed = None
+        self._downsample_lock = threading.Lock()
 
     def set_target(self, target):
         self.fixed = target
 
+    def set_downsample(self, factor: int, cache_dir: Path):
+        """
+        Register using downsampled copies of the moving images and target. The transforms are then applied to the
+        full resolution moving images, so the outputs are still full resolution
+
+        Parameters
+        ----------
+        factor
+            The downsampling factor
+        cache_dir
+            Where to keep the downsampled copies. These are reused while the source image is unchanged
+        """
+        self.downsample = factor
+        self.downsample_cache = cache_dir
+
     def run(self):
 
         if self.movdir.is_file():
@@ -82,41 +221,281 @@ class TargetBasedRegistration(ElastixRegistration):
         if len(moving_imgs) < 1:
             raise common.LamaDataException("No volumes in {}".format(self.movdir))
 
-        for mov in moving_imgs:
-            mov_basename = mov.stem
-            outdir = self.stagedir / mov_basename
-            outdir.mkdir(parents=True)
+        if self.resume:
+            self.remove_stale_dirs(Path(self.stagedir), [mov.stem for mov in moving_imgs])
+
+        if self.workers > 1:
+            self._run_concurrent(moving_imgs)
+        else:
+            for mov in moving_imgs:
+                self.register_specimen(mov, self.threads)
+
+    def _run_concurrent(self, moving_imgs: List[Path]):
+        """
+        Run multiple elastix processes at once. elastix does not scale well past a few cores, so it's quicker to run
+        several registrations with fewer threads each.
+
+        A failed registration does not stop the others. Once all have finished, raise if any have failed.
+        """
+        threads = self.threads_per_worker()
+        logging.info(f'Running {self.workers} concurrent registrations with {threads} threads each')
+
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # elastix runs in a subprocess so threads are enough here
+            futures = {executor.submit(self.register_specimen, mov, threads): mov for mov in moving_imgs}
+
+            for future in as_completed(futures):
+                mov = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f'Registration of {mov.name} failed: {e}')
+                    failed.append(mov.name)
+                else:
+                    logging.info(f'Registration of {mov.name} finished')
+
+        if failed:
+            raise common.RegistrationException('The following registrations failed:\n{}'.format('\n'.join(failed)))
+
+    def register_specimen(self, mov: Path, threads: Union[int, None]):
+        """
+        Register a single moving image to the target and tidy up the output
+
+        Parameters
+        ----------
+        mov
+            The moving image
+        threads
+            The number of threads elastix should use
+        """
+        mov_basename = mov.stem
+        outdir = self.stagedir / mov_basename
+
+        if self.resume:
+            reg_key = self.registration_key(mov, self.fixed)
+            if registration_done(outdir, reg_key):
+                logging.info(f'Skipping {mov_basename}. Already registered with the same inputs')
+                return
+            # A stale or partial registration
+            shutil.rmtree(outdir, ignore_errors=True)
+
+        outdir.mkdir(parents=True)
+
+        new_out_name = self._register(mov, outdir, threads)
+
+        # add registration metadata
+        reg_metadata_path = outdir / common.INDV_REG_METADATA
+        fixed_vol_relative = relpath(self.fixed, outdir)
+        reg_metadata = {'fixed_vol': fixed_vol_relative}
+
+        with open(reg_metadata_path, 'w') as fh:
+            fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+
+        if self.resume:
+            write_registration_done(outdir, reg_key, new_out_name)
+
+    def _register(self, mov: Path, outdir: Path, threads: Union[int, None]) -> Path:
+        """
+        Run elastix on a single moving image
+
+        Returns
+        -------
+        The path to the registered image
+        """
+        if self.downsample > 1:
+            return self._register_downsampled(mov, outdir, threads)
+
+        cmd = {'mov': str(mov),
+               'fixed': str(self.fixed),
+               'outdir': str(outdir),
+               'elxparam_file': str(self.elxparam_file),
+               'threads': threads,
+               'fixed': str(self.fixed)}
+        if self.fixed_mask is not None:
+            cmd['fixed_mask'] = str(self.fixed_mask)
+        if mov.stem in self.initial_transforms:
+            cmd['initial_transform'] = str(self.initial_transforms[mov.stem])
+
+        run_elastix(cmd)
+
+        # Rename the registered output.
+        elx_outfile = outdir / f'result.0.{self.filetype}'
+        new_out_name = outdir / f'{mov.stem}.{self.filetype}'
+
+        try:
+            shutil.move(elx_outfile, new_out_name)
+        except IOError:
+            logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
+            raise
+
+        move_intemediate_volumes(outdir)
+
+        return new_out_name
+
+    def _register_downsampled(self, mov: Path, outdir: Path, threads: Union[int, None]) -> Path:
+        """
+        Run elastix on downsampled copies of the moving image and target, then make the full resolution output
+
+        The downsampled images keep their physical extent (the spacing is increased), so the transform parameters are
+        already in full resolution physical units. Only the output grid in the transform parameter files needs changing
+        back to that of the full resolution target before applying them to the full resolution moving image.
+
+        Returns
+        -------
+        The path to the registered image
+        """
+        with self._downsample_lock:
+            fixed = self._downsampled_copy(Path(self.fixed))
+            fixed_mask = self._downsampled_copy(Path(self.fixed_mask), mask=True) if self.fixed_mask is not None else None
 
-            cmd = {'mov': str(mov),
-                   'fixed': str(self.fixed),
-                   'outdir': str(outdir),
-                   'elxparam_file': str(self.elxparam_file),
-                   'threads': self.threads,
-                   'fixed': str(self.fixed)}
-            if self.fixed_mask is not None:
-                cmd['fixed_mask'] = str(self.fixed_mask)
+        cmd = {'mov': str(self._downsampled_copy(mov)),
+               'fixed': str(fixed),
+               'outdir': str(outdir),
+               'elxparam_file': str(self.elxparam_file),
+               'threads': threads}
+        if fixed_mask is not None:
+            cmd['fixed_mask'] = str(fixed_mask)
+        if mov.stem in self.initial_transforms:
+            cmd['initial_transform'] = str(self.initial_transforms[mov.stem])
 
-            run_elastix(cmd)
+        run_elastix(cmd)
 
-            # Rename the registered output.
-            elx_outfile = outdir / f'result.0.{self.filetype}'
-            new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+        # The low resolution result is not needed
+        for small_result in outdir.glob('result.*'):
+            small_result.unlink()
 
-            try:
-                shutil.move(elx_outfile, new_out_name)
-            except IOError:
-                logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
-                raise
+        for tp_file in outdir.glob('TransformParameters.0*.txt'):
+            set_elastix_transform_grid(tp_file, Path(self.fixed))
 
-            move_intemediate_volumes(outdir)
+        run_transformix({'mov': str(mov),
+                         'tp': str(outdir / FULL_STAGE_TP_FILENAME),
+                         'outdir': str(outdir),
+                         'threads': threads})
 
-            # add registration metadata
-            reg_metadata_path = outdir / common.INDV_REG_METADATA
-            fixed_vol_relative = relpath(self.fixed, outdir)
-            reg_metadata = {'fixed_vol': fixed_vol_relative}
+        new_out_name = outdir / f'{mov.stem}.{self.filetype}'
+        shutil.move(outdir / f'result.{self.filetype}', new_out_name)
 
-            with open(reg_metadata_path, 'w') as fh:
-                fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+        return new_out_name
+
+    def _downsampled_copy(self, path: Path, mask: bool = False) -> Path:
+        """
+        Get a downsampled copy of an image from the cache, making it if needed.
+        The cached file name includes a checksum of the source so a changed image is not matched to an old copy
+        """
+        out_path = self.downsample_cache / f'{path.stem}_{self._file_checksum(path)[:12]}_x{self.downsample}.nrrd'
+
+        if not out_path.is_file():
+            img = sitk.ReadImage(str(path))
+            if mask:
+                small = sitk.Cast(sitk.BinShrink(img, [self.downsample] * img.GetDimension()) > 0.5, sitk.sitkUInt8)
+            else:
+                small = pyramid_level(sitk.Cast(img, sitk.sitkFloat32), self.downsample)
+
+            # Write then rename so another worker never sees a partial file
+            tmp_path = out_path.with_name(f'.{out_path.name}.{threading.get_ident()}.tmp.nrrd')
+            sitk.WriteImage(small, str(tmp_path), True)
+            os.replace(tmp_path, out_path)
+
+        return out_path
+
+
+class SimpleITKTargetBasedRegistration(TargetBasedRegistration):
+    """
+    Target-based registration of low degree-of-freedom stages (rigid, similarity, affine) run in-process with
+    SimpleITK instead of in an elastix subprocess.
+
+    The relevant settings are read from the stage's elastix parameter file. The fixed image and its pyramid are made
+    once and shared by all the specimens in the stage. An elastix-compatible TransformParameters.0.txt is written for
+    each specimen so inversion and deformation generation work as for elastix stages.
+    """
+    def __init__(self, *args):
+        super(SimpleITKTargetBasedRegistration, self).__init__(*args)
+        self.elx_params = read_elastix_parameters(self.elxparam_file)
+        self._fixed_img = None
+        self._fixed_pyramid = None
+        self._fixed_mask_img = None
+        self._pyramid_lock = threading.Lock()
+
+    def _pyramid_schedule(self) -> List[int]:
+        """
+        Get the shrink factor for each resolution, coarsest first
+        """
+        num_res = int(self.elx_params.get('NumberOfResolutions', 4))
+        schedule = self.elx_params.get('ImagePyramidSchedule')
+        if schedule is None:
+            return [2 ** (num_res - 1 - i) * self.downsample for i in range(num_res)]
+        schedule = schedule if isinstance(schedule, list) else [schedule]
+        if len(schedule) == num_res * 3:
+            schedule = schedule[::3]  # elastix format has a factor for each dimension
+        # The pyramid is made in-process from the full resolution images so downsampling just makes each level coarser
+        return [int(x) * self.downsample for x in schedule]
+
+    def _fixed_levels(self) -> List[sitk.Image]:
+        with self._pyramid_lock:
+            if self._fixed_pyramid is None:
+                self._fixed_img = sitk.ReadImage(str(self.fixed), sitk.sitkFloat32)
+                self._fixed_pyramid = [pyramid_level(self._fixed_img, f) for f in self._pyramid_schedule()]
+                if self.fixed_mask is not None:
+                    self._fixed_mask_img = sitk.Cast(sitk.ReadImage(str(self.fixed_mask)), sitk.sitkUInt8)
+            return self._fixed_pyramid
+
+    def _register(self, mov: Path, outdir: Path, threads: Union[int, None]) -> Path:
+        """
+        Register a single moving image with SimpleITK, then write the resampled image and the transform parameters
+
+        Returns
+        -------
+        The path to the registered image
+        """
+        params = self.elx_params
+        fixed_levels = self._fixed_levels()
+        fixed = self._fixed_img
+
+        moving_img = sitk.ReadImage(str(mov))
+        moving = sitk.Cast(moving_img, sitk.sitkFloat32)
+
+        transform = SITK_TRANSFORMS[params['Transform']]()
+
+        if mov.stem in self.initial_transforms:
+            # Start from the initial transform rather than composing with it, so the transform file stands alone
+            initial = read_elastix_euler_transform(self.initial_transforms[mov.stem])
+            transform.SetCenter(initial.GetCenter())
+            transform.SetMatrix(initial.GetMatrix())
+            transform.SetTranslation(initial.GetTranslation())
+        else:
+            init_method = sitk.CenteredTransformInitializerFilter.MOMENTS \
+                if params.get('AutomaticTransformInitializationMethod') == 'CenterOfGravity' \
+                else sitk.CenteredTransformInitializerFilter.GEOMETRY
+            transform = sitk.CenteredTransformInitializer(fixed, moving, transform, init_method)
+            if str(params.get('AutomaticTransformInitialization', 'false')).lower() != 'true':
+                # elastix only sets the centre of rotation to the centre of the fixed image
+                transform.SetTranslation([0.0] * fixed.GetDimension())
+
+        # Each resolution is run separately so the fixed pyramid can be reused across specimens
+        for level, (factor, fixed_level) in enumerate(zip(self._pyramid_schedule(), fixed_levels)):
+            reg = sitk.ImageRegistrationMethod()
+            set_sitk_metric(reg, params, fixed_level.GetNumberOfPixels())
+            if self._fixed_mask_img is not None:
+                reg.SetMetricFixedMask(self._fixed_mask_img)
+            reg.SetInterpolator(sitk.sitkLinear)
+            set_sitk_optimizer(reg, params, level, fixed)
+            reg.SetOptimizerScalesFromPhysicalShift()
+            reg.SetInitialTransform(transform, inPlace=True)
+            if threads:
+                reg.SetNumberOfThreads(threads)
+
+            reg.Execute(fixed_level, pyramid_level(moving, factor))
+
+        new_out_name = outdir / f'{mov.stem}.{self.filetype}'
+        registered = resample_like_elastix(moving_img, fixed, transform, params)
+        sitk.WriteImage(registered, str(new_out_name), True)
+
+        write_elastix_transform(outdir / FULL_STAGE_TP_FILENAME, transform, fixed, params,
+                                result_pixel_type(moving_img, params))
+
+        return new_out_name
 
 
 class PairwiseBasedRegistration(ElastixRegistration):
@@ -124,61 +503,201 @@ class PairwiseBasedRegistration(ElastixRegistration):
     def __init__(self, *args):
         super(PairwiseBasedRegistration, self).__init__(*args)
         self.inputs_and_mean_tp = {}
+        self.num_neighbours = None
+
+    def set_num_neighbours(self, k: Union[int, None]):
+        """
+        Register each specimen to only its k most similar specimens instead of all others.
+        If None, do full pairwise registration
+        """
+        self.num_neighbours = k
 
     def run(self):
+        """
+        Register every specimen to every other specimen then, for each specimen, combine the transforms from its row of
+        pairs into a mean transform and apply it.
 
+        The pairs are run as a job graph on a pool of self.workers elastix processes. As soon as all the pairs for a
+        fixed image have finished, its mean transform job is put at the front of the queue.
+        A failed pair is logged and the mean transform is made from the remaining pairs in that row.
+
+        If self.num_neighbours is set, each fixed image only gets the pairs from its most similar specimens.
+        This makes the number of registrations O(N*k) rather than O(N^2)
+        """
         # If inputs_vols is a file get the specified root and paths from it
         if isdir(self.movdir):
-            movlist = common.get_file_paths(self.movdir)
+            movlist = common.get_file_paths(Path(self.movdir), ignore_folder=RESOLUTION_IMG_FOLDER)
         else:
-            movlist = common.get_inputs_from_file_list(self.movdir, self.config_dir)
+            movlist = [Path(x) for x in common.get_inputs_from_file_list(self.movdir, Path(self.movdir).parent)]
 
         if len(movlist) < 1:
             raise common.LamaDataException("No volumes in {}".format(self.movdir))
 
-        for fixed in movlist:  # Todo: change variable name fixed to moving
-            tp_file_paths = defaultdict(list)
-            full_tp_file_paths = []
-            fixed_basename = splitext(basename(fixed))[0]
-            fixed_dir = self.paths.make(join(self.stagedir, fixed_basename), 'f')
-
-            for moving in movlist:
-                if basename(fixed) == basename(moving):
-                    continue
-                moving_basename = splitext(basename(moving))[0]
-                outdir = join(fixed_dir, moving_basename)
-                common.mkdir_force(outdir)
-
-                run_elastix({'mov': moving,
-                             'fixed': fixed,
-                             'outdir': outdir,
-                             'elxparam_file': self.elxparam_file,
-                             'threads': self.threads,
-                             'fixed': fixed})
-                # Get the resolution tforms
-                tforms = list(sorted([x for x in os.listdir(outdir) if x .startswith(REOLSUTION_TP_PREFIX)]))
-                # get the full tform that spans all resolutions
-                full_tp_file_paths.append(join(outdir, FULL_STAGE_TP_FILENAME))
-
-                # Add the tforms to a resolution-specific list so we can generate deformations from any range
-                # of deformations later
-                for i, tform in enumerate(tforms):
-                    tp_file_paths[i].append(join(outdir, tform))
-
-                # add registration metadata
-                reg_metadata_path = join(outdir, common.INDV_REG_METADATA)
-                fixed_vol_relative = relpath(fixed, outdir)
-                reg_metadata = {'fixed_vol': fixed_vol_relative}
-                with open(reg_metadata_path, 'w') as fh:
-                    fh.write(yaml.dump(reg_metadata, default_flow_style=False))
-
-            for i, files_ in tp_file_paths.items():
-                mean_tfom_name = "{}{}.txt".format(REOLSUTION_TP_PREFIX, i)
-                self.generate_mean_tranform(files_, fixed, fixed_dir, mean_tfom_name, self.filetype)
-            self.generate_mean_tranform(full_tp_file_paths, fixed, fixed_dir, FULL_STAGE_TP_FILENAME, self.filetype)
+        threads = self.threads_per_worker()
+
+        if self.num_neighbours and self.num_neighbours < len(movlist) - 1:
+            partners = nearest_neighbours(movlist, self.num_neighbours)
+
+            with open(Path(self.stagedir) / PAIRWISE_NEIGHBOURS_FILE, 'w') as fh:
+                neighbour_ids = {f.stem: [m.stem for m in ms] for f, ms in partners.items()}
+                fh.write(yaml.dump(neighbour_ids, default_flow_style=False))
+        else:
+            partners = {fixed: [m for m in movlist if m.name != fixed.name] for fixed in movlist}
+
+        # A mean transform can't be made without any pairs, so the specimen would have no output
+        no_partners = [fixed.stem for fixed in movlist if not partners[fixed]]
+        if no_partners:
+            raise common.LamaDataException('Pairwise registration needs at least two specimens. No partners for:\n{}'
+                                           .format('\n'.join(no_partners)))
+
+        if self.resume:
+            self.remove_stale_dirs(Path(self.stagedir), [fixed.stem for fixed in movlist])
+            for fixed in movlist:
+                self.remove_stale_dirs(Path(self.stagedir) / fixed.stem, [m.stem for m in partners[fixed]])
+
+        jobs = deque(('pair', fixed, moving) for fixed in movlist for moving in partners[fixed])
+        num_pairs = len(jobs)
+
+        pairs_left = {fixed: len(partners[fixed]) for fixed in movlist}
+        pair_dirs = defaultdict(list)  # Successful pair registrations for each fixed image
+        status = defaultdict(dict)
+        failed_means = []
+        pairs_done = 0
+
+        logging.info(f'Running {num_pairs} pairwise registrations, {self.workers} at a time with {threads} threads each')
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                in_flight = {}
+
+                while jobs or in_flight:
+                    # Only keep as many jobs in the pool as there are workers so the mean transform jobs can jump the queue
+                    while jobs and len(in_flight) < self.workers:
+                        job = jobs.popleft()
+                        if job[0] == 'pair':
+                            future = executor.submit(self._register_pair, job[1], job[2], threads)
+                        else:
+                            future = executor.submit(self._make_mean_transform, job[1], pair_dirs[job[1]], threads)
+                        in_flight[future] = job
+
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                    for future in finished:
+                        job_type, fixed, *moving = in_flight.pop(future)
+                        error = future.exception()
+
+                        if job_type == 'mean':
+                            if error:
+                                logging.error(f'Mean transform for {fixed.stem} failed: {error}')
+                                failed_means.append(fixed.stem)
+                            continue
+
+                        moving = moving[0]
+                        pairs_done += 1
+
+                        if error:
+                            logging.error(f'Pairwise registration {moving.stem} -> {fixed.stem} failed: {error}')
+                            status[fixed.stem][moving.stem] = 'failed'
+                        else:
+                            status[fixed.stem][moving.stem] = 'complete'
+                            pair_dirs[fixed].append(future.result())
+
+                        logging.info(f'{pairs_done}/{num_pairs} pairwise registrations finished')
+
+                        pairs_left[fixed] -= 1
+                        if pairs_left[fixed] == 0:
+                            if pair_dirs[fixed]:
+                                jobs.appendleft(('mean', fixed))
+                            else:
+                                logging.error(f'All pairwise registrations to {fixed.stem} failed')
+                                failed_means.append(fixed.stem)
+        finally:
+            with open(Path(self.stagedir) / PAIRWISE_STATUS_FILE, 'w') as fh:
+                fh.write(yaml.dump({k: dict(v) for k, v in status.items()}, default_flow_style=False))
+
+        if failed_means:
+            raise common.RegistrationException('Could not make the mean transform for:\n{}'.format('\n'.join(failed_means)))
+
+    def _register_pair(self, fixed: Path, moving: Path, threads: Union[int, None]) -> Path:
+        """
+        Register one specimen to another
+
+        Returns
+        -------
+        The registration output directory
+        """
+        outdir = Path(self.stagedir) / fixed.stem / moving.stem
+
+        if self.resume:
+            reg_key = self.registration_key(moving, fixed)
+            if registration_done(outdir, reg_key):
+                logging.info(f'Skipping {moving.stem} -> {fixed.stem}. Already registered with the same inputs')
+                return outdir
+
+        common.mkdir_force(outdir)
+
+        run_elastix({'mov': str(moving),
+                     'fixed': str(fixed),
+                     'outdir': str(outdir),
+                     'elxparam_file': str(self.elxparam_file),
+                     'threads': threads})
+
+        # add registration metadata
+        reg_metadata_path = outdir / common.INDV_REG_METADATA
+        fixed_vol_relative = relpath(fixed, outdir)
+        reg_metadata = {'fixed_vol': fixed_vol_relative}
+        with open(reg_metadata_path, 'w') as fh:
+            fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+
+        if self.resume:
+            write_registration_done(outdir, reg_key, outdir / FULL_STAGE_TP_FILENAME)
+
+        return outdir
+
+    def _make_mean_transform(self, fixed: Path, pair_dirs: List[Path], threads: Union[int, None] = None):
+        """
+        Combine the transforms from all the pairs registered to fixed and apply the mean transform to it.
+        threads is the number of threads for transformix. If None, it uses all the cores
+        """
+        fixed_dir = Path(self.stagedir) / fixed.stem
+
+        if self.resume:
+            # The mean transform only needs remaking if any of the pair transforms have changed
+            pair_outputs = {}
+            for outdir in pair_dirs:
+                with open(outdir / REG_DONE_FILE, 'r') as fh:
+                    pair_outputs[outdir.name] = yaml.safe_load(fh)['output_md5']
+            mean_key = md5({'fixed': self._file_checksum(fixed), 'pairs': pair_outputs})
+
+            if registration_done(fixed_dir, mean_key):
+                logging.info(f'Skipping mean transform for {fixed.stem}. The pairwise transforms are unchanged')
+                return
+
+        tp_file_paths = defaultdict(list)
+        full_tp_file_paths = []
+
+        for outdir in sorted(pair_dirs):
+            # Get the resolution tforms
+            tforms = list(sorted([x for x in os.listdir(outdir) if x.startswith(REOLSUTION_TP_PREFIX)]))
+            # get the full tform that spans all resolutions
+            full_tp_file_paths.append(str(outdir / FULL_STAGE_TP_FILENAME))
+
+            # Add the tforms to a resolution-specific list so we can generate deformations from any range
+            # of deformations later
+            for i, tform in enumerate(tforms):
+                tp_file_paths[i].append(str(outdir / tform))
+
+        for i, files_ in tp_file_paths.items():
+            mean_tfom_name = "{}{}.txt".format(REOLSUTION_TP_PREFIX, i)
+            self.generate_mean_tranform(files_, str(fixed), str(fixed_dir), mean_tfom_name, self.filetype, threads)
+        self.generate_mean_tranform(full_tp_file_paths, str(fixed), str(fixed_dir), FULL_STAGE_TP_FILENAME, self.filetype,
+                                    threads)
+
+        if self.resume:
+            write_registration_done(fixed_dir, mean_key, fixed_dir / f'{fixed.stem}.{self.filetype}')
 
     @staticmethod
-    def generate_mean_tranform(tp_files, fixed_vol, out_dir, tp_out_name, filetype):
+    def generate_mean_tranform(tp_files, fixed_vol, out_dir, tp_out_name, filetype, threads=None):
         """
 
         Parameters
@@ -192,6 +711,8 @@ class PairwiseBasedRegistration(ElastixRegistration):
             path to output directory
         filetype
             Filetype for output
+        threads: int/None
+            number of threads for transformix to use. if None, use all available cpus
         -------
 
         """
@@ -217,6 +738,8 @@ class PairwiseBasedRegistration(ElastixRegistration):
                '-tp', mean_tp_file,
                '-out', out_dir,
                ]
+        if threads:
+            cmd.extend(['-threads', str(threads)])
         try:
             subprocess.check_output(cmd)
         except Exception as e:  # Can't seem to log CalledProcessError
@@ -230,6 +753,298 @@ class PairwiseBasedRegistration(ElastixRegistration):
             shutil.move(elx_outfile, new_out_name)
 
 
+def nearest_neighbours(img_paths: List[Path], k: int) -> Dict[Path, List[Path]]:
+    """
+    For each image, find the k other images that are most similar to it.
+    Similarity is measured with normalised cross correlation on downsampled copies of the images,
+    so this should be run on images that have already been rigidly aligned.
+
+    Parameters
+    ----------
+    img_paths
+        The images to compare. They should all be the same size
+    k
+        The number of neighbours to get for each image
+
+    Returns
+    -------
+    image path: the k most similar images, most similar first
+    """
+    vectors = []
+
+    for path in img_paths:
+        img = sitk.ReadImage(str(path), sitk.sitkFloat32)
+        factor = max(1, int(np.ceil(max(img.GetSize()) / NEIGHBOUR_IMG_SIZE)))
+        small = sitk.GetArrayFromImage(sitk.BinShrink(img, [factor] * img.GetDimension())).ravel()
+        small -= small.mean()
+        norm = np.linalg.norm(small)
+        vectors.append(small / norm if norm else small)
+
+    vectors = np.stack(vectors)
+    ncc = vectors @ vectors.T
+    np.fill_diagonal(ncc, -np.inf)  # An image is not its own neighbour
+
+    neighbours = {}
+    for i, path in enumerate(img_paths):
+        ranked = np.argsort(ncc[i])[::-1][:k]
+        neighbours[path] = [img_paths[j] for j in ranked]
+
+    return neighbours
+
+
+def read_elastix_parameters(path: Path) -> dict:
+    """
+    Read an elastix parameter file into a dict. Parameters with more than one value are returned as lists
+    """
+    params = {}
+
+    with open(path, 'r') as fh:
+        for line in fh:
+            line = line.split('//')[0].strip()
+            if not (line.startswith('(') and line.endswith(')')):
+                continue
+            name, *values = line[1:-1].split()
+            values = [v.strip('"') for v in values]
+            values = [float(v) if common.is_number(v) else v for v in values]
+            params[name] = values[0] if len(values) == 1 else values
+
+    return params
+
+
+def read_elastix_euler_transform(path: Path) -> sitk.Euler3DTransform:
+    """
+    Read an elastix EulerTransform parameter file into a SimpleITK transform
+    """
+    params = read_elastix_parameters(path)
+
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter([float(x) for x in params['CenterOfRotationPoint']])
+    transform.SetParameters([float(x) for x in params['TransformParameters']])
+
+    return transform
+
+
+def pyramid_level(img: sitk.Image, factor: int) -> sitk.Image:
+    """
+    Smooth and shrink an image in the same way as the elastix smoothing image pyramid (sigma = 0.5 * factor voxels)
+    """
+    if factor == 1:
+        return img
+    sigmas = [0.5 * factor * sp for sp in img.GetSpacing()]
+    return sitk.Shrink(sitk.SmoothingRecursiveGaussian(img, sigmas), [factor] * img.GetDimension())
+
+
+def set_sitk_metric(reg: sitk.ImageRegistrationMethod, params: dict, num_voxels: int):
+    """
+    Set the SimpleITK registration metric and sampling to match the elastix parameters
+    """
+    metric = params.get('Metric', 'AdvancedMattesMutualInformation')
+
+    if metric == 'AdvancedNormalizedCorrelation':
+        reg.SetMetricAsCorrelation()
+    elif metric == 'AdvancedMeanSquares':
+        reg.SetMetricAsMeanSquares()
+    else:
+        bins = params.get('NumberOfHistogramBins', 32)
+        bins = bins[0] if isinstance(bins, list) else bins
+        reg.SetMetricAsMattesMutualInformation(numberOfHistogramBins=int(bins))
+
+    samples = params.get('NumberOfSpatialSamples')
+    if samples is not None and params.get('ImageSampler', 'Random') != 'Full':
+        samples = samples[0] if isinstance(samples, list) else samples
+        reg.SetMetricSamplingStrategy(reg.RANDOM)
+        reg.SetMetricSamplingPercentage(min(1.0, samples / num_voxels), SITK_RANDOM_SEED)
+
+
+def elastix_level_value(params: dict, name: str, level: int, default):
+    """
+    Get the value of an elastix parameter for a resolution level. A single value applies to all levels and a list that
+    is shorter than the number of levels has its last value repeated
+    """
+    value = params.get(name, default)
+    if isinstance(value, list):
+        value = value[min(level, len(value) - 1)]
+    return value
+
+
+def set_sitk_optimizer(reg: sitk.ImageRegistrationMethod, params: dict, level: int, fixed: sitk.Image):
+    """
+    Set the SimpleITK optimizer for a resolution level to match the elastix optimizer, iterations and step size
+    parameters. The defaults are those of elastix
+
+    AdaptiveStochasticGradientDescent with AutomaticParameterEstimation limits each step to MaximumStepLength
+    (in mm), which maps onto the ITK learning rate estimator. Otherwise elastix uses the decaying gain
+    SP_a / (SP_A + k + 1) ^ SP_alpha. The ITK gradient descent optimizer has a fixed learning rate, so the mean of the
+    gain over the iterations is used
+    """
+    optimizer = params.get('Optimizer', 'AdaptiveStochasticGradientDescent')
+    if optimizer not in SITK_OPTIMIZERS:
+        raise ValueError(f'The {optimizer} optimizer is not available with the SimpleITK backend. '
+                         f'Use one of {", ".join(SITK_OPTIMIZERS)}')
+
+    iterations = int(elastix_level_value(params, 'MaximumNumberOfIterations', level, 500))
+
+    if optimizer == 'RegularStepGradientDescent':
+        reg.SetOptimizerAsRegularStepGradientDescent(
+            learningRate=float(elastix_level_value(params, 'MaximumStepLength', level, 1.0)),
+            minStep=float(elastix_level_value(params, 'MinimumStepLength', level, 0.5)),
+            numberOfIterations=iterations,
+            relaxationFactor=float(elastix_level_value(params, 'RelaxationFactor', level, 0.5)),
+            gradientMagnitudeTolerance=float(elastix_level_value(params, 'MinimumGradientMagnitude', level, 1e-8)))
+        return
+
+    # elastix runs stochastic gradient descent for all the iterations, so turn off the ITK convergence check
+    auto_estimate = str(params.get('AutomaticParameterEstimation', 'false')).lower() == 'true'
+    if optimizer == 'AdaptiveStochasticGradientDescent' and auto_estimate:
+        # elastix defaults the maximum step to the mean voxel spacing of the fixed image
+        max_step = float(elastix_level_value(params, 'MaximumStepLength', level, np.mean(fixed.GetSpacing())))
+        reg.SetOptimizerAsGradientDescent(learningRate=1.0, numberOfIterations=iterations,
+                                          convergenceMinimumValue=0.0,
+                                          estimateLearningRate=reg.EachIteration,
+                                          maximumStepSizeInPhysicalUnits=max_step)
+    else:
+        a = float(elastix_level_value(params, 'SP_a', level, 400.0))
+        big_a = float(elastix_level_value(params, 'SP_A', level, 50.0))
+        alpha = float(elastix_level_value(params, 'SP_alpha', level, 0.602))
+        gain = np.mean(a / (big_a + np.arange(1, iterations + 1)) ** alpha)
+        reg.SetOptimizerAsGradientDescent(learningRate=float(gain), numberOfIterations=iterations,
+                                          convergenceMinimumValue=0.0,
+                                          estimateLearningRate=reg.Never)
+
+
+def result_pixel_type(moving: sitk.Image, params: dict) -> np.dtype:
+    """
+    Get the pixel type of the registered image: the elastix ResultImagePixelType if set, otherwise that of the
+    moving image
+    """
+    out_dtype = ELX_PIXEL_TYPES.get(params.get('ResultImagePixelType'))
+    if out_dtype is None:  # Get it from a single voxel rather than copying the whole image
+        out_dtype = sitk.GetArrayFromImage(moving[:1, :1, :1]).dtype
+    return np.dtype(out_dtype)
+
+
+def resample_like_elastix(moving: sitk.Image, fixed: sitk.Image, transform: sitk.Transform, params: dict) -> sitk.Image:
+    """
+    Resample the moving image onto the fixed grid using the elastix final interpolation order, default pixel value
+    and result pixel type
+    """
+    order = int(params.get('FinalBSplineInterpolationOrder', 3))
+    interpolator = {0: sitk.sitkNearestNeighbor, 1: sitk.sitkLinear}.get(order, sitk.sitkBSpline)
+
+    resampled = sitk.Resample(sitk.Cast(moving, sitk.sitkFloat32), fixed, transform, interpolator,
+                              float(params.get('DefaultPixelValue', 0)), sitk.sitkFloat32)
+
+    out_dtype = result_pixel_type(moving, params)
+    arr = sitk.GetArrayFromImage(resampled)
+    if np.issubdtype(out_dtype, np.integer):
+        info = np.iinfo(out_dtype)
+        arr = np.clip(np.rint(arr), info.min, info.max)
+    out = sitk.GetImageFromArray(arr.astype(out_dtype))
+    out.CopyInformation(resampled)
+
+    return out
+
+
+def write_elastix_transform(out_path: Path, transform: sitk.Transform, fixed: sitk.Image, params: dict,
+                            out_dtype: np.dtype = None):
+    """
+    Write a SimpleITK rigid, similarity or affine transform as an elastix transform parameter file so it can be used
+    by transformix and by the inversion code. out_dtype is the pixel type of the registered image, so that transformix
+    gives the same output. If None, the ResultImagePixelType parameter is used
+    """
+    if out_dtype is None:
+        elx_pixel_type = params.get('ResultImagePixelType', 'short')
+    else:
+        elx_pixel_type = next(name for name, dtype in ELX_PIXEL_TYPES.items() if np.dtype(dtype) == np.dtype(out_dtype))
+
+    dims = fixed.GetDimension()
+    # elastix writes the direction cosines column-wise
+    direction = np.array(fixed.GetDirection()).reshape(dims, dims).T.ravel()
+
+    def fmt(values):
+        return ' '.join('{:.10g}'.format(v) for v in values)
+
+    elx_transform = params['Transform']
+
+    lines = [
+        f'(Transform "{elx_transform}")',
+        f'(NumberOfParameters {len(transform.GetParameters())})',
+        f'(TransformParameters {fmt(transform.GetParameters())})',
+        '(InitialTransformParametersFileName "NoInitialTransform")',
+        '(HowToCombineTransforms "Compose")',
+        f'(FixedImageDimension {dims})',
+        f'(MovingImageDimension {dims})',
+        '(FixedInternalImagePixelType "float")',
+        '(MovingInternalImagePixelType "float")',
+        f'(Size {fmt(fixed.GetSize())})',
+        f'(Index {fmt([0] * dims)})',
+        f'(Spacing {fmt(fixed.GetSpacing())})',
+        f'(Origin {fmt(fixed.GetOrigin())})',
+        f'(Direction {fmt(direction)})',
+        '(UseDirectionCosines "true")',
+        f'(CenterOfRotationPoint {fmt(transform.GetCenter())})',
+    ]
+    if elx_transform == 'EulerTransform':
+        lines.append('(ComputeZYX "false")')
+    lines.extend([
+        '(ResampleInterpolator "FinalBSplineInterpolator")',
+        '(FinalBSplineInterpolationOrder {})'.format(int(params.get('FinalBSplineInterpolationOrder', 3))),
+        '(Resampler "DefaultResampler")',
+        '(DefaultPixelValue {})'.format(fmt([params.get('DefaultPixelValue', 0)])),
+        '(ResultImageFormat "{}")'.format(params.get('ResultImageFormat', 'nrrd')),
+        f'(ResultImagePixelType "{elx_pixel_type}")',
+        '(CompressResultImage "false")'
+    ])
+
+    with open(out_path, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+
+
+def set_elastix_transform_grid(tp_file: Path, img_path: Path):
+    """
+    Set the output grid of an elastix transform parameter file to that of another image
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(img_path))
+    reader.ReadImageInformation()
+
+    dims = reader.GetDimension()
+    direction = np.array(reader.GetDirection()).reshape(dims, dims).T.ravel()  # elastix writes them column-wise
+
+    grid = {'Size': reader.GetSize(),
+            'Index': [0] * dims,
+            'Spacing': reader.GetSpacing(),
+            'Origin': reader.GetOrigin(),
+            'Direction': direction}
+
+    with open(tp_file, 'r') as fh:
+        lines = fh.readlines()
+
+    with open(tp_file, 'w') as fh:
+        for line in lines:
+            name = line.strip()[1:].split(' ')[0] if line.startswith('(') else None
+            if name in grid:
+                line = '({} {})\n'.format(name, ' '.join('{:.10g}'.format(x) for x in grid[name]))
+            fh.write(line)
+
+
+def run_transformix(args):
+    cmd = ['transformix',
+           '-in', args['mov'],
+           '-tp', args['tp'],
+           '-out', args['outdir'],
+           ]
+
+    if args.get('threads'):
+        cmd.extend(['-threads', str(args['threads'])])
+
+    try:
+        subprocess.check_output(cmd)
+    except Exception as e:  # can't seem to log CalledProcessError
+        logging.exception('transformix falied:\n\ncommand: {}\n\n error:{}'.format(cmd, e))
+        raise
+
+
 def run_elastix(args):
     cmd = ['elastix',
            '-f', args['fixed'],
@@ -244,6 +1059,9 @@ def run_elastix(args):
     if args.get('fixed_mask'):
         cmd.extend(['-fMask', args['fixed_mask']])
 
+    if args.get('initial_transform'):
+        cmd.extend(['-t0', args['initial_transform']])
+
     try:
         a = subprocess.check_output(cmd)
     except Exception as e:  # can't seem to log CalledProcessError
@@ -252,6 +1070,41 @@ def run_elastix(args):
         raise
 
 
+def registration_done(reg_outdir: Path, reg_key: str) -> bool:
+    """
+    Check whether a registration has finished with inputs that give reg_key
+
+    Parameters
+    ----------
+    reg_outdir
+        The specimen registration output folder
+    reg_key
+        The checksum of the current registration inputs. See ElastixRegistration.registration_key
+    """
+    done_file = reg_outdir / REG_DONE_FILE
+
+    if not done_file.is_file():
+        return False
+
+    with open(done_file, 'r') as fh:
+        done = yaml.safe_load(fh)
+
+    return done.get('key') == reg_key and (reg_outdir / done['output']).is_file()
+
+
+def write_registration_done(reg_outdir: Path, reg_key: str, output: Path):
+    """
+    Mark a registration as complete. The checksum of the registered image is stored so the stage average only needs
+    to be remade if an output has changed
+    """
+    done = {'key': reg_key,
+            'output': output.name,
+            'output_md5': file_md5(output)}
+
+    with open(reg_outdir / REG_DONE_FILE, 'w') as fh:
+        fh.write(yaml.dump(done, default_flow_style=False))
+
+
 def move_intemediate_volumes(reg_outdir: Path):
     """
     If using elastix multi-resolution registration and outputting image each resolution, put the intermediate files
@@ -19,7 +19,7 @@ from . import (ELX_TRANSFORM_PREFIX, ELX_PARAM_PREFIX, LABEL_INVERTED_TRANFORM,
 
 
 def batch_invert_transform_parameters(config: Union[str, LamaConfig],
-                                      clobber=True, new_log:bool=False):
+                                      clobber=True, new_log:bool=False, threads: int = None):
     """
     Create new elastix TransformParameter files that can then be used by transformix to invert labelmaps, stats etc
 
@@ -33,13 +33,16 @@ def batch_invert_transform_parameters(config: Union[str, LamaConfig],
 
     new_log:
         Whether to create a new log file. If called from another module, logging may happen there
+
+    threads
+        The number of threads elastix should use. If None, use config['threads']
     """
     common.test_installation('elastix')
 
     if isinstance(config, Path):
         config = LamaConfig(config)
 
-    threads = str(config['threads'])
+    threads = str(threads or config['threads'])
 
     if new_log:
         common.init_logging(config / 'invert_transforms.log')
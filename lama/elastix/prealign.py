@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Moment-based rigid pre-alignment
+
+Before the first registration stage, each moving image can be roughly aligned to the fixed image by matching the centres
+of mass and principal axes of the two images. This is written as an elastix EulerTransform parameter file that is used
+as the initial transform (-t0) for the first stage, so the first stage only has to refine the alignment.
+"""
+
+from itertools import product
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from logzero import logger as logging
+import numpy as np
+import SimpleITK as sitk
+
+from lama.elastix import ELX_TRANSFORM_PREFIX
+from lama.elastix.elastix_registration import write_elastix_transform
+
+PREALIGN_IMG_SIZE = 128  # Moments are calculated on images shrunk to about this size along their longest axis
+
+
+def prealign(fixed: Path, moving_imgs: List[Path], outdir: Path, fixed_mask: Path = None) -> Dict[str, Path]:
+    """
+    Make a rigid initial transform for each moving image
+
+    Parameters
+    ----------
+    fixed
+        The target of the first registration stage
+    moving_imgs
+        The images to align
+    outdir
+        The transform parameter files are written to outdir/specimen_id/
+    fixed_mask
+        If given, only the voxels of the fixed image within the mask are used for the fixed image moments
+
+    Returns
+    -------
+    specimen id: the path to its initial transform parameter file
+    """
+    fixed_img = sitk.ReadImage(str(fixed), sitk.sitkFloat32)
+    fixed_small = _shrink(fixed_img)
+
+    mask_small = None
+    if fixed_mask is not None:
+        mask_small = _shrink(sitk.ReadImage(str(fixed_mask), sitk.sitkFloat32)) > 0.5
+
+    fixed_com, fixed_axes = image_moments(fixed_small, mask_small)
+
+    initial_transforms = {}
+
+    for mov in moving_imgs:
+        moving_small = _shrink(sitk.ReadImage(str(mov), sitk.sitkFloat32))
+        mov_com, mov_axes = image_moments(moving_small)
+
+        transform, ncc = _best_rotation(fixed_small, moving_small, fixed_com, fixed_axes, mov_com, mov_axes)
+        logging.info(f'Pre-aligned {mov.stem}. Normalised cross correlation: {ncc:.3f}')
+
+        spec_dir = outdir / mov.stem
+        spec_dir.mkdir(parents=True, exist_ok=True)
+        tform_path = spec_dir / ELX_TRANSFORM_PREFIX
+        write_elastix_transform(tform_path, transform, fixed_img, {'Transform': 'EulerTransform'})
+        initial_transforms[mov.stem] = tform_path
+
+    return initial_transforms
+
+
+def image_moments(img: sitk.Image, mask: sitk.Image = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the intensity-weighted centre of mass and principal axes of an image in physical coordinates
+
+    Parameters
+    ----------
+    img
+        The image
+    mask
+        Only use voxels within this mask. If None, the foreground is found by Otsu thresholding
+
+    Returns
+    -------
+    The centre of mass
+    The principal axes as the columns of a rotation matrix (det = 1), largest first
+    """
+    if mask is None:
+        mask = sitk.OtsuThreshold(img, 0, 1)
+
+    arr = sitk.GetArrayFromImage(img).astype(np.float64)
+    weights = np.clip(arr - arr.min(), 0, None) * (sitk.GetArrayFromImage(mask) > 0)
+
+    idx = np.nonzero(weights)
+    w = weights[idx]
+
+    # Voxel indices (x, y, z) to physical points
+    index = np.stack(idx[::-1]).astype(np.float64)
+    direction = np.array(img.GetDirection()).reshape(3, 3)
+    points = np.array(img.GetOrigin())[:, None] + direction @ (np.array(img.GetSpacing())[:, None] * index)
+
+    com = (points * w).sum(axis=1) / w.sum()
+    centred = points - com[:, None]
+    cov = (centred * w) @ centred.T / w.sum()
+
+    _, axes = np.linalg.eigh(cov)
+    axes = axes[:, ::-1]  # Largest axis first
+
+    # Fix the sign of each axis with the third moment so it points the same way in similar images
+    skew = ((axes.T @ centred) ** 3 * w).sum(axis=1)
+    axes = axes * np.where(skew < 0, -1, 1)
+    if np.linalg.det(axes) < 0:
+        axes[:, 2] *= -1
+
+    return com, axes
+
+
+def _best_rotation(fixed: sitk.Image, moving: sitk.Image, fixed_com, fixed_axes, mov_com, mov_axes) \
+        -> Tuple[sitk.Euler3DTransform, float]:
+    """
+    The principal axes only determine the rotation up to a flip of two of the axes. Try each of the flips, and also no
+    rotation at all, and keep the one that gives the best correlation
+    """
+    flips = [np.diag(s) for s in product((1, -1), repeat=3) if np.prod(s) == 1]
+    candidates = [mov_axes @ flip @ fixed_axes.T for flip in flips] + [np.eye(3)]
+
+    best = None
+    for rotation in candidates:
+        # Make sure the matrix is orthonormal to within the tolerance of Euler3DTransform
+        u, _, vt = np.linalg.svd(rotation)
+        transform = sitk.Euler3DTransform()
+        transform.SetCenter(fixed_com.tolist())
+        transform.SetMatrix((u @ vt).ravel().tolist())
+        transform.SetTranslation((mov_com - fixed_com).tolist())
+
+        resampled = sitk.Resample(moving, fixed, transform, sitk.sitkLinear, 0.0)
+        ncc = _ncc(sitk.GetArrayFromImage(fixed), sitk.GetArrayFromImage(resampled))
+
+        if best is None or ncc > best[1]:
+            best = (transform, ncc)
+
+    return best
+
+
+def _ncc(a: np.ndarray, b: np.ndarray) -> float:
+    a = a.ravel() - a.mean()
+    b = b.ravel() - b.mean()
+    denom = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / denom) if denom else 0.0
+
+
+def _shrink(img: sitk.Image) -> sitk.Image:
+    factor = max(1, int(np.ceil(max(img.GetSize()) / PREALIGN_IMG_SIZE)))
+    return sitk.BinShrink(img, [factor] * img.GetDimension())
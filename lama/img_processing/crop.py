@@ -0,0 +1,130 @@
+"""
+Crop the target images to the bounding box of a mask to cut down the number of background voxels that registration,
+transform inversion and stats have to process.
+
+The crop box is written to the registration output folder so that results made in the cropped frame, such as stats
+heatmaps, can be put back into the original target frame.
+
+Only the target images (fixed volume, masks and label map) are cropped. The inputs are not cropped as they are not
+aligned to the target before registration.
+
+The crop box is stored in SimpleITK (x, y, z) index order:
+    start: the index of the first voxel in the box
+    size: the size of the box
+    original_size: the size of the uncropped image
+"""
+
+from pathlib import Path
+from typing import Dict, Union
+
+import numpy as np
+import SimpleITK as sitk
+import yaml
+
+from lama import common
+
+CROP_BOX_FILE = 'crop_box.yaml'
+
+
+def bounding_box(mask: np.ndarray, margin: int = 0) -> Dict:
+    """
+    Get the bounding box of the non-zero voxels in a mask, expanded by margin and clipped to the mask extent
+
+    Parameters
+    ----------
+    mask
+        3D (z, y, x) mask array
+    margin
+        The number of voxels to add to each side of the box
+
+    Returns
+    -------
+    The crop box
+    """
+    nonzero = np.nonzero(mask)
+    if len(nonzero[0]) == 0:
+        raise common.LamaDataException('Cannot make a crop box from an empty mask')
+
+    original_size = np.array(mask.shape[::-1])
+    start = np.array([axis.min() for axis in nonzero[::-1]]) - margin
+    stop = np.array([axis.max() for axis in nonzero[::-1]]) + 1 + margin
+
+    start = np.clip(start, 0, None)
+    stop = np.minimum(stop, original_size)
+
+    return {'start': start.tolist(),
+            'size': (stop - start).tolist(),
+            'original_size': original_size.tolist()}
+
+
+def crop_image(img: sitk.Image, box: Dict) -> sitk.Image:
+    """
+    Crop an image. The origin is shifted so the cropped image stays in the same physical location
+    """
+    return sitk.RegionOfInterest(img, [int(x) for x in box['size']], [int(x) for x in box['start']])
+
+
+def uncrop_image(img: sitk.Image, box: Dict) -> sitk.Image:
+    """
+    Zero-pad a cropped image back to the original size
+    """
+    lower = [int(x) for x in box['start']]
+    upper = [int(o - s - z) for o, s, z in zip(box['original_size'], box['start'], box['size'])]
+    return sitk.ConstantPad(img, lower, upper, 0)
+
+
+def crop_array(array: np.ndarray, box: Dict) -> np.ndarray:
+    """
+    Crop a (z, y, x) array
+    """
+    slices = tuple(slice(s, s + z) for s, z in zip(box['start'][::-1], box['size'][::-1]))
+    return array[slices]
+
+
+def uncrop_array(array: np.ndarray, box: Dict) -> np.ndarray:
+    """
+    Zero-pad a cropped (z, y, x) array back to the original size
+    """
+    full = np.zeros(box['original_size'][::-1], dtype=array.dtype)
+    slices = tuple(slice(s, s + z) for s, z in zip(box['start'][::-1], box['size'][::-1]))
+    full[slices] = array
+    return full
+
+
+def write_crop_box(path: Path, box: Dict):
+    with open(path, 'w') as fh:
+        fh.write(yaml.dump(box, default_flow_style=None))
+
+
+def read_crop_box(path: Path) -> Dict:
+    with open(path, 'r') as fh:
+        return yaml.safe_load(fh)
+
+
+def find_crop_box(root_dir: Path) -> Union[Dict, None]:
+    """
+    Find the crop box used when registering the specimens in a lama job runner output folder.
+
+    Parameters
+    ----------
+    root_dir
+        The folder containing the 'output' folder with line/specimen subfolders
+
+    Returns
+    -------
+    The crop box, or None if the registrations were not cropped
+
+    Raises
+    ------
+    LamaDataException if specimens were registered with different crop boxes
+    """
+    box = None
+
+    for box_file in (root_dir / 'output').glob(f'*/*/output/{CROP_BOX_FILE}'):
+        spec_box = read_crop_box(box_file)
+        if box is None:
+            box = spec_box
+        elif spec_box != box:
+            raise common.LamaDataException(f'{box_file} is different to other crop boxes. '
+                                           f'All specimens should be registered to the same cropped target')
+    return box
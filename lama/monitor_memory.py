@@ -51,3 +51,56 @@ class MonitorMemory(Thread):
 
     def stopped(self):
         return self.shutdown_flag.is_set()
+
+
+def process_tree_rss() -> int:
+    """
+    Get the RSS in bytes of this python process + all the child processes (R etc.)
+    """
+    current_process = psutil.Process(os.getpid())
+    rss = current_process.memory_info().rss
+
+    for child in current_process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+class PeakMemory(Thread):
+    """
+    Record the peak RSS of this python process + all the child processes while in a with block.
+    The RSS is sampled every `interval` seconds so very short spikes may be missed.
+
+    Usage
+    -----
+    with PeakMemory() as mem:
+        # do some work
+    mem.increase  # The peak RSS in bytes over the RSS at the start
+
+    """
+    def __init__(self, interval: float = 0.05):
+        super(PeakMemory, self).__init__(daemon=True)
+        self.interval = interval
+        self.shutdown_flag = Event()
+        self.start_rss = 0
+        self.peak = 0
+
+    def __enter__(self):
+        self.start_rss = self.peak = process_tree_rss()
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown_flag.set()
+        self.join()
+        self.peak = max(self.peak, process_tree_rss())
+
+    @property
+    def increase(self) -> int:
+        return self.peak - self.start_rss
+
+    def run(self):
+        while not self.shutdown_flag.wait(self.interval):
+            self.peak = max(self.peak, process_tree_rss())
@@ -29,7 +29,7 @@ import logzero
 import SimpleITK as sitk
 
 
-def make_avg(root_dir: Path,  out_path: Path, log_path):
+def make_avg(root_dir: Path,  out_path: Path, log_path, method: str = 'mean'):
 
     paths = []
     for spec_dir in root_dir.iterdir():
@@ -37,7 +37,7 @@ def make_avg(root_dir: Path,  out_path: Path, log_path):
             continue
         paths.append(spec_dir / f'{spec_dir.name}.nrrd')
 
-    avg = common.average(paths)
+    avg = common.average(paths, method=method)
     logzero.logfile(log_path)
     logging.info(f'\nCreating average from:\n')
     logging.info('\n'.join([str(x) for x in paths]))
@@ -131,7 +131,8 @@ def grid_runner(config_path: Path) -> Path:
                                 continue
                             else:
                                 average_path = avg_dir / f'{stage_id}.nrrd'
-                                make_avg(stage_dir, average_path, avg_dir / f'{stage_id}.log')
+                                make_avg(stage_dir, average_path, avg_dir / f'{stage_id}.log',
+                                         method=config['average_method'])
                                 open(average_done, 'x').close()
                                 print('making average')
                                 break
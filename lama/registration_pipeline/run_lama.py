@@ -33,9 +33,17 @@ Config file
     pad_dims: true # Pads all the volumes so all are the same dimensions. Finds the largest dimension from each volume
     pad_dims: [300, 255, 225]  # this specifies the dimensions tyo pad to
     threads: 10  # number of cpu cores to use
+    registration_workers: 4  # number of elastix processes to run at once. threads are split between them.
+    post_reg_workers: 2  # number of post-registration steps (inversion, jacobians etc.) to run at once. threads are split between them
     filetype: nrrd  # the output file format - nrrd, nii, tiff
     compress_averages: true  # compress the averages to save disk space
     generate_new_target_each_stage: true  # true for creating an average. false for phenotype detection
+    resume_registration: true  # Do not redo registrations that have been completed in a previous run with the same inputs
+    average_method: mean  # how to make the stage averages. mean, trimmed_mean or median
+    pairwise_neighbours: 10  # If doing pairwise registration, only register each specimen to its 10 most similar specimens
+    prealign: true  # Roughly align the inputs to the fixed volume using image moments before the first stage
+    crop_to_mask: true  # Crop the target images to the bounding box of the fixed_mask (or stats_mask) before registration
+    crop_margin: 10  # Number of voxels to leave around the mask when cropping
     
     staging entry. this allows for the automatoc determination of stage using various surrogates
     staging: scaling_factor
@@ -86,6 +94,10 @@ Then we specify a registration stage like this
       do_analysis: true
       normalise_registered_output: [[200, 240, 230], [210, 250, 240]]
 
+    - stage_id: affine
+      backend: simpleitk
+      downsample: 2
+
 inherit_elx_params: This takes the elastix paramteters from the named stage. Any elastix parameters specified
 after this will overide the inherited parameters
 
@@ -95,6 +107,13 @@ normalise_registered_output: in order to do intensity-based analsysis on the reg
 normalised first. The format [[start indices, [end indices]] specifies an ROI from an area of background in the
 target. This average of this region in the outputs will be used as as the new zero value for the image
 
+backend: elastix (default) or simpleitk. Rigid, similarity and affine target-based stages can be run in-process with
+SimpleITK, which avoids starting an elastix process for each specimen. The settings are taken from the stage's elastix
+parameters and elastix-compatible transform parameter files are written
+
+downsample: register a rigid, similarity or affine target-based stage using copies of the images downsampled by this
+factor. The transforms are applied to the full resolution images so the stage outputs are full resolution
+
 
 """
 from lama import common
@@ -116,9 +135,13 @@ from lama.elastix.invert_transforms import batch_invert_transform_parameters
 from lama.img_processing.organ_vol_calculation import label_sizes
 from lama.img_processing import glcm3d
 from lama.registration_pipeline.validate_config import LamaConfig, LamaConfigError
+from lama.registration_pipeline.task_graph import TaskGraph
 from lama.elastix.deformations import make_deformations_at_different_scales
 from lama.qc.metric_charts import make_charts
-from lama.elastix.elastix_registration import TargetBasedRegistration, PairwiseBasedRegistration
+from lama.elastix.elastix_registration import (TargetBasedRegistration, PairwiseBasedRegistration,
+                                               SimpleITKTargetBasedRegistration)
+from lama.elastix.prealign import prealign
+from lama.img_processing.crop import bounding_box, crop_image, write_crop_box, CROP_BOX_FILE
 from lama.staging import staging_metric_maker
 from lama.qc.qc_images import make_qc_images
 from lama.stats.standard_stats.data_loaders import DEFAULT_FWHM, DEFAULT_VOXEL_SIZE
@@ -128,6 +151,7 @@ from lama.common import cfg_load
 
 LOG_FILE = 'LAMA.log'
 ELX_PARAM_PREFIX = 'elastix_params_'               # Prefix the generated elastix parameter files
+AVERAGE_DONE_SUFFIX = '_average_done.yaml'         # Records the inputs to a stage average
 PAD_INFO_FILE = 'pad_info.yaml'
 
 
@@ -158,10 +182,13 @@ def run(configfile: Path):
         except Exception as e:
             raise(LamaConfigError(e))
 
-        config.mkdir('output_dir')
+        # If resuming a previous run, keep the completed registrations and averages
+        clobber = not config['resume_registration']
+
+        config.mkdir('output_dir', clobber=clobber)
         qc_dir = config.mkdir('qc_dir')
-        config.mkdir('average_folder')
-        config.mkdir('root_reg_dir')
+        config.mkdir('average_folder', clobber=clobber)
+        config.mkdir('root_reg_dir', clobber=clobber)
 
         # TODO find the histogram batch code
         # if not config['no_qc']:
@@ -187,42 +214,42 @@ def run(configfile: Path):
 
         logging.info("Registration started")
 
+        if config['crop_to_mask']:
+            crop_target(config)
+
         final_registration_dir = run_registration_schedule(config)
 
-        make_deformations_at_different_scales(config)
+        # The steps after registration. Each starts once the steps it depends on have finished, and independent
+        # steps can run at the same time
+        post_reg = TaskGraph()
+
+        # Keep to the thread budget when several elastix/transformix steps run at once
+        post_reg_workers = max(1, config['post_reg_workers'])
+        step_threads = max(1, config['threads'] // post_reg_workers)
 
-        create_glcms(config, final_registration_dir)
+        post_reg.add('deformations', make_deformations_at_different_scales, config, step_threads)
+        post_reg.add('glcms', create_glcms, config, final_registration_dir)
+        post_reg.add('reg_dir_order', write_reg_dir_order, config)
 
+        inversion_steps = []
         if config['skip_transform_inversion']:
             logging.info('Skipping inversion of transforms')
         else:
-            logging.info('inverting transforms')
-            batch_invert_transform_parameters(config)
-
-            logging.info('inverting volumes')
-            invert_volumes(config)
+            post_reg.add('invert_transforms', batch_invert_transform_parameters, config, True, False, step_threads)
+            post_reg.add('invert_volumes', invert_volumes, config, step_threads, deps=['invert_transforms'])
+            inversion_steps = ['invert_volumes']
 
             if config['label_map']:
+                post_reg.add('organ_volumes', generate_organ_volumes, config, deps=inversion_steps)
 
-                generate_organ_volumes(config)
-
-        if not generate_staging_data(config):
-            logging.warning('No staging data generated')
-
-        # Write out the names of the registration dirs in the order they were run
-        with open(config['root_reg_dir'] / REG_DIR_ORDER, 'w') as fh:
-            for reg_stage in config['registration_stage_params']:
-                fh.write(f'{reg_stage["stage_id"]}\n')
+        # Embryo volume staging uses the inverted stats masks
+        post_reg.add('staging', run_staging, config, deps=inversion_steps)
 
         if not no_qc:
-            if config['skip_transform_inversion']:
-                inverted_label_overlay_dir = None
-            else:
-                inverted_label_overlay_dir = config.mkdir('inverted_label_overlay_dir')
+            # The QC images use the registration order and the inverted labels
+            post_reg.add('qc_images', run_qc, config, qc_dir, deps=['reg_dir_order'] + inversion_steps)
 
-            # registered_midslice_dir = config.mkdir('registered_midslice_dir')
-
-            make_qc_images(config.config_dir, config['fixed_volume'], qc_dir)
+        post_reg.run(workers=post_reg_workers)
 
         mem_monitor.stop()
 
@@ -231,6 +258,60 @@ def run(configfile: Path):
         return True
 
 
+def crop_target(config: LamaConfig):
+    """
+    Crop the fixed volume, masks and label map to the bounding box of the fixed mask (or stats mask if there is no
+    fixed mask) plus a margin. The cropped images replace the originals in the config so all the following steps work
+    on the smaller images. The crop box is written to the output folder so results can be put back into the
+    original target frame.
+
+    Only the target images are cropped. The inputs are not aligned to the target yet, so the target's box can't be
+    applied to them. The registered outputs are resampled onto the cropped fixed grid anyway, and inverted
+    labels/masks are made in each input's own, uncropped frame.
+    """
+    box_mask = config['fixed_mask'] or config['stats_mask']
+    if not box_mask:
+        raise LamaConfigError('crop_to_mask needs either a fixed_mask or a stats_mask')
+
+    box = bounding_box(common.img_path_to_array(box_mask), config['crop_margin'])
+    logging.info(f"Cropping the target images to {box['size']} from {box['original_size']}")
+
+    cropped_dir = config.mkdir('cropped_target_dir')
+
+    for name in ('fixed_volume', 'fixed_mask', 'stats_mask', 'label_map'):
+        path = config[name]
+        if not path:
+            continue
+        cropped_path = cropped_dir / Path(path).name
+        sitk.WriteImage(crop_image(sitk.ReadImage(str(path)), box), str(cropped_path), True)
+        config.options[name] = cropped_path
+
+    write_crop_box(config['output_dir'] / CROP_BOX_FILE, box)
+
+
+def write_reg_dir_order(config: LamaConfig):
+    """
+    Write out the names of the registration dirs in the order they were run
+    """
+    with open(config['root_reg_dir'] / REG_DIR_ORDER, 'w') as fh:
+        for reg_stage in config['registration_stage_params']:
+            fh.write(f'{reg_stage["stage_id"]}\n')
+
+
+def run_staging(config: LamaConfig):
+    if not generate_staging_data(config):
+        logging.warning('No staging data generated')
+
+
+def run_qc(config: LamaConfig, qc_dir: Path):
+    if not config['skip_transform_inversion']:
+        config.mkdir('inverted_label_overlay_dir')
+
+    # registered_midslice_dir = config.mkdir('registered_midslice_dir')
+
+    make_qc_images(config.config_dir, config['fixed_volume'], qc_dir)
+
+
 def generate_staging_data(config: LamaConfig):
     """
     Generate staging data from the registration results
@@ -282,11 +363,16 @@ def get_affine_or_similarity_stage_dir(config: LamaConfig) -> Path:
             return reg_dir
 
 
-def invert_volumes(config: LamaConfig):
+def invert_volumes(config: LamaConfig, threads: int = None):
     """
     Invert volumes, such as masks and labelmaps from population average space to input volumes space using
     pre-calculated elastix inverse transform parameter files
 
+    Parameters
+    ----------
+    threads
+        The number of threads transformix should use. If None, use config['threads']
+
     Returns
     -------
     Status of inverions for masks and labels
@@ -294,14 +380,15 @@ def invert_volumes(config: LamaConfig):
     """
 
     invert_config = config['inverted_transforms'] / INVERT_CONFIG
+    threads = threads or config['threads']
 
     if config['stats_mask']:
         mask_inversion_dir = config.mkdir('inverted_stats_masks')
-        InvertLabelMap(invert_config, config['stats_mask'], mask_inversion_dir, threads=config['threads']).run()
+        InvertLabelMap(invert_config, config['stats_mask'], mask_inversion_dir, threads=threads).run()
 
     if config['label_map']:
         labels_inverion_dir = config.mkdir('inverted_labels')
-        InvertLabelMap(invert_config, config['label_map'], labels_inverion_dir, threads=config['threads']).run()
+        InvertLabelMap(invert_config, config['label_map'], labels_inverion_dir, threads=threads).run()
 
 
 def generate_organ_volumes(config: LamaConfig):
@@ -371,6 +458,16 @@ def run_registration_schedule(config: LamaConfig) -> Path:
     # Set the fixed volume up for the first stage. This will checnge each stage if doing population average
     fixed_vol = config['fixed_volume']
 
+    initial_transforms = {}
+    if config['prealign']:
+        logging.info('Pre-aligning the inputs using image moments')
+        if os.path.isdir(moving_vols_dir):
+            prealign_inputs = common.get_file_paths(moving_vols_dir)
+        else:
+            prealign_inputs = [moving_vols_dir]
+        prealign_dir = config.mkdir('prealign_dir')
+        initial_transforms = prealign(fixed_vol, prealign_inputs, prealign_dir, config['fixed_mask'])
+
     for i, reg_stage in enumerate(config['registration_stage_params']):
 
         tform_type = reg_stage['elastix_parameters']['Transform']
@@ -390,11 +487,23 @@ def run_registration_schedule(config: LamaConfig) -> Path:
             logging.info('using target-based registration')
             reg_method = TargetBasedRegistration
 
+        if reg_stage.get('backend') == 'simpleitk':
+            if reg_method is TargetBasedRegistration:
+                logging.info('using the in-process SimpleITK registration backend')
+                reg_method = SimpleITKTargetBasedRegistration
+            else:
+                logging.warning('The SimpleITK backend is only available for target-based stages. Using elastix')
+
         #  Make the stage output dir
         stage_id = reg_stage['stage_id']
         stage_dir = config.stage_dirs[stage_id]
 
-        common.mkdir_force(stage_dir)
+        resume = config['resume_registration']
+
+        if resume:
+            stage_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            common.mkdir_force(stage_dir)
 
         logging.info("### Current registration step: {} ###".format(stage_id))
 
@@ -421,17 +530,44 @@ def run_registration_schedule(config: LamaConfig) -> Path:
                                  stage_dir,
                                  config['filetype'],
                                  config['threads'],
-                                 fixed_mask
+                                 fixed_mask,
+                                 config['registration_workers'],
+                                 resume
                                  )
 
         if (not config['pairwise_registration']) or (config['pairwise_registration'] and euler_stage):
             registrator.set_target(fixed_vol)
+        elif config['pairwise_neighbours']:
+            registrator.set_num_neighbours(config['pairwise_neighbours'])
+
+        if i == 0:
+            registrator.set_initial_transforms(initial_transforms)
+
+        downsample = reg_stage.get('downsample', 1)
+        if downsample > 1:
+            if isinstance(registrator, TargetBasedRegistration):
+                registrator.set_downsample(downsample, config.mkdir('downsample_cache_dir', clobber=False))
+            else:
+                logging.warning('Downsampling is only available for target-based stages. Using full resolution')
 
         registrator.run()  # Do the registrations for a single stage
 
         # Make average from the stage outputs
         average_path = join(config['average_folder'], '{0}.{1}'.format(stage_id, config['filetype']))
-        registrator.make_average(average_path)
+        average_done_path = config['average_folder'] / f'{stage_id}{AVERAGE_DONE_SUFFIX}'
+
+        # The inputs to the average. None if it can't be determined, in which case the average is always remade
+        outputs_checksum = registrator.outputs_checksum()
+        average_key = {'outputs': outputs_checksum, 'method': config['average_method']}
+
+        if resume and outputs_checksum and average_done(average_path, average_done_path, average_key):
+            logging.info(f'Skipping {stage_id} average. The registered volumes are unchanged')
+        else:
+            registrator.make_average(average_path, method=config['average_method'])
+
+            if outputs_checksum:
+                with open(average_done_path, 'w') as fh:
+                    fh.write(yaml.dump(average_key, default_flow_style=False))
 
         if not config['no_qc']:
 
@@ -451,6 +587,17 @@ def run_registration_schedule(config: LamaConfig) -> Path:
     return stage_dir
 
 
+def average_done(average_path: Path, average_done_path: Path, average_key: dict) -> bool:
+    """
+    Check whether a stage average exists and was made from the same registered volumes with the same method
+    """
+    if not os.path.isfile(average_path) or not average_done_path.is_file():
+        return False
+
+    with open(average_done_path, 'r') as fh:
+        return yaml.safe_load(fh) == average_key
+
+
 def create_glcms(config: LamaConfig, final_reg_dir):
     """
     Create grey level co-occurence matrices. This is done in the main registration pipeline as we don't
@@ -0,0 +1,98 @@
+"""
+A small executor for pipeline steps that depend on each other.
+
+Steps are added with the names of the steps they depend on. When run, each step starts as soon as all of its
+dependencies have finished, with up to `workers` steps running at once.
+
+Example
+-------
+graph = TaskGraph()
+graph.add('invert_transforms', batch_invert_transform_parameters, config)
+graph.add('invert_volumes', invert_volumes, config, deps=['invert_transforms'])
+graph.run(workers=2)
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Dict, Any
+
+from logzero import logger as logging
+
+
+class TaskGraph:
+    def __init__(self):
+        self.tasks = OrderedDict()  # name: (func, args, deps)
+
+    def add(self, name: str, func: Callable, *args, deps: Iterable[str] = ()):
+        """
+        Add a step to the graph. Dependencies must already have been added, so the graph can't contain cycles
+
+        Parameters
+        ----------
+        name
+            A unique name for the step
+        func
+            The function to run
+        args
+            Arguments to pass to func
+        deps
+            The names of the steps that must finish before this one starts
+        """
+        if name in self.tasks:
+            raise ValueError(f'Task {name} has already been added')
+
+        missing = [d for d in deps if d not in self.tasks]
+        if missing:
+            raise ValueError(f'Task {name} depends on tasks that have not been added: {missing}')
+
+        self.tasks[name] = (func, args, list(deps))
+
+    def run(self, workers: int = 1) -> Dict[str, Any]:
+        """
+        Run the steps. Ready steps are started in the order they were added, so with one worker the steps run in
+        the order they were added.
+
+        If a step raises, no more steps are started. The running steps are allowed to finish and then the exception
+        is raised
+
+        Returns
+        -------
+        step name: the value returned by the step
+        """
+        workers = max(1, workers)
+        results = {}
+        pending = OrderedDict(self.tasks)
+        error = None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+
+            while (pending and error is None) or in_flight:
+
+                if error is None:
+                    ready = [name for name, (_, _, deps) in pending.items() if all(d in results for d in deps)]
+
+                    for name in ready:
+                        if len(in_flight) >= workers:
+                            break
+                        func, args, _ = pending.pop(name)
+                        logging.info(f'Starting {name}')
+                        in_flight[executor.submit(func, *args)] = name
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    name = in_flight.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logging.error(f'{name} failed')
+                        if error is None:
+                            error = e
+                    else:
+                        logging.info(f'Finished {name}')
+
+        if error is not None:
+            raise error
+
+        return results
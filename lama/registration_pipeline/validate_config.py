@@ -11,6 +11,7 @@ import numpy as np
 import toml
 
 from lama import common
+from lama.elastix.elastix_registration import REGISTRATION_BACKENDS, SITK_TRANSFORMS, SITK_OPTIMIZERS
 from lama.staging.staging_metric_maker import STAGING_METHODS, DEFAULT_STAGING_METHOD
 
 
@@ -64,6 +65,9 @@ class LamaConfig:
             'jacmat': 'jacobian_matrices',
             'glcm_dir': 'glcms',
             'root_reg_dir': 'registrations',
+            'prealign_dir': 'prealignment',
+            'cropped_target_dir': 'cropped_target',
+            'downsample_cache_dir': 'downsampled',
             'inverted_transforms': 'inverted_transforms',
             'inverted_labels': 'inverted_labels',
             'inverted_stats_masks': 'inverted_stats_masks',
@@ -87,11 +91,19 @@ class LamaConfig:
             'registration_stage_params': ('dict', 'required'),
             'no_qc': ('bool', False),
             'threads': ('int', 4),
+            'registration_workers': ('int', 1),
+            'post_reg_workers': ('int', 1),
             'filetype': ('func', self.validate_filetype),
             'voxel_size': ('float', 14.0),
             'generate_new_target_each_stage': ('bool', False),
+            'average_method': (list(common.AVERAGE_METHODS), 'mean'),
             'skip_transform_inversion': ('bool', False),
+            'resume_registration': ('bool', False),
             'pairwise_registration': ('bool', False),
+            'pairwise_neighbours': ('int', 0),
+            'prealign': ('bool', False),
+            'crop_to_mask': ('bool', False),
+            'crop_margin': ('int', 10),
             'generate_deformation_fields': ('dict', None),
             'skip_deformation_fields': ('bool', True),
             'staging': ('func', self.validate_staging),
@@ -311,6 +323,41 @@ class LamaConfig:
                     logging.error("Could not find the registration stage to inherit from '{}'".format(inherit_id))
                     raise LamaConfigError()
 
+            downsample = stage.get('downsample', 1)
+            if not isinstance(downsample, int) or downsample < 1:
+                logging.error("Stage 'downsample' should be a whole number of 1 or more")
+                raise LamaConfigError()
+
+            backend = stage.get('backend', 'elastix')
+            if backend not in REGISTRATION_BACKENDS:
+                logging.error("Registration backend should be one of {}".format(', '.join(REGISTRATION_BACKENDS)))
+                raise LamaConfigError()
+
+            tform = stage['elastix_parameters'].get('Transform')
+            if not tform and inherit_id:
+                tform = next(s for s in stages if s.get('stage_id') == inherit_id)['elastix_parameters'].get('Transform')
+
+            if backend == 'simpleitk' and tform not in SITK_TRANSFORMS:
+                logging.error("The simpleitk backend can only be used for stages with transforms: {}".format(
+                    ', '.join(SITK_TRANSFORMS)))
+                raise LamaConfigError()
+
+            if backend == 'simpleitk':
+                optimizer = stage['elastix_parameters'].get('Optimizer')
+                if not optimizer and inherit_id:
+                    optimizer = next(s for s in stages if s.get('stage_id') == inherit_id)['elastix_parameters'].get('Optimizer')
+                if not optimizer:
+                    optimizer = config.get('global_elastix_params', {}).get('Optimizer', 'AdaptiveStochasticGradientDescent')
+                if optimizer not in SITK_OPTIMIZERS:
+                    logging.error("The simpleitk backend can only be used with the optimizers: {}".format(
+                        ', '.join(SITK_OPTIMIZERS)))
+                    raise LamaConfigError()
+
+            if downsample > 1 and tform not in SITK_TRANSFORMS:
+                logging.error("'downsample' can only be used for stages with transforms: {}".format(
+                    ', '.join(SITK_TRANSFORMS)))
+                raise LamaConfigError()
+
     def check_images(self):
         """
         validate that image paths are correct and give loadeable volumes
@@ -29,11 +29,16 @@ def main():
                         required=False, default=1000)
     parser.add_argument('-norm', '--normalise', dest='norm', help='normalise organ volume to whole embryo volume',
                         required=False, default=False, action='store_true')
+    parser.add_argument('--workers', dest='workers', help='number of processes to fit the permutations with',
+                        type=int, required=False, default=1)
+    parser.add_argument('--null_cache', dest='null_cache', help='folder to cache null distributions in so they can be '
+                        'reused by other runs with the same baselines. Defaults to <out_dir>/distributions/null_cache',
+                        type=Path, required=False, default=None)
 
     args = parser.parse_args()
 
     run(args.wt_dir, args.mut_dir, args.out_dir, args.num_perm,
-        label_info=args.label_info, label_map_path=args.label_map, normalise_to_whole_embryo=args.norm)
+        label_info=args.label_info, label_map_path=args.label_map, normalise_to_whole_embryo=args.norm, workers=args.workers, null_cache_dir=args.null_cache)
 
 
 if __name__ == '__main__':
@@ -4,28 +4,51 @@ The code to run linear models in R.
 The current interface to R is to write binary files that R can read (numpy_to_dat). The reason r2py wasn't used is that
 it used to be a pain to install. I imagine it's better now and using docker should improve things so adding
 rp2y interface is on the todo list
+
+To avoid starting R for every call, lm_r sends the jobs to a long-running R process (RWorker, lm_worker.R) that is
+started on first use and restarted if it dies. The exchange files are put in shared memory (/dev/shm) if available.
+
+lm_numpy fits the same models in-process with NumPy and gives the same output as lm_r, so R is not needed.
+lm_permutations fits the model for many relabellings of the same specimens at once for the permutation stats.
+
+BaselineStats holds the baseline sums needed to finish each line's model from just its mutants.
 """
 
 
 import subprocess as sub
 import os
-import struct
+import atexit
+import selectors
+import threading
 from pathlib import Path
 import tempfile
-from typing import Tuple
+from typing import Tuple, List, Sequence, Union
 from logzero import logger as logging
 
 import numpy as np
 import pandas as pd
+from scipy import stats
 
 
 from lama import common
 
 LM_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'lmFast.R')
+LM_WORKER_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'lm_worker.R')
+
+# Use a persistent R process for lm_r. If False, start Rscript for every call
+USE_R_WORKER = True
+R_WORKER_TIMEOUT = 60  # Seconds to wait for the R worker to start or to reply to a health check
+
+# Memory-backed temp dir for exchanging data with R
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
 
 # If debugging, don't delete the temp files used for communication with R so they can be used for R debugging.
 DEBUGGING = False
 
+GENOTYPE_COL = 1  # The column of the design matrix with the genotype effect. 0 is the intercept
+LM_BLOCK_SIZE = 2 ** 16  # Number of voxels/labels to get residuals for at once in lm_numpy
+PERM_BLOCK_SIZE = 4096  # Number of relabellings to fit at once in lm_permutations
+
 
 def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=False, use_staging: bool=True) -> Tuple[np.ndarray, np.ndarray]:
     """
@@ -57,10 +80,10 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
     if np.any(np.isnan(data)):
         raise ValueError('Data passed to linear_model.py has NAN values')
 
-    input_binary_file = tempfile.NamedTemporaryFile().name
-    line_level_pval_out_file = tempfile.NamedTemporaryFile().name
-    line_level_tstat_out_file = tempfile.NamedTemporaryFile().name
-    groups_file = tempfile.NamedTemporaryFile().name
+    input_binary_file = tempfile.NamedTemporaryFile(dir=SHM_DIR).name
+    line_level_pval_out_file = tempfile.NamedTemporaryFile(dir=SHM_DIR).name
+    line_level_tstat_out_file = tempfile.NamedTemporaryFile(dir=SHM_DIR).name
+    groups_file = tempfile.NamedTemporaryFile(dir=SHM_DIR).name
 
     # create groups file
     if use_staging:
@@ -76,24 +99,27 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
 
     _numpy_to_dat(data, input_binary_file)
 
-    cmd = ['Rscript',
-           LM_SCRIPT,
-           input_binary_file,
-           groups_file,
-           line_level_pval_out_file,
-           line_level_tstat_out_file,
-           formula,
-           str(boxcox).upper(),  # bool to string for R
-           ''  # No plots needed for permutation testing
-           ]
-    # logging.info(f"LM command to Rscript {cmd}")
+    lm_args = [input_binary_file,
+               groups_file,
+               line_level_pval_out_file,
+               line_level_tstat_out_file,
+               formula,
+               str(boxcox).upper(),  # bool to string for R
+               ''  # No plots needed for permutation testing
+               ]
 
-    try:
-        sub.check_output(cmd)
-    except sub.CalledProcessError as e:
-        msg = "R linear model failed: {}".format(e)
-        logging.exception(msg)
-        raise RuntimeError(msg)
+    if USE_R_WORKER:
+        get_r_worker().run(lm_args)
+    else:
+        cmd = ['Rscript', LM_SCRIPT] + lm_args
+        # logging.info(f"LM command to Rscript {cmd}")
+
+        try:
+            sub.check_output(cmd)
+        except sub.CalledProcessError as e:
+            msg = "R linear model failed: {}".format(e)
+            logging.exception(msg)
+            raise RuntimeError(msg)
 
     # Read in the pvalue and t-statistic results.
     # The start of the binary file will contain values from the line level call
@@ -126,14 +152,512 @@ def _numpy_to_dat(mat: np.ndarray, outfile: str):
 
 
     """
-    # mat = mat.as_matrix()
     # create a binary file
     with open(outfile, 'wb') as binfile:
-    # and write out two integers with the row and column dimension
-
-        header = struct.pack('2I', mat.shape[0], mat.shape[1])
-        binfile.write(header)
-        # then loop over columns and write each
-        for i in range(mat.shape[1]):
-            data = struct.pack('%id' % mat.shape[0], *mat[:, i])
-            binfile.write(data)
\ No newline at end of file
+        # write out two integers with the row and column dimension
+        np.array(mat.shape[:2], dtype=np.uint32).tofile(binfile)
+        # then the data as doubles, column by column (R matrices are column-major)
+        np.asarray(mat, dtype=np.float64).T.tofile(binfile)
+
+
+class RWorker:
+    """
+    A long-running R process (lm_worker.R) that runs lmFast.R jobs, so R and its libraries are only loaded once.
+
+    If the process dies it is restarted, and a job that was running when it died is tried once more.
+    """
+    def __init__(self):
+        self.proc = None
+        self._selector = None
+        self._buffer = b''  # Output read from the worker that has not been used yet
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.stop()
+        logging.info('Starting R linear model worker')
+        self.proc = sub.Popen(['Rscript', LM_WORKER_SCRIPT, LM_SCRIPT], stdin=sub.PIPE, stdout=sub.PIPE, bufsize=0)
+        self._buffer = b''
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.proc.stdout, selectors.EVENT_READ)
+
+        if self._reply(R_WORKER_TIMEOUT) != 'ready':
+            self.stop()
+            raise RuntimeError('R linear model worker failed to start')
+
+    def stop(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                try:
+                    self._send('quit')
+                    self.proc.wait(timeout=5)
+                except (OSError, sub.TimeoutExpired):
+                    self.proc.kill()
+            self._selector.close()
+        self.proc = None
+
+    def healthy(self) -> bool:
+        """
+        Check that the worker is running and responding
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            return False
+        try:
+            self._send('ping')
+            return self._reply(R_WORKER_TIMEOUT) == 'pong'
+        except (OSError, RuntimeError):
+            return False
+
+    def run(self, lm_args: List[str]):
+        """
+        Run lmFast.R with the given arguments
+
+        Raises
+        ------
+        RuntimeError if the linear model fails
+        """
+        with self._lock:
+            for attempt in range(2):
+                if not self.healthy():
+                    self.start()
+                try:
+                    self._send('\t'.join(lm_args))
+                    reply = self._reply(timeout=None)
+                except (OSError, RuntimeError) as e:
+                    # The worker died. Restart it and try once more
+                    logging.warning(f'R linear model worker stopped unexpectedly: {e}')
+                    self.stop()
+                    continue
+
+                if reply != 'ok':
+                    msg = "R linear model failed: {}".format(reply)
+                    logging.error(msg)
+                    raise RuntimeError(msg)
+                return
+
+            raise RuntimeError('R linear model worker keeps failing')
+
+    def _send(self, line: str):
+        self.proc.stdin.write((line + '\n').encode())
+        self.proc.stdin.flush()
+
+    def _reply(self, timeout=None) -> str:
+        """
+        Get the next reply from the worker. Other output from R is logged.
+        The pipe is read directly rather than with readline so that select never waits on data that is already buffered
+        """
+        while True:
+            while b'\n' not in self._buffer:
+                if not self._selector.select(timeout):
+                    raise RuntimeError('Timed out waiting for the R linear model worker')
+                chunk = os.read(self.proc.stdout.fileno(), 65536)
+                if not chunk:
+                    raise RuntimeError('R linear model worker has exited')
+                self._buffer += chunk
+
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            line = line.decode(errors='replace')
+            if line.startswith('@@'):
+                return line[2:]
+            logging.info(f'R: {line}')
+
+
+_r_workers = {}  # process id: RWorker. A forked child must not use its parent's worker
+_r_workers_lock = threading.Lock()
+
+
+def get_r_worker() -> RWorker:
+    """
+    Get the R worker for this process. It is started on first use and stopped on exit
+    """
+    pid = os.getpid()
+    with _r_workers_lock:
+        if pid not in _r_workers:
+            _r_workers[pid] = RWorker()
+            atexit.register(_r_workers[pid].stop)
+        return _r_workers[pid]
+
+
+def lm_numpy(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bool = False,
+             use_staging: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit the same linear models as lm_r (lmFast.R) without R, and return the results in the same layout.
+
+    The data ~ genotype (+ staging) model is fitted for all voxels or labels at once, using a single QR decomposition of
+    the design matrix. Then a model is fitted for each mutant specimen using the wildtypes and that specimen. These are
+    found for all the mutants at once from the wildtype-only fit (BaselineStats.fit_specimens).
+
+    Parameters
+    ----------
+    data
+        columns: data points
+        rows: specimens
+        float32 data is processed in float32 to save memory
+    info
+        columns:
+            genotype, staging, line
+        rows:
+            specimens
+    plot_dir
+        Not used. For compatibility with lm_r
+    boxcox
+        Not supported (it is not implemented in lmFast.R either)
+    use_staging
+        if true, uae staging as a fixed effect in the linear model
+
+    Returns
+    -------
+    pvalues for each label or voxel, followed by the specimen-level pvalues for each mutant
+    t-statistics for each label or voxel, followed by the specimen-level t-statistics for each mutant
+    """
+    if np.any(np.isnan(data)):
+        raise ValueError('Data passed to linear_model.py has NAN values')
+
+    if boxcox:
+        raise ValueError('boxcox is not supported')
+
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    y = np.abs(data).astype(dtype, copy=False)  # lmFast.R uses the absolute values
+
+    # As in R, the genotype coefficient is for the second genotype in sorted order compared to the first
+    genotype = info['genotype'].values
+    levels = sorted(set(genotype))
+    if len(levels) != 2:
+        raise ValueError(f'The linear model needs two genotypes. Got {levels}')
+
+    design = [np.ones(len(genotype)), (genotype == levels[1]).astype(np.float64)]
+    if use_staging:
+        design.append(info['staging'].values.astype(np.float64))
+    design = np.column_stack(design)
+
+    p_line, t_line = _ols_genotype_effect(design, y)
+    p_all = [p_line]
+    t_all = [t_line]
+
+    # Fit each mutant specimen along with all the wildtypes. These are all updates of the wildtype-only fit
+    wt_rows = np.flatnonzero(genotype == 'wildtype')
+    mut_rows = np.flatnonzero(genotype == 'mutant')
+
+    if len(mut_rows):
+        staging = info['staging'].values if use_staging else np.zeros(len(genotype))
+        baseline = BaselineStats(y[wt_rows], staging[wt_rows])
+        p_spec, t_spec = baseline.fit_specimens(y[mut_rows], staging[mut_rows], use_staging=use_staging)
+
+        # These are the mutant effects already, so flip them to match the sign of the line-level wildtype effect
+        p_all.extend(p_spec)
+        t_all.extend(0 - t_spec)
+
+    # As in lmFast.R, flip the sign of the t-statistic to get the effect for mutant rather than wildtype
+    return np.concatenate(p_all).astype(np.float32), (0 - np.concatenate(t_all)).astype(np.float32)
+
+
+def _ols_genotype_effect(design: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit an ordinary least squares model to each column of y and get the p-value and t-statistic of the genotype
+    coefficient. The design matrix is shared so only one QR decomposition is needed.
+
+    Parameters
+    ----------
+    design
+        n specimens * n coefficients. Column GENOTYPE_COL is the genotype effect
+    y
+        n specimens * n voxels/labels
+
+    Returns
+    -------
+    p-values and t-statistics for each column of y
+    """
+    q, r = np.linalg.qr(design)
+    df = design.shape[0] - design.shape[1]
+
+    r_inv = np.linalg.inv(r)
+    genotype_row = r_inv[GENOTYPE_COL].astype(y.dtype)
+    # The diagonal of (X'X)^-1 for the genotype coefficient. The standard error is this scaled by the residual variance
+    unscaled_var = (r_inv @ r_inv.T)[GENOTYPE_COL, GENOTYPE_COL]
+    q = q.astype(y.dtype)
+
+    t = np.empty(y.shape[1], dtype=np.float64)
+
+    for start in range(0, y.shape[1], LM_BLOCK_SIZE):
+        block = y[:, start: start + LM_BLOCK_SIZE]
+        qty = q.T @ block
+        beta = genotype_row @ qty
+        resid = block - q @ qty
+        rss = np.einsum('ij,ij->j', resid, resid, dtype=np.float64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t[start: start + LM_BLOCK_SIZE] = beta / np.sqrt(unscaled_var * rss / df)
+
+    p = stats.t.sf(np.abs(t), df) * 2
+
+    return p, t
+
+
+def lm_permutations(data: np.ndarray, staging: np.ndarray, mutant_labels: np.ndarray,
+                    use_staging: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit data ~ genotype (+ staging) for many relabellings of the same specimens as synthetic mutants, as used to make
+    permutation null distributions.
+
+    Only the genotype column of the design matrix changes between relabellings. So the intercept and staging are
+    projected out of the data once (Frisch-Waugh-Lovell), and each batch of relabellings is then fitted with a couple of
+    matrix products. The results are the same as fitting each relabelling separately with lm_r or lm_numpy.
+
+    Parameters
+    ----------
+    data
+        columns: data points
+        rows: specimens
+    staging
+        The staging value of each specimen
+    mutant_labels
+        n relabellings * n specimens. True where a specimen is labelled as a synthetic mutant
+    use_staging
+        if true, uae staging as a fixed effect in the linear model
+
+    Returns
+    -------
+    pvalues: n relabellings * n data points
+    t-statistics: n relabellings * n data points. Positive t-statistics mean larger values in the synthetic mutants
+    """
+    if np.any(np.isnan(data)):
+        raise ValueError('Data passed to linear_model.py has NAN values')
+
+    mutant_labels = np.asarray(mutant_labels, dtype=np.float64)
+    if mutant_labels.ndim != 2 or mutant_labels.shape[1] != data.shape[0]:
+        raise ValueError(f'mutant_labels should have shape (n relabellings, {data.shape[0]}). Got {mutant_labels.shape}')
+
+    y = np.abs(data).astype(np.float64)  # lmFast.R uses the absolute values
+
+    covariates = [np.ones(data.shape[0])]
+    if use_staging:
+        covariates.append(np.asarray(staging, dtype=np.float64))
+    q, _ = np.linalg.qr(np.column_stack(covariates))
+    df = data.shape[0] - len(covariates) - 1
+
+    # The data with the covariates projected out. Shared by all relabellings
+    y_resid = y - q @ (q.T @ y)
+    yy = np.einsum('ij,ij->j', y_resid, y_resid)
+
+    p = np.empty((len(mutant_labels), data.shape[1]), dtype=np.float32)
+    t = np.empty_like(p)
+
+    for start in range(0, len(mutant_labels), PERM_BLOCK_SIZE):
+        labels = mutant_labels[start: start + PERM_BLOCK_SIZE]
+
+        # genotype' P y and genotype' P genotype, where P projects out the covariates
+        gy = labels @ y_resid
+        g_resid = labels - (labels @ q) @ q.T
+        gg = np.einsum('ij,ij->i', g_resid, labels)[:, None]
+
+        rss = yy - gy ** 2 / gg
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_block = gy / np.sqrt(gg * rss / df)
+
+        t[start: start + PERM_BLOCK_SIZE] = t_block
+        p[start: start + PERM_BLOCK_SIZE] = stats.t.sf(np.abs(t_block), df) * 2
+
+    return p, t
+
+
+class BaselineStats:
+    """
+    The sufficient statistics of the baseline data for the data ~ genotype (+ staging) model.
+
+    The baselines are the same for every mutant line, so their per data point sums are found once. Each line's model
+    (and each specimen-level model) is then finished by adding just the mutant rows, so fitting a line does not touch
+    the baseline data. The results are the same as lm_r/lm_numpy with the baselines and the line's mutants.
+
+    The data are centred on the baseline means, and the staging on the baseline mean staging, so that the residual
+    sums of squares do not lose precision.
+    """
+    def __init__(self, data: Union[np.ndarray, Sequence[np.ndarray]], staging: np.ndarray, ids: Sequence = None):
+        """
+        Parameters
+        ----------
+        data
+            The baseline data. 2D array or list of 1D arrays. rows: specimens, columns: data points
+        staging
+            The staging value for each baseline
+        ids
+            The baseline specimen ids. Stored so it can be checked that the statistics are for the right baselines
+        """
+        if len(data) != len(staging):
+            raise ValueError(f'Got {len(data)} baselines but {len(staging)} staging values')
+
+        self.ids = None if ids is None else list(ids)
+        self.n = len(data)
+
+        staging = np.asarray(staging, dtype=np.float64)
+        self.staging_mean = staging.mean()
+        staging = staging - self.staging_mean
+        self.staging_ss = staging @ staging
+
+        # Two passes over the specimens so only one row at a time is converted to float64
+        self.mean = np.zeros(len(data[0]), dtype=np.float64)
+        for row in data:
+            self.mean += np.abs(row)  # lmFast.R uses the absolute values
+        self.mean /= self.n
+        if np.any(np.isnan(self.mean)):
+            raise ValueError('Data passed to linear_model.py has NAN values')
+
+        self.ss = np.zeros_like(self.mean)  # sum of (y - mean)^2
+        self.staging_cp = np.zeros_like(self.mean)  # sum of (staging - staging mean) * (y - mean)
+        for row, s in zip(data, staging):
+            centred = np.abs(row) - self.mean
+            self.ss += centred * centred
+            self.staging_cp += s * centred
+
+    def fit_line(self, data: Union[np.ndarray, Sequence[np.ndarray]], staging: np.ndarray,
+                 use_staging: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Fit the model for the baselines and a line's mutants, and for the baselines and each mutant
+
+        Parameters
+        ----------
+        data
+            The mutant data. 2D array or list of 1D arrays. rows: specimens, columns: data points
+        staging
+            The staging value for each mutant
+        use_staging
+            if true, uae staging as a fixed effect in the linear model
+
+        Returns
+        -------
+        As lm_r:
+        pvalues for each label or voxel, followed by the specimen-level pvalues for each mutant
+        t-statistics for each label or voxel, followed by the specimen-level t-statistics for each mutant
+        """
+        if len(data) != len(staging):
+            raise ValueError(f'Got {len(data)} mutants but {len(staging)} staging values')
+
+        staging = np.asarray(staging, dtype=np.float64) - self.staging_mean
+        num_points = len(self.mean)
+
+        # The line followed by each specimen on its own
+        p_all = np.empty((len(data) + 1, num_points), dtype=np.float32)
+        t_all = np.empty_like(p_all)
+
+        for block, centred in self._centred_blocks(data):
+            t, df = self._genotype_t(centred, staging, block, use_staging)
+            t_all[0, block] = t
+            p_all[0, block] = stats.t.sf(np.abs(t), df) * 2
+
+            t, df = self._specimen_t(centred, staging, block, use_staging)
+            t_all[1:, block] = t
+            p_all[1:, block] = stats.t.sf(np.abs(t), df) * 2
+
+        return p_all.ravel(), t_all.ravel()
+
+    def fit_specimens(self, data: Union[np.ndarray, Sequence[np.ndarray]], staging: np.ndarray,
+                      use_staging: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Fit the model for the baselines and each mutant on its own
+
+        Parameters
+        ----------
+        data
+            The mutant data. 2D array or list of 1D arrays. rows: specimens, columns: data points
+        staging
+            The staging value for each mutant
+        use_staging
+            if true, uae staging as a fixed effect in the linear model
+
+        Returns
+        -------
+        pvalues: mutants * data points
+        t-statistics: mutants * data points
+        """
+        if len(data) != len(staging):
+            raise ValueError(f'Got {len(data)} mutants but {len(staging)} staging values')
+
+        staging = np.asarray(staging, dtype=np.float64) - self.staging_mean
+
+        p = np.empty((len(data), len(self.mean)), dtype=np.float32)
+        t = np.empty_like(p)
+
+        for block, centred in self._centred_blocks(data):
+            t_block, df = self._specimen_t(centred, staging, block, use_staging)
+            t[:, block] = t_block
+            p[:, block] = stats.t.sf(np.abs(t_block), df) * 2
+
+        return p, t
+
+    def _centred_blocks(self, data: Union[np.ndarray, Sequence[np.ndarray]]):
+        """
+        Yield blocks of data points of the mutant data as float64 absolute values centred on the baseline means
+        """
+        for start in range(0, len(self.mean), LM_BLOCK_SIZE):
+            block = slice(start, start + LM_BLOCK_SIZE)
+            centred = np.abs(np.array([row[block] for row in data], dtype=np.float64)) - self.mean[block]
+            if np.any(np.isnan(centred)):
+                raise ValueError('Data passed to linear_model.py has NAN values')
+            yield block, centred
+
+    def _genotype_t(self, centred: np.ndarray, staging: np.ndarray, block: slice,
+                    use_staging: bool) -> Tuple[np.ndarray, int]:
+        """
+        Get the t-statistic of the genotype coefficient of the baselines plus the given mutant rows.
+
+        Design matrix columns: intercept, mutant indicator, (centred staging). The baseline contributions to X'X are
+        n and the staging sum of squares (the centred baseline sums are zero), and to X'y just the staging
+        cross-product
+        """
+        k = len(centred)
+        mut_sum = centred.sum(axis=0)
+
+        if use_staging:
+            s_sum = staging.sum()
+            xtx = np.array([[self.n + k, k, s_sum],
+                            [k, k, s_sum],
+                            [s_sum, s_sum, self.staging_ss + staging @ staging]])
+            xty = np.stack([mut_sum, mut_sum, self.staging_cp[block] + staging @ centred])
+        else:
+            xtx = np.array([[self.n + k, k],
+                            [k, k]], dtype=np.float64)
+            xty = np.stack([mut_sum, mut_sum])
+
+        xtx_inv = np.linalg.inv(xtx)
+        df = self.n + k - len(xtx)
+
+        beta = xtx_inv @ xty
+        rss = self.ss[block] + np.einsum('ij,ij->j', centred, centred) - np.einsum('ij,ij->j', beta, xty)
+        rss = np.maximum(rss, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = beta[GENOTYPE_COL] / np.sqrt(xtx_inv[GENOTYPE_COL, GENOTYPE_COL] * rss / df)
+
+        return t, df
+
+    def _specimen_t(self, centred: np.ndarray, staging: np.ndarray, block: slice,
+                    use_staging: bool) -> Tuple[np.ndarray, int]:
+        """
+        Get the genotype t-statistics for the baselines plus each one of the given mutant rows, all at once.
+
+        The genotype indicator of a single mutant fits that row exactly, so the rest of the model is the baseline-only
+        fit. The genotype coefficient is then the mutant's residual from the baseline fit, and its variance is the
+        prediction variance RSS/df * (1 + h), where h is the mutant's leverage under the baseline fit
+        """
+        if use_staging:
+            slope = self.staging_cp[block] / self.staging_ss
+            resid = centred - np.outer(staging, slope)
+            rss = self.ss[block] - self.staging_cp[block] * slope
+            leverage = 1 / self.n + staging ** 2 / self.staging_ss
+            df = self.n - 2
+        else:
+            resid = centred
+            rss = self.ss[block]
+            leverage = np.full(len(centred), 1 / self.n)
+            df = self.n - 1
+
+        rss = np.maximum(rss, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = resid / np.sqrt(np.outer(1 + leverage, rss / df))
+
+        return t, df
+
+
+# The functions that can be used as Stats.stats_runner
+LM_ENGINES = {'R': lm_r,
+              'numpy': lm_numpy}
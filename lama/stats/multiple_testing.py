@@ -0,0 +1,161 @@
+"""
+Multiple testing correction without R.
+
+fdr() gives the same q-values as R's p.adjust (methods 'BH' and 'BY') and the qvalue package (method 'qvalue', Storey's
+q-values with the default smoother estimate of pi0). Each vector of p-values is sorted once, so correction is
+O(n log n), and the work is done in the dtype of the output so float32 p-values can be corrected in place.
+
+A 2D array is treated as a batch of p-value vectors, one per row, that are corrected separately. So, for example, all
+the specimens of a line can be corrected with one call.
+
+Example
+-------
+q = fdr(pvals)  # BH
+fdr(specimen_pvals, method='qvalue', out=specimen_pvals)  # In place, one row per specimen
+"""
+
+from functools import lru_cache
+from typing import Tuple, Union
+
+import numpy as np
+from scipy.interpolate import make_smoothing_spline
+from scipy.optimize import brentq
+
+FDR_METHODS = ('BH', 'BY', 'qvalue')
+
+# The defaults of qvalue::pi0est
+QVALUE_LAMBDAS = tuple(np.round(np.arange(0.05, 0.951, 0.05), 2))
+QVALUE_SMOOTH_DF = 3
+
+
+def fdr(pvals: np.ndarray, method: str = 'BH', out: np.ndarray = None) -> np.ndarray:
+    """
+    Correct p-values for multiple testing
+
+    Parameters
+    ----------
+    pvals
+        1D array of p-values, or 2D array with a vector of p-values to correct in each row.
+        NaNs are left as NaN and are not counted as tests, as in p.adjust
+    method
+        'BH' (Benjamini-Hochberg), 'BY' (Benjamini-Yekutieli) or 'qvalue' (Storey)
+    out
+        Where to write the q-values. Can be pvals to correct in place. If None, a new float32 array is made for float32
+        input and a float64 array otherwise
+
+    Returns
+    -------
+    The q-values, in the same shape as pvals
+    """
+    if method not in FDR_METHODS:
+        raise ValueError(f'Unknown FDR method {method}. Choose from {FDR_METHODS}')
+
+    pvals = np.asarray(pvals)
+
+    if out is None:
+        out = np.empty(pvals.shape, dtype=np.float32 if pvals.dtype == np.float32 else np.float64)
+    elif out.shape != pvals.shape:
+        raise ValueError(f'out has shape {out.shape}. Expected {pvals.shape}')
+
+    if pvals.ndim == 1:
+        _fdr_vector(pvals, out, method)
+    elif pvals.ndim == 2:
+        for p_row, q_row in zip(pvals, out):
+            _fdr_vector(p_row, q_row, method)
+    else:
+        raise ValueError(f'pvals should be 1D or 2D. Got {pvals.ndim} dimensions')
+
+    return out
+
+
+def _fdr_vector(p: np.ndarray, q: np.ndarray, method: str):
+    """
+    Correct one vector of p-values and write the q-values into q, which may be p
+    """
+    order = np.argsort(p, kind='stable')
+    sorted_ = p[order].astype(q.dtype, copy=False)  # NaNs are sorted to the end
+
+    num_tests = len(sorted_) - int(np.count_nonzero(np.isnan(sorted_)))
+    tested = sorted_[:num_tests]
+
+    pi0 = 1.0
+    if method == 'qvalue' and num_tests:
+        pi0 = storey_pi0(tested, is_sorted=True)
+
+    # q(i) = min over j >= i of p(j) * n / j
+    factor = float(num_tests)
+    if method == 'BY':
+        factor *= float(np.sum(1.0 / np.arange(1, num_tests + 1)))
+
+    tested *= factor
+    tested /= np.arange(1, num_tests + 1, dtype=q.dtype)
+    reverse = tested[::-1]
+    np.minimum.accumulate(reverse, out=reverse)
+    np.minimum(tested, 1, out=tested)
+
+    if pi0 != 1.0:
+        tested *= pi0
+
+    q[order] = sorted_
+
+
+def storey_pi0(pvals: np.ndarray, lambdas: Union[float, Tuple[float, ...]] = QVALUE_LAMBDAS,
+               is_sorted: bool = False) -> float:
+    """
+    Estimate the proportion of true null hypotheses as qvalue::pi0est does with its default smoother method
+
+    Parameters
+    ----------
+    pvals
+        The p-values with no NaNs
+    lambdas
+        The p-value cutoffs to estimate pi0 at. If there is only one, pi0 is estimated at that cutoff with no smoothing
+    is_sorted
+        Set to True if pvals is already sorted in ascending order
+
+    Returns
+    -------
+    The estimate of pi0 (0, 1]
+    """
+    if not is_sorted:
+        pvals = np.sort(pvals)
+
+    lambdas = np.atleast_1d(np.asarray(lambdas, dtype=np.float64))
+
+    if pvals[-1] < lambdas.max():
+        raise ValueError(f'The maximum p-value ({pvals[-1]}) is smaller than the lambda range')
+
+    # The fraction of p-values >= lambda, scaled by the width of the interval
+    num_over = len(pvals) - np.searchsorted(pvals, lambdas, side='left')
+    pi0 = num_over / (len(pvals) * (1 - lambdas))
+
+    if len(lambdas) == 1:
+        pi0 = pi0[0]
+    else:
+        # The smoothing spline is linear in pi0, so only the weights for the prediction at the largest lambda are needed
+        pi0 = float(_smoother_weights(tuple(lambdas), QVALUE_SMOOTH_DF) @ pi0)
+
+    pi0 = min(pi0, 1.0)
+
+    if pi0 <= 0:
+        raise ValueError('The estimated pi0 <= 0. Check that the p-values are valid')
+
+    return pi0
+
+
+@lru_cache(maxsize=8)
+def _smoother_weights(x: Tuple[float, ...], df: float) -> np.ndarray:
+    """
+    Get the weights that give the value at x[-1] of a cubic smoothing spline with df degrees of freedom fitted to
+    values at x, as R's smooth.spline(x, y, df=df) does
+    """
+    x = np.array(x)
+    identity = np.eye(len(x))
+
+    def smoother_matrix(log_lam):
+        return np.column_stack([make_smoothing_spline(x, col, lam=np.exp(log_lam))(x) for col in identity])
+
+    # The degrees of freedom of a linear smoother is the trace of its matrix. It falls from len(x) to 2 as lam rises
+    log_lam = brentq(lambda log_lam: np.trace(smoother_matrix(log_lam)) - df, -30, 30, xtol=1e-6)
+
+    return smoother_matrix(log_lam)[-1]
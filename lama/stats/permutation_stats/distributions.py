@@ -19,20 +19,28 @@ For each mutant line
 """
 
 from os.path import expanduser
-from typing import Union, Tuple, List
-import random
+from typing import Union, Tuple, List, Set, Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from logzero import logger as logging
+import numpy as np
 import pandas as pd
 from scipy.special import comb
 
-from lama.stats.linear_model import lm_r
+from lama.stats.linear_model import lm_r, lm_permutations, PERM_BLOCK_SIZE
+from lama.stats.permutation_stats.null_store import NullCache, LineNullStore, null_key
 
 home = expanduser('~')
 
+PERM_SEED = 999  # The default run seed. Each permutation's random generator is seeded from this and its number
+
 
 def null(input_data: pd.DataFrame,
-         num_perm: int,) -> Tuple[pd.DataFrame, pd.DataFrame, List]:
+         num_perm: int,
+         workers: int = 1,
+         seed: int = PERM_SEED,
+         cache_dir: Path = None) -> Tuple[pd.DataFrame, pd.DataFrame, List]:
     """
     Generate null distributions for line and specimen-level data
 
@@ -47,6 +55,14 @@ def null(input_data: pd.DataFrame,
 
     num_perm
         number of permutations
+    workers
+        The number of processes to fit the permutations with
+    seed
+        The run seed. Permutation i of the lines with n specimens chooses its synthetic mutants with a generator
+        seeded with (seed, n, i), so the results are the same whatever the number of workers
+    cache_dir
+        If given, the null distributions are cached here (see null_store). Cached permutations made from the same
+        baselines, staging and seed are reused, and only the missing ones are made
 
     Returns
     -------
@@ -58,22 +74,16 @@ def null(input_data: pd.DataFrame,
     Notes
     -----
     Labels must not start with a digit as R will throw a wobbly
-    """
-    random.seed(999)
 
+    The permutations cycle through the line sizes. Each line size has its own sequence of unique synthetic mutant
+    sets, which are made in chunks and fitted in batches with linear_model.lm_permutations. This gives the same
+    p-values as fitting each set with lm_r
+    """
     # Use the generic staging label from now on
     input_data.rename(columns={'crl': 'staging', 'volume': 'staging'}, inplace=True)
 
     label_names = input_data.drop(['staging', 'line'], axis='columns').columns
 
-    # Store p-value results. One tuple(len=num labels) per iteration
-    line_p = []
-    line_t = []
-    line_specimens = []  # To debug which specimens might be causing problems for certain organs
-
-    spec_p = []
-    spec_t = []
-
     # Create synthetic specimens by iteratively relabelling each baseline as synthetic mutant
     baselines = input_data[input_data['line'] == 'baseline']
 
@@ -81,114 +91,176 @@ def null(input_data: pd.DataFrame,
     line_specimen_counts = input_data[input_data['line'] != 'baseline'].groupby('line').count()
     line_specimen_counts = list(line_specimen_counts.iloc[:, 0])
 
-    # Split data into a numpy array of raw data and dataframe for staging and genotype fopr the LM code
+    # Split data into a numpy array of raw data and the staging for the LM code
     data = baselines.drop(columns=['staging', 'line']).values
-    info = baselines[['staging', 'line']]
+    staging = baselines['staging'].values
+
+    cache = NullCache(cache_dir, null_key(data, staging, seed))
 
     # Get the specimen-level null distribution. i.e. the distributuio of p-values obtained from relabeling each baseline
     # once
-    # TODO: Why does the LM not try to return a specimen-level p value as well?
-    for index, _ in info.iterrows():
-        info['genotype'] = 'wt'                     # Set all genotypes to WT
-        info.ix[[index], 'genotype'] = 'synth_hom'  # Set the ith baseline to synth hom
-
-        # Get a p-value for each organ
-        p, t = lm_r(data, info)
-
-        # Check that there are equal amounts of p-value than there are data points
-        if len(p) != data.shape[1]:
-            raise ValueError(f'The length of p-values results: {data.shape[1]} does not match the length of the input data: {len(p)}')
-
-        spec_p.append(p)
-        spec_t.append(t)
+    if cache.spec_pvalues is None:
+        cache.set_spec_pvalues(_fit_permutations(data, staging, np.eye(len(baselines), dtype=bool), workers))
+    spec_p = cache.spec_pvalues
 
     # Line-level null distribution
     # Create synthetic lines by iteratively relabelling n baselines as synthetic mutants
     # n is determined by sampling the number of homs in each mutant line
+    perm_line_sizes = _line_size_cycle(len(baselines), line_specimen_counts, num_perm - 1)
 
-    # keep a list of sets of synthetic mutants, only run a set once
-    synthetics_sets_done = []
+    if len(perm_line_sizes) < num_perm - 1:
+        logging.warning(f'Only {len(perm_line_sizes)} unique permutations can be made from {len(baselines)} baselines')
 
-    perms_done = 1
+    line_p = np.empty((len(perm_line_sizes), len(label_names)), dtype=np.float32)
+    mutant_labels = np.empty((len(perm_line_sizes), len(baselines)), dtype=bool)
 
-    while perms_done < num_perm:
+    for n in sorted(set(perm_line_sizes)):
+        perms_needed = np.flatnonzero(perm_line_sizes == n)
+        store = cache.line_store(n)
+        _make_line_permutations(store, data, staging, n, len(perms_needed), seed, workers)
 
-        for n in line_specimen_counts:  # mutant lines
+        # The permutations for each line size are used in the order they were made
+        line_p[perms_needed] = np.concatenate(store.pvalues)[:len(perms_needed)]
+        mutant_labels[perms_needed] = np.concatenate(store.labels)[:len(perms_needed)]
 
-            if perms_done == num_perm:
-                break
+    # To debug which specimens might be causing problems for certain organs
+    line_specimens = [[baselines.index[row].to_list()] for row in mutant_labels]
 
-            print(f'permutation: {perms_done}')
+    line_df = pd.DataFrame(line_p, columns=label_names)
+    spec_df = pd.DataFrame(spec_p, columns=label_names)
 
-            if not _label_synthetic_mutants(info, n, synthetics_sets_done):
-                continue
+    # Get rid of the x in the headers that were needed for R
+    strip_x([line_df, spec_df])
 
-            perms_done += 1
+    return line_df, spec_df, line_specimens
 
-            line_specimens.append([info[info['genotype'] == 'synth_hom'].index.to_list()])
 
-            p, t = lm_r(data, info)  # returns p_values for all organs, 1 iteration
+def _line_size_cycle(n_baselines: int, line_sizes: List[int], num_perm: int) -> np.ndarray:
+    """
+    Get the number of synthetic mutants for each line-level permutation, cycling through the mutant line sizes.
+    Line sizes are skipped once all their unique combinations of baselines have been used
 
-            if len(p) != data.shape[1]:
-                raise ValueError(
-                    f'The length of p-values results: {data.shape[1]} does not match the length of the input data: {len(p)}')
+    Returns
+    -------
+    The line size for each permutation. This is shorter than num_perm if the combinations run out
+    """
+    max_combs = {n: int(comb(n_baselines, n)) for n in set(line_sizes)}
+    used = dict.fromkeys(max_combs, 0)
+    sizes = []
 
-            line_p.append(p)
-            line_t.append(t)
+    while len(sizes) < num_perm and any(used[n] < max_combs[n] for n in used):
+        for n in line_sizes:  # mutant lines
+            if len(sizes) == num_perm:
+                break
+            if used[n] < max_combs[n]:
+                used[n] += 1
+                sizes.append(n)
 
-    line_df = pd.DataFrame.from_records(line_p, columns=label_names)
-    spec_df = pd.DataFrame.from_records(spec_p, columns=label_names)
+    return np.array(sizes, dtype=int)
 
-    # Get rid of the x in the headers that were needed for R
-    strip_x([line_df, spec_df])
 
-    return line_df, spec_df, line_specimens
+def _make_line_permutations(store: LineNullStore, data: np.ndarray, staging: np.ndarray, n: int, num_perm: int,
+                            seed: int, workers: int):
+    """
+    Add permutations with n synthetic mutants to the store until it has num_perm of them
+    """
+    # keep the sets of synthetic mutants done, only run a set once
+    synthetics_sets_done = set()
+    chunks_seen = 0
+
+    chunk_size = PERM_BLOCK_SIZE * max(1, workers)
+
+    while store.num_perms < num_perm:
+        # The store may have been given chunks made by another run sharing the cache
+        for labels in store.labels[chunks_seen:]:
+            synthetics_sets_done.update(tuple(np.flatnonzero(row).tolist()) for row in labels)
+        chunks_seen = len(store.labels)
+
+        first_perm = store.num_perms
+        chunk_perms = range(first_perm, min(num_perm, first_perm + chunk_size))
+
+        mutant_labels = np.zeros((len(chunk_perms), data.shape[0]), dtype=bool)
+        for i, perm_num in enumerate(chunk_perms):
+            mutant_indices = _label_synthetic_mutants(data.shape[0], n, synthetics_sets_done, seed, perm_num)
+            mutant_labels[i, mutant_indices] = True
 
+        logging.info(f'Fitting line-level permutations {first_perm + 1}-{chunk_perms[-1] + 1} for lines of {n} '
+                     f'with {workers} workers')
+        store.append(_fit_permutations(data, staging, mutant_labels, workers), mutant_labels)
 
-def _label_synthetic_mutants(info: pd.DataFrame, n: int, sets_done: List) -> bool:
+
+def _label_synthetic_mutants(n_baselines: int, n: int, sets_done: Set[Tuple[int, ...]], seed: int,
+                             perm_num: int) -> List[int]:
     """
-    Given a dataframe of wild type data relabel n baselines as synthetic mutant in place.
+    Choose n baselines to relabel as synthetic mutants.
     Keep track of combinations done in sets_done and do not duplicate
 
     Parameters
     ----------
-    info
-        dataframe with 'genotype' column
+    n_baselines
+        The number of baselines to choose from
     n
         how many specimens to relabel
     sets_done
-        Contains Sets of previously selected specimen IDs
+        The sorted tuples of previously selected specimen indices. The new set is added to this
+    seed
+        The run seed
+    perm_num
+        The permutation number for this n. Used along with seed and n to seed the random generator for this permutation
 
     Returns
     -------
-    True if able to find a new combination of mutant and wildtype
-    False if no more combinations are available for that specific n
+    The sorted indices of the baselines to relabel as synthetic mutants
     """
+    if len(sets_done) >= int(comb(n_baselines, n)):
+        raise ValueError(f'Cannot find more unique combinations of {n} synthetic mutants from {n_baselines} baselines')
 
-    # Set all to wt genotype
-    info['genotype'] = 'wt'
+    rng = np.random.default_rng([seed, n, perm_num])
 
-    # label n number of baselines as mutants
+    # There is at least one unused combination, so this will finish
+    while True:
+        synthetics_mut_indices = tuple(sorted(rng.choice(n_baselines, n, replace=False).tolist()))
+        if synthetics_mut_indices not in sets_done:
+            break
 
-    max_comb = int(comb(len(info), n))
+    sets_done.add(synthetics_mut_indices)
 
-    for i in range(max_comb):
-        synthetics_mut_indices = random.sample(range(0, len(info)), n)
-        i += 1
-        if not set(synthetics_mut_indices) in sets_done:
-            break
+    return list(synthetics_mut_indices)
 
-    if i > max_comb - 1:
-        msg = f"""Cannot find unique combinations of wild type baselines to relabel as synthetic mutants
-        With a baseline n  of {len(info)}\n. Choosing {n} synthetics. 
-        Try increasing the number of baselines or reducing the number of permutations"""
 
-        return False
+def _fit_permutations(data: np.ndarray, staging: np.ndarray, mutant_labels: np.ndarray, workers: int) -> np.ndarray:
+    """
+    Fit the relabellings in blocks spread over a process pool and return the p-values in the order of mutant_labels
+    """
+    blocks = [(data, staging, mutant_labels[i: i + PERM_BLOCK_SIZE])
+              for i in range(0, len(mutant_labels), PERM_BLOCK_SIZE)]
 
-    sets_done.append(set(synthetics_mut_indices))
+    p_blocks = _map(_fit_permutation_block, blocks, workers)
 
-    info.ix[synthetics_mut_indices, 'genotype'] = 'synth_hom'  # Why does iloc not work here?
-    return True
+    if not p_blocks:
+        return np.empty((0, data.shape[1]), dtype=np.float32)
+    return np.concatenate(p_blocks)
+
+
+def _fit_permutation_block(job: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> np.ndarray:
+    p, _ = lm_permutations(*job)
+    return p
+
+
+def _fit_alternative(job: Tuple[np.ndarray, pd.DataFrame]) -> np.ndarray:
+    p, _ = lm_r(*job)
+    return p
+
+
+def _map(func: Callable, jobs: Iterable, workers: int) -> List:
+    """
+    map func over jobs, using a process pool if workers > 1. The results are in the order of the jobs
+    """
+    if workers <= 1:
+        return list(map(func, jobs))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, jobs))
 
 
 def strip_x(dfs):
@@ -198,7 +270,8 @@ def strip_x(dfs):
 
 def alternative(input_data: pd.DataFrame,
                 plot_dir: Union[None, Path] = None,
-                boxcox: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame]:
+                boxcox: bool = False,
+                workers: int = 1) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Generate alterntive (mutant) distributions for line and pecimen-level data
 
@@ -207,13 +280,15 @@ def alternative(input_data: pd.DataFrame,
     input_data
     plot_dir
     boxcox
+    workers
+        The number of processes to fit the lines and specimens with
 
     Returns
     -------
     alternative distribution dataframes with either line or specimen as index
     """
 
-    # Group by line and sequntaily run
+    # Group by line. The models are fitted in a process pool once they have all been set up
     line_groupby = input_data.groupby('line')
 
     label_names = list(input_data.drop(['staging', 'line'], axis='columns').columns)
@@ -221,8 +296,10 @@ def alternative(input_data: pd.DataFrame,
     baseline = input_data[input_data['line'] == 'baseline']
     baseline['genotype'] = 'wt'
 
-    alt_line_pvalues = []
-    alt_spec_pvalues = []
+    line_jobs = []
+    line_ids = []
+    spec_jobs = []
+    spec_ids = []
 
     # Get line-level alternative distributions
     for line_id, line_df in line_groupby:
@@ -242,9 +319,8 @@ def alternative(input_data: pd.DataFrame,
 
         info = df_wt_mut[['staging', 'line', 'genotype']]
 
-        p, t = lm_r(data, info)  # returns p_values for all organs, 1 iteration
-        res = [line_id] + list(p)
-        alt_line_pvalues.append(res)
+        line_jobs.append((data, info))
+        line_ids.append([line_id])
 
     # Get specimen-level alternative distributions
     mutants = input_data[input_data['line'] != 'baseline']
@@ -256,9 +332,12 @@ def alternative(input_data: pd.DataFrame,
         data = df_wt_mut.drop(columns=['line', 'genotype', 'staging']).values
         info = df_wt_mut[['genotype', 'staging']]
 
-        p, t = lm_r(data, info)  # returns p_values for all organs, 1 iteration
-        res = [line_id, specimen_id] + list(p)
-        alt_spec_pvalues.append(res)
+        spec_jobs.append((data, info))
+        spec_ids.append([line_id, specimen_id])
+
+    # returns p_values for all organs, 1 iteration per job
+    alt_line_pvalues = [ids + list(p) for ids, p in zip(line_ids, _map(_fit_alternative, line_jobs, workers))]
+    alt_spec_pvalues = [ids + list(p) for ids, p in zip(spec_ids, _map(_fit_alternative, spec_jobs, workers))]
 
     # result dataframes have either line or specimen in index then labels
     alt_line_df = pd.DataFrame.from_records(alt_line_pvalues, columns=['line'] + label_names, index='line')
@@ -0,0 +1,273 @@
+"""
+Storage for the permutation null distributions.
+
+The null distributions only depend on the baseline data, the staging and the seed, and the line-level null also on the
+sizes of the mutant lines. So they are kept in a content-addressed cache: a folder named by a checksum of the baseline
+data, staging and seed (null_key), holding the specimen-level null and one folder of line-level permutations for each
+line size (n synthetic mutants). A run with a new line only has to make the permutations for line sizes that are not in
+the cache yet, and a run that asks for more permutations only adds the missing ones.
+
+The line-level permutations are written in chunks as soon as they have been fitted, so a run that is stopped part way
+through can be restarted without losing the finished chunks.
+
+Without a cache folder everything is just kept in memory.
+
+The cache can be shared by runs at the same time (the --null_cache option). Writes to a null folder are made while
+holding a lock file for its key (<null_key>.lock), and before adding a chunk any chunks added by another run are loaded.
+The permutations are seeded by their number, so a chunk already added by another run is the same as the one just made
+and is not added again.
+
+The cache is kept under a size limit by deleting the least recently used null folders when a NullCache is opened.
+A folder's modification time is set whenever it's opened. Folders whose lock is held by another run are not deleted.
+
+Folder layout
+-------------
+<null_key>/
+    spec_pvalues.npy
+    n_3/
+        state.yaml
+        pvalues_00000.npy
+        labels_00000.npy
+        pvalues_00001.npy
+        ...
+    n_4/
+        ...
+"""
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Union
+
+from filelock import SoftFileLock, Timeout
+from logzero import logger as logging
+import numpy as np
+import yaml
+
+STATE_FILE = 'state.yaml'
+SPEC_PVALUES_FILE = 'spec_pvalues.npy'
+PVALUES_PREFIX = 'pvalues_'
+LABELS_PREFIX = 'labels_'
+LOCK_SUFFIX = '.lock'
+LOCK_TIMEOUT = 600  # Seconds to wait for another run to finish writing to the same null folder
+DEFAULT_NULL_CACHE_MAX_GB = 20
+
+
+def null_key(data: np.ndarray, staging: np.ndarray, seed: int) -> str:
+    """
+    Get a checksum of the inputs that determine the null distributions
+    """
+    md5 = hashlib.md5()
+    md5.update(str(data.shape).encode())
+    md5.update(np.ascontiguousarray(data, dtype=np.float64).tobytes())
+    md5.update(np.ascontiguousarray(staging, dtype=np.float64).tobytes())
+    md5.update(str(seed).encode())
+    return md5.hexdigest()
+
+
+class NullCache:
+    def __init__(self, cache_dir: Union[Path, None], key: str, max_gb: float = DEFAULT_NULL_CACHE_MAX_GB):
+        """
+        Parameters
+        ----------
+        cache_dir
+            The root of the cache. The null for these inputs is stored in cache_dir/key. If None, nothing is written
+        key
+            The null_key of the inputs
+        max_gb
+            The size limit of the cache. Least recently used null folders are deleted to keep under it
+        """
+        self.out_dir = None if cache_dir is None else cache_dir / key
+        self._line_stores: Dict[int, LineNullStore] = {}
+        self.lock = None
+
+        self.spec_pvalues = None
+
+        if self.out_dir is not None:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            self.lock = _key_lock(self.out_dir)
+            os.utime(self.out_dir)
+            _evict(cache_dir, keep=self.out_dir, max_bytes=max_gb * 1024 ** 3)
+
+            spec_file = self.out_dir / SPEC_PVALUES_FILE
+            if spec_file.is_file():
+                self.spec_pvalues = np.load(spec_file)
+                logging.info(f'Using the cached specimen-level null in {self.out_dir}')
+
+    def set_spec_pvalues(self, p: np.ndarray):
+        self.spec_pvalues = p
+        if self.out_dir is not None:
+            with _acquire(self.lock):
+                _save_npy(self.out_dir / SPEC_PVALUES_FILE, p)
+
+    def line_store(self, n: int) -> 'LineNullStore':
+        """
+        Get the line-level permutations with n synthetic mutants
+        """
+        if n not in self._line_stores:
+            self._line_stores[n] = LineNullStore(None if self.out_dir is None else self.out_dir / f'n_{n}', self.lock)
+        return self._line_stores[n]
+
+
+class LineNullStore:
+    def __init__(self, out_dir: Union[Path, None], lock: SoftFileLock = None):
+        """
+        The line-level permutations for one line size
+
+        Parameters
+        ----------
+        out_dir
+            Where to write the chunks. If None, nothing is written
+        lock
+            The lock of the null folder, held while writing to out_dir
+        """
+        self.out_dir = out_dir
+        self.lock = lock
+
+        self.state = {'num_chunks': 0,
+                      'num_perms': 0}
+
+        self.pvalues: List[np.ndarray] = []
+        self.labels: List[np.ndarray] = []
+
+        if out_dir is not None:
+            out_dir.mkdir(parents=True, exist_ok=True)
+            self._load()
+
+    def _load(self):
+        """
+        Load any chunks that are on disk but not in memory yet. The chunk files are written before the state, so the
+        chunks listed in the state are always complete
+        """
+        state_file = self.out_dir / STATE_FILE
+
+        if not state_file.is_file():
+            return
+
+        with open(state_file, 'r') as fh:
+            state = yaml.safe_load(fh)
+
+        if state['num_chunks'] <= self.state['num_chunks']:
+            return
+
+        for i in range(self.state['num_chunks'], state['num_chunks']):
+            self.pvalues.append(np.load(self._chunk_path(PVALUES_PREFIX, i)))
+            self.labels.append(np.load(self._chunk_path(LABELS_PREFIX, i)))
+
+        logging.info(f'Using {state["num_perms"] - self.num_perms} cached line-level permutations from {self.out_dir}')
+        self.state = state
+
+    @property
+    def num_perms(self) -> int:
+        return self.state['num_perms']
+
+    def append(self, p: np.ndarray, labels: np.ndarray):
+        """
+        Add a chunk of permutations, which follow on from the permutations already in the store
+
+        If another run sharing the cache has added some of the same permutations in the meantime, those are loaded
+        instead and only the rest of the chunk is added
+
+        Parameters
+        ----------
+        p
+            permutations * labels p-values
+        labels
+            permutations * baselines. True for the synthetic mutants
+        """
+        if self.out_dir is None:
+            self._add(p, labels)
+            return
+
+        with _acquire(self.lock):
+            first_perm = self.num_perms
+            self._load()
+            already_done = self.num_perms - first_perm
+            if already_done >= len(p):
+                return
+            p, labels = p[already_done:], labels[already_done:]
+
+            # The chunk files are written before the state, so an interrupted write is just overwritten on resume
+            i = self.state['num_chunks']
+            _save_npy(self._chunk_path(PVALUES_PREFIX, i), p)
+            _save_npy(self._chunk_path(LABELS_PREFIX, i), labels)
+
+            self._add(p, labels)
+            self._write_state()
+
+    def _add(self, p: np.ndarray, labels: np.ndarray):
+        self.pvalues.append(p)
+        self.labels.append(labels)
+        self.state['num_chunks'] += 1
+        self.state['num_perms'] += len(p)
+
+    def _chunk_path(self, prefix: str, i: int) -> Path:
+        return self.out_dir / f'{prefix}{i:05d}.npy'
+
+    def _write_state(self):
+        tmp = self.out_dir / f'{STATE_FILE}.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(yaml.dump(self.state))
+        os.replace(tmp, self.out_dir / STATE_FILE)
+
+
+def _key_lock(out_dir: Path) -> SoftFileLock:
+    """
+    Get the lock for a null folder. A SoftFileLock is used, as for the lama_job_runner job file, so it works on nfs.
+    If a run is killed while holding the lock, the lock file is left and has to be deleted
+    """
+    return SoftFileLock(str(out_dir) + LOCK_SUFFIX)
+
+
+def _acquire(lock: SoftFileLock):
+    try:
+        return lock.acquire(timeout=LOCK_TIMEOUT)
+    except Timeout:
+        raise RuntimeError(f'Could not get the null cache lock {lock.lock_file}. If no other run is using the cache, '
+                           f'delete the lock file')
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def _evict(cache_dir: Path, keep: Path, max_bytes: float):
+    """
+    Delete the least recently used null folders until the cache is under max_bytes. keep is never deleted
+    """
+    folders = [d for d in cache_dir.iterdir() if d.is_dir()]
+    sizes = {d: _dir_size(d) for d in folders}
+    total = sum(sizes.values())
+
+    for folder in sorted(folders, key=lambda d: d.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        if folder == keep:
+            continue
+
+        lock = _key_lock(folder)
+        try:
+            lock.acquire(timeout=0)
+        except Timeout:
+            continue  # In use by another run
+        try:
+            shutil.rmtree(folder)
+        finally:
+            lock.release()
+
+        total -= sizes[folder]
+        logging.info(f'Removed {folder.name} from the null cache')
+
+    if total > max_bytes:
+        logging.warning(f'The null cache in {cache_dir} is over its size limit of {round(max_bytes / 1024 ** 3, 3)} GB')
+
+
+def _save_npy(path: Path, array: np.ndarray):
+    """
+    Write via a temp file so a partly written file is never left at path
+    """
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as fh:
+        np.save(fh, array)
+    os.replace(tmp, path)
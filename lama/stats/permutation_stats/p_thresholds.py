@@ -5,6 +5,9 @@ Given a Null and Altertiove distribution of a parameter (organ)
 return a p-value threshold so that the false discovery will be set to 5%.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
 import pandas as pd
 import numpy as np
 
@@ -13,12 +16,16 @@ TESTING = False  # If set to true the p-threshold will be set high an dthe fdr <
 # to get some positive hits for testing
 
 
-def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_threshold: float=0.05) -> pd.DataFrame:
+def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_threshold: float=0.05,
+                   workers: int = 1) -> pd.DataFrame:
     """
     Calculate the per-organ p-value thresholds
     Given a wild type null distribution of p-values and a alternative (mutant)  distribution
     find the largest p-value threshold that would give a FDR < 0.05
 
+    Each distribution is sorted once and the FDR at every candidate threshold for a label is found at once with
+    searchsorted (see _label_threshold). This gives the same results as calling fdr_calc for each candidate.
+
     Parameters
     ----------
     null_dist
@@ -31,6 +38,9 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
 
     target_threshold
         The target FDR threshold
+
+    workers
+        The number of processes to split the labels between
     Returns
     -------
     pd.DataFrame
@@ -41,83 +51,86 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
             num_null, num_null_<=_thresh, num_alt, num_alt_<=_thresh]
 
     """
-    results = []
+    labels = list(null_dist.columns)
 
-    # Prevent overwriting originals
-    null_dist = null_dist.copy()
-    alt_dist = alt_dist.copy()
+    # Sort all the labels at once. NaNs go to the end and are not counted under any threshold
+    wt_sorted = np.sort(null_dist.values.astype(np.float64), axis=0)
+    mut_sorted = np.sort(alt_dist[labels].values.astype(np.float64), axis=0)
 
-    for label in null_dist:
-        print(label)
-        wt_pvals = null_dist[label].values
-        mut_pvals = alt_dist[label].values
+    jobs = [(wt_sorted[:, i], mut_sorted[:, i], target_threshold) for i in range(len(labels))]
 
-        # Debugging
-        wt_pvals.sort()
-        mut_pvals.sort()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            thresholds = list(pool.map(_label_threshold, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    else:
+        thresholds = [_label_threshold(job) for job in jobs]
 
-        # Merge the p-values together get a list of available thresholds to use
-        all_p = list(wt_pvals) + list(mut_pvals)
+    # TODO: what about if the labels are not numbers
+    results = [[int(label)] + list(t) for label, t in zip(labels, thresholds)]
 
-        all_p.sort()
-
-        pthresh_fdrs = []
+    header = ['label', 'p_thresh', 'fdr',
+              'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
 
-        # For every available p-value from the null + alternative distributions, That is lower than 0.05
-        # get the associated FDR for that threshold
+    result_df = pd.DataFrame.from_records(results, columns=header, index='label')
+    result_df.sort_values(by='label', inplace=True)
 
-        all_p = [x for x in all_p if x <= 0.05]
-        for p_to_test in all_p:
+    return result_df
 
-            fdr_at_thresh = fdr_calc(wt_pvals, mut_pvals, p_to_test)
 
-            if fdr_at_thresh is not None:
-                pthresh_fdrs.append((p_to_test, fdr_at_thresh))
+def _label_threshold(job: Tuple[np.ndarray, np.ndarray, float]) -> Tuple:
+    """
+    Find the p-value threshold for one label
 
-        # Create a DataFrame of p-value thresholds and associated FDRs
-        p_fdr_df = pd.DataFrame.from_records(pthresh_fdrs, columns=['p', 'fdr'])
+    Parameters
+    ----------
+    job
+        The sorted null p-values, the sorted alternative p-values and the target FDR
 
-        if len(p_fdr_df) > 0:
+    Returns
+    -------
+    p_thresh, fdr, num_null, num_null_lt_thresh, num_alt, num_alt_lt_thresh
+    """
+    wt_pvals, mut_pvals, target_threshold = job
 
-            p_under_target_fdr = p_fdr_df[p_fdr_df.fdr <= target_threshold]
+    # Every available p-value from the null + alternative distributions that is lower than 0.05 is a candidate
+    # threshold. The candidates are sorted so the largest passing threshold is the last one
+    all_p = np.sort(np.concatenate([wt_pvals, mut_pvals]))
+    all_p = all_p[all_p <= 0.05]
 
-            if len(p_under_target_fdr) < 1:
-                # No acceptable p-value threshold for this label. Choose minimum fdr.
-                lowest_fdr_row = p_fdr_df.loc[p_fdr_df['fdr'].idxmax()]
-                p_thresh = lowest_fdr_row['p']
-                best_fdr = lowest_fdr_row['fdr']
-            else:
-                row = p_fdr_df.loc[p_under_target_fdr.p.idxmax()]
-                p_thresh = row['p']
-                best_fdr = row['fdr']
+    # The number of p-values strictly under each candidate, as in fdr_calc
+    num_wt_under = np.searchsorted(wt_pvals, all_p, side='left')
+    num_mut_under = np.searchsorted(mut_pvals, all_p, side='left')
 
-            # Total number of paramerters across all lines that are below our p-value threshold
-            num_hits = len(mut_pvals[mut_pvals <= p_thresh])
+    # There is no FDR at thresholds with no mutants under them
+    has_mut = num_mut_under > 0
+    all_p = all_p[has_mut]
 
-            num_null = len(wt_pvals)
-            num_alt = len(mut_pvals)
+    if len(all_p) == 0:
+        return np.nan, 1, 'NA', 'NA', 'NA', 0
 
-            num_null_lt_thresh = len(wt_pvals[wt_pvals <= p_thresh])
-            # num_alt_lt_thresh = len(mut_pvals[mut_pvals <= p_thresh])
+    ratio_wt_under_thresh = num_wt_under[has_mut] / len(wt_pvals)
+    ratio_mut_under_threshold = num_mut_under[has_mut] / len(mut_pvals)
 
-        else:
-            best_fdr = 1
-            p_thresh = np.NAN
-            num_hits = 0
-            num_null, num_null_lt_thresh, num_alt = ['NA'] * 3
+    # If the null is skewed to the right, we might get FDR values greater than 1, which does not make sense
+    fdrs = np.clip(ratio_wt_under_thresh / ratio_mut_under_threshold, 0, 1)
 
+    under_target = np.flatnonzero(fdrs <= target_threshold)
 
-        # TODO: what about if the labels are not numbers
-        results.append([int(label), p_thresh, best_fdr,
-                        num_null, num_null_lt_thresh, num_alt, num_hits])
+    if len(under_target) < 1:
+        # No acceptable p-value threshold for this label. Choose the first threshold with the maximum fdr
+        best = np.argmax(fdrs)
+    else:
+        # The largest threshold that passes. Repeated p-values have the same FDR so any of them will do
+        best = under_target[-1]
 
-    header = ['label', 'p_thresh', 'fdr',
-              'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
+    p_thresh = all_p[best]
+    best_fdr = fdrs[best]
 
-    result_df = pd.DataFrame.from_records(results, columns=header, index='label')
-    result_df.sort_values(by='label', inplace=True)
+    # Total number of paramerters across all lines that are below our p-value threshold
+    num_hits = int(np.searchsorted(mut_pvals, p_thresh, side='right'))
+    num_null_lt_thresh = int(np.searchsorted(wt_pvals, p_thresh, side='right'))
 
-    return result_df
+    return p_thresh, best_fdr, len(wt_pvals), num_null_lt_thresh, len(mut_pvals), num_hits
 
 
 def fdr_calc(null_pvals, alt_pvals, thresh) -> float:
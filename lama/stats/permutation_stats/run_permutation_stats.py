@@ -323,7 +323,7 @@ def prepare_data(wt_organ_vol: pd.DataFrame,
 
 def run(wt_dir: Path, mut_dir: Path, out_dir: Path, num_perms: int,
         label_info: Path = None, label_map_path: Path = None, line_fdr: float=0.05, specimen_fdr: float=0.2,
-        normalise_to_whole_embryo:bool=True):
+        normalise_to_whole_embryo:bool=True, workers: int = 1, null_cache_dir: Path = None):
     """
     Run the permutation-based stats pipeline
 
@@ -350,6 +350,11 @@ def run(wt_dir: Path, mut_dir: Path, out_dir: Path, num_perms: int,
         the FDR threshold at which to accept specimen-level calls
     normalise_to_whole_embryo:
         Whether to divide the organ each organ volume by whole embryo volume
+    workers
+        The number of processes to fit the null and alternative distributions and find the thresholds with
+    null_cache_dir
+        Where to cache the null distributions so they can be reused by runs with the same baselines.
+        Defaults to out_dir/distributions/null_cache
     """
     # Collate all the staging and organ volume data into csvs
     np.random.seed(999)
@@ -383,7 +388,10 @@ def run(wt_dir: Path, mut_dir: Path, out_dir: Path, num_perms: int,
     dists_out.mkdir(exist_ok=True)
 
     # Get the null distributions
-    line_null, specimen_null, null_ids = distributions.null(data, num_perms)
+    if null_cache_dir is None:
+        null_cache_dir = dists_out / 'null_cache'
+
+    line_null, specimen_null, null_ids = distributions.null(data, num_perms, workers=workers, cache_dir=null_cache_dir)
 
     with open(dists_out / 'null_ids.yaml', 'w') as fh:
         yaml.dump(null_ids, fh)
@@ -396,7 +404,7 @@ def run(wt_dir: Path, mut_dir: Path, out_dir: Path, num_perms: int,
     specimen_null.to_csv(null_specimen_pvals_file)
 
     # Get the alternative distribution
-    line_alt, spec_alt = distributions.alternative(data)
+    line_alt, spec_alt = distributions.alternative(data, workers=workers)
 
     line_alt_pvals_file = dists_out / 'alt_line_dist_pvalues.csv'
     spec_alt_pvals_file = dists_out / 'alt_specimen_dist_pvalues.csv'
@@ -405,8 +413,8 @@ def run(wt_dir: Path, mut_dir: Path, out_dir: Path, num_perms: int,
     line_alt.to_csv(line_alt_pvals_file)
     spec_alt.to_csv(spec_alt_pvals_file)
 
-    line_organ_thresholds = p_thresholds.get_thresholds(line_null, line_alt)
-    specimen_organ_thresholds = p_thresholds.get_thresholds(specimen_null, spec_alt)
+    line_organ_thresholds = p_thresholds.get_thresholds(line_null, line_alt, workers=workers)
+    specimen_organ_thresholds = p_thresholds.get_thresholds(specimen_null, spec_alt, workers=workers)
 
     line_thresholds_path = dists_out / 'line_organ_p_thresholds.csv'
     spec_thresholds_path = dists_out / 'specimen_organ_p_thresholds.csv'
@@ -19,9 +19,9 @@ we might add normalisation etc to IntensityDataGetter
 loaded only once
 """
 from abc import ABC
+from collections import namedtuple
 from pathlib import Path
 from typing import Union, List, Iterator, Tuple, Iterable, Callable
-import math
 import tempfile
 
 import numpy as np
@@ -32,12 +32,21 @@ import toml
 
 from lama import common
 from lama.img_processing.misc import blur
+from lama.monitor_memory import PeakMemory
 from lama.paths import specimen_iterator
+from lama.stats.standard_stats.voxel_cache import VoxelMatrix, VoxelCache, DEFAULT_CACHE_MAX_GB, join_voxel_matrices
 
 
 GLCM_FILE_SUFFIX = '.npz'
 DEFAULT_FWHM = 100  # um
 DEFAULT_VOXEL_SIZE = 14.0
+DEFAULT_LOAD_WORKERS = 4
+LOAD_MEMORY_FRACTION = 0.5  # Fraction of the free memory that volumes being loaded at once can use
+LOAD_BYTES_PER_VOXEL = 16  # A float32 volume is held up to 4 times while it's read, blurred and masked
+
+
+# The baseline data shared by all the lines. vols is the list of baseline data arrays from DataLoader._read
+Baselines = namedtuple('Baselines', ['paths', 'staging', 'vols'])
 
 
 class LineData:
@@ -54,7 +63,10 @@ class LineData:
                  mask: np.ndarray = None,
                  outdirs = None,
                  cluster_data = None,
-                 normalise: Callable = None):
+                 normalise: Callable = None,
+                 data_matrices: List[np.ndarray] = None,
+                 chunk_size: int = None,
+                 memory_budget: float = None):
         """
         Holds the input data to be used in the stats tests
         Parameters
@@ -80,6 +92,14 @@ class LineData:
             The input paths used to generate the data
             [0] Wildtype
             [1] mutants
+        data_matrices
+            Optional voxel-major (voxels * specimens) matrices whose columns are the rows of data, in order. If given,
+            they are joined into one matrix when the chunks are first asked for, and each chunk is a transposed slice
+            (a view) of it (see voxel_cache)
+        chunk_size
+            Fixed number of data points in each chunk. If None, the chunks are sized by memory (see ChunkPlanner)
+        memory_budget
+            The memory in bytes to use for fitting each chunk. If None, half the available memory
 
         """
         self.data = data
@@ -90,6 +110,10 @@ class LineData:
         self.outdirs = None
         self.size = np.prod(shape)
         self.mask = mask
+        self.data_matrices = data_matrices
+        self._data_matrix = None  # The joined data_matrices
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
 
         if len(data) != len(info):
             raise ValueError
@@ -103,95 +127,163 @@ class LineData:
     def genotypes(self):
         return self.info.genotype
 
-    def get_num_chunks(self, log: bool=False):
+    def chunk_planner(self) -> 'ChunkPlanner':
         """
-        Using the size of the data set and the available memory, get the number of chunks needed to analyse the data
-        without maxing out the memory.
-
-        The overhead is quite large
-            First the data is written to a binary file for R to read in
-            Then there is the data (pvalues and t-statistics) output by R into another binary file
-            Plus any overhead R encounters when fitting the linear models
-
-        Currently The overhead factor is set to 100X the size of the data being analysed
-
-        Parameters
-        ----------
-        log: Whether to log data size information
-
-        Returns
-        -------
-
+        Get a ChunkPlanner for the data of this line using the chunk_size or memory_budget if given
         """
-
-        overhead_factor = 100
-        # debug
-        bytes_free = common.available_memory()
-        num_samples = len(self.data)
-
         try:
             self.data.shape
         except AttributeError:  # List of numpy arrays
             dtype_size = self.data[0].dtype.itemsize
-            num_voxels = self.data[0].size
+            num_points = self.data[0].size
         else:  # Dataframes
-            num_voxels = self.data.shape[1]
+            num_points = self.data.shape[1]
             dtype_size = self.data.values.dtype.itemsize
 
-        data_size = dtype_size * num_samples * num_voxels
-
-        num_chunks = math.ceil((data_size * overhead_factor) / bytes_free)
-
-        if log:
-            logging.info(f'\nAvailable memory: {round(bytes_free / (1024 **3), 3)} GB\nSize of raw data: {round(data_size / (1024**3), 3)} GB')
-
-        if num_chunks > 1:
-            return num_chunks
-        else:
-
-            return 1
+        return ChunkPlanner(num_points, dtype_size * len(self.data), self.chunk_size, self.memory_budget)
 
     def chunks(self) -> Iterator[np.ndarray]:
         """
         Return chunks of the data.
 
+        The chunk sizes are chosen by a ChunkPlanner, which measures the memory used while each chunk is being fitted.
+        So the next chunk is not made until the work on the last one has finished
+
         Yields
         -------
         Chunks split column-wise (axis=1)
 
         Notes
         -----
-        np.array_split returns a view on the data not a copy
-
-        # TODO: Allow chunk size to be set via config
         # TODO: Organ vol self.data is a Dataframe voxeld ata is list of arrays. Should standardise this
         """
-        num_chunks = self.get_num_chunks()
+        planner = self.chunk_planner()
+
+        if self.data_matrices and self._data_matrix is None:
+            # Copy the baselines and mutants into one matrix once, rather than joining them for every chunk
+            self._data_matrix = join_voxel_matrices(self.data_matrices).matrix
+
+        i = 0
+        chunk_num = 1
+
+        while i < planner.num_points:
+            chunk_size = planner.next_chunk_size(planner.num_points - i)
+            logging.info(f'Chunk {chunk_num}: data points {i}-{i + chunk_size} of {planner.num_points}')
+
+            with PeakMemory() as memory:
+                yield self._chunk(i, chunk_size)
+
+            planner.record(chunk_size, memory.increase)
+            i += chunk_size
+            chunk_num += 1
+
+    def _chunk(self, i: int, chunk_size: int) -> np.ndarray:
+        if self._data_matrix is not None:
+            # A view on the voxel-major matrix of all the line's specimens, so nothing is copied
+            return self._data_matrix[i: i + chunk_size].T
 
         try:
             self.data.shape
         except AttributeError:
-            specimen_size = len(self.data[0])
+            return np.array([x[i: i + chunk_size] for x in self.data])
         else:
-            specimen_size = self.data.shape[1]
-
-        chunk_size = math.ceil(specimen_size/ num_chunks)
-
-        for i in range(0, specimen_size, chunk_size):
-            try:
-                self.data.shape
-            except AttributeError:
-                chunk = np.array([x[i: i + chunk_size] for x in self.data])
-            else:
-                chunk = np.array([x[i: i + chunk_size] for _, x in self.data.iterrows()])
-
-            yield chunk
+            return np.array([x[i: i + chunk_size] for _, x in self.data.iterrows()])
 
     @property  # delete
     def mask_size(self) -> int:
         return self.mask[self.mask == 1].size
 
 
+class ChunkPlanner:
+    """
+    Choose the number of data points in each chunk of a line's data so that fitting a chunk uses about memory_budget
+    bytes.
+
+    The memory needed to fit a chunk depends on the stats engine (R makes several copies of the data, the NumPy engine
+    only a few), so it's measured rather than guessed. The first chunk is sized assuming FIRST_CHUNK_OVERHEAD times the
+    size of its data is needed. The peak RSS increase of this process and its children (R) while the first chunk is
+    fitted gives the memory per data point, and the later chunks are sized from that. A chunk can be at most MAX_GROWTH
+    times the size of the one before, as the first chunk is small and a larger one may behave differently.
+
+    Only the first chunk is measured. Memory freed by NumPy is usually kept by the process rather than returned to the
+    OS, so the RSS increase for later chunks, measured from an RSS that already includes it, under-reports their use.
+
+    If chunk_size is given every chunk is that size.
+    """
+    FIRST_CHUNK_OVERHEAD = 100
+    MIN_OVERHEAD = 2  # Don't trust a measurement below this multiple of the data size. The RSS is only sampled
+    MEMORY_FRACTION = 0.5  # Default memory budget as a fraction of the available memory
+    MIN_CHUNK_SIZE = 1000
+    MAX_GROWTH = 4
+
+    def __init__(self, num_points: int, bytes_per_point: int, chunk_size: int = None, memory_budget: float = None):
+        """
+        Parameters
+        ----------
+        num_points
+            The number of data points (voxels, organs) to split into chunks
+        bytes_per_point
+            The size of the data for one data point (all specimens)
+        chunk_size
+            Fixed number of data points per chunk
+        memory_budget
+            The memory in bytes to use for fitting a chunk. Defaults to MEMORY_FRACTION of the available memory
+        """
+        self.num_points = num_points
+        self.bytes_per_point = bytes_per_point
+        self.fixed_chunk_size = int(chunk_size) if chunk_size else None
+
+        if memory_budget is None:
+            memory_budget = common.available_memory() * self.MEMORY_FRACTION
+        self.memory_budget = memory_budget
+
+        self.memory_per_point = bytes_per_point * self.FIRST_CHUNK_OVERHEAD
+        self.measured = False
+        self.last_chunk_size = None
+
+        if chunk_size:
+            logging.info(f'Chunk plan: fixed chunk size of {chunk_size} data points')
+        else:
+            logging.info(f'Chunk plan: memory budget {round(memory_budget / 1024 ** 3, 3)} GB. '
+                         f'Size of data: {round(bytes_per_point * num_points / 1024 ** 3, 3)} GB. '
+                         f'First chunk assumes {self.FIRST_CHUNK_OVERHEAD}X the data size is needed')
+
+    def next_chunk_size(self, remaining: int) -> int:
+        """
+        Get the size of the next chunk, given the number of data points still to do
+        """
+        if self.fixed_chunk_size:
+            return min(self.fixed_chunk_size, remaining)
+
+        chunk_size = max(self.MIN_CHUNK_SIZE, int(self.memory_budget // self.memory_per_point))
+        if self.last_chunk_size:
+            chunk_size = min(chunk_size, self.last_chunk_size * self.MAX_GROWTH)
+        return min(chunk_size, remaining)
+
+    def record(self, chunk_size: int, memory_increase: int):
+        """
+        Record the peak memory increase measured while fitting a chunk, and resize the later chunks
+        """
+        if self.fixed_chunk_size:
+            return
+
+        self.last_chunk_size = chunk_size
+
+        if self.measured:
+            # The RSS increase under-reports after the first chunk (see the class docstring), so keep the first
+            # measurement. It's an upper bound, as the fixed costs of fitting are spread over only a small chunk
+            return
+
+        measured = max(memory_increase / chunk_size, self.bytes_per_point * self.MIN_OVERHEAD)
+        self.memory_per_point = measured
+        self.measured = True
+
+        next_size = self.next_chunk_size(self.num_points)
+        logging.info(f'Chunk plan: measured {round(memory_increase / 1024 ** 2, 1)} MB for {chunk_size} data points '
+                     f'({round(measured / self.bytes_per_point, 1)}X the data size). '
+                     f'Next chunks: {next_size} data points')
+
+
 class DataLoader:
     """
     Base class for loading in data
@@ -209,7 +301,8 @@ class DataLoader:
                  lines_to_process: Union[List, None] = None,
                  baseline_file: Union[str, None] = None,
                  mutant_file: Union[str, None] = None,
-                 memmap: bool = False):
+                 memmap: bool = False,
+                 cache_dir: Path = None):
         """
 
         Parameters
@@ -223,6 +316,8 @@ class DataLoader:
         baseline_file
             Path to csv containing baseline ids to use.
             If None, use all baselines
+        cache_dir
+            If given, cache the blurred and masked voxel data here (see voxel_cache)
         """
         self.norm_to_mask_volume_on = False
 
@@ -254,6 +349,13 @@ class DataLoader:
         self.blur_fwhm = config.get('blur', DEFAULT_FWHM)
         self.voxel_size = config.get('voxel_size', DEFAULT_VOXEL_SIZE)
         self.memmap = memmap
+        self.cache_dir = cache_dir
+        self.voxel_cache = None
+
+        self.chunk_size = config.get('chunk_size')
+        self.memory_budget = config.get('memory_budget_gb')
+        if self.memory_budget is not None:
+            self.memory_budget *= 1024 ** 3
 
     @staticmethod
     def factory(type_: str):
@@ -353,6 +455,18 @@ class DataLoader:
         -------
         LineData
         """
+        baselines = self.load_baselines()
+
+        # Iterate over the lines
+        logging.info('loading mutant data')
+
+        for line, mut_df in self.mutant_lines():
+            yield self.line_data(line, mut_df, baselines)
+
+    def load_baselines(self) -> Baselines:
+        """
+        Read in and normalise the baseline data that is shared by all the lines
+        """
         wt_metadata = self._get_metadata(self.wt_dir)
         wt_paths = list(wt_metadata['data_path'])
 
@@ -362,6 +476,10 @@ class DataLoader:
         if self.baseline_ids:
             wt_paths, wt_staging = self.filter_specimens(self.baseline_ids, wt_paths, wt_staging)
 
+        # Id there is a value column, change to staging. TODO: make lama spitout staging header instead of value
+        if 'value' in wt_staging:
+            wt_staging.rename(columns={'value': 'staging'}, inplace=True)
+
         logging.info('loading baseline data')
         wt_vols = self._read(wt_paths)
 
@@ -373,51 +491,70 @@ class DataLoader:
             # <-bodge
             self.normaliser.normalise(wt_vols)
 
-        # Make a 2D array of the WT data
-        masked_wt_data = [x.ravel() for x in wt_vols]
+        return Baselines(wt_paths, wt_staging, wt_vols)
 
+    def mutant_lines(self) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """
+        Yields
+        ------
+        The line id and the metadata of the mutants of each line to process
+        """
         mut_metadata = self._get_metadata(self.mut_dir, self.lines_to_process)
+        yield from mut_metadata.groupby('line')
 
-        # Iterate over the lines
-        logging.info('loading mutant data')
+    def line_data(self, line: str, mut_df: pd.DataFrame, baselines: Baselines) -> LineData:
+        """
+        Read in the mutants of a line and join them with the baselines
 
-        mut_gb = mut_metadata.groupby('line')
+        Parameters
+        ----------
+        line
+            The line id
+        mut_df
+            The metadata of the line's mutants from mutant_lines
+        baselines
+            From load_baselines
+        """
+        wt_paths, wt_staging, wt_vols = baselines
 
-        for line, mut_df in mut_gb:
+        # Make a 2D array of the WT data. reshape rather than ravel so cached (strided) data is not copied
+        masked_wt_data = [x.reshape(-1) for x in wt_vols]
 
-            # Make dataframe of specimen_id, genotype, staging
-            mut_staging = get_staging_data(self.mut_dir, line=line)
-            mut_staging['genotype'] = 'mutant'
+        # Make dataframe of specimen_id, genotype, staging
+        mut_staging = get_staging_data(self.mut_dir, line=line)
+        mut_staging['genotype'] = 'mutant'
 
-            mut_paths = list(mut_df['data_path'])
+        mut_paths = list(mut_df['data_path'])
 
-            if self.mutant_ids:
-                # Check if current line has a specimen list to use
-                ids = self.mutant_ids.get(line)
-                if ids:
-                    mut_paths, mut_staging = self.filter_specimens(self.mutant_ids[line], mut_paths, mut_staging)
+        if self.mutant_ids:
+            # Check if current line has a specimen list to use
+            ids = self.mutant_ids.get(line)
+            if ids:
+                mut_paths, mut_staging = self.filter_specimens(self.mutant_ids[line], mut_paths, mut_staging)
 
-            mut_vols = self._read(mut_paths)
+        mut_vols = self._read(mut_paths)
 
-            if self.normaliser:
-                self.normaliser.normalise(mut_vols)
-            masked_mut_data = [x.ravel() for x in mut_vols]
+        if self.normaliser:
+            self.normaliser.normalise(mut_vols)
+        masked_mut_data = [x.reshape(-1) for x in mut_vols]
 
-            staging = pd.concat((wt_staging, mut_staging))
-            # Id there is a value column, change to staging. TODO: make lama spitout staging header instead of value
-            if 'value' in staging:
-                staging.rename(columns={'value': 'staging'}, inplace=True)
+        if 'value' in mut_staging:
+            mut_staging.rename(columns={'value': 'staging'}, inplace=True)
+        staging = pd.concat((wt_staging, mut_staging))
 
-            # data = np.vstack((masked_wt_data, masked_mut_data)) # This almost doubled memory usage.
-            # Stick all arrays in a list instead
-            data = masked_wt_data[:]
-            data.extend(masked_mut_data)
+        # data = np.vstack((masked_wt_data, masked_mut_data)) # This almost doubled memory usage.
+        # Stick all arrays in a list instead
+        data = masked_wt_data
+        data.extend(masked_mut_data)
 
+        # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
 
-            # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
+        data_matrices = None
+        if isinstance(wt_vols, VoxelMatrix) and isinstance(mut_vols, VoxelMatrix):
+            data_matrices = [wt_vols.matrix, mut_vols.matrix]
 
-            input_ = LineData(data, staging, line, self.shape, (wt_paths, mut_paths), self.mask)
-            yield input_
+        return LineData(data, staging, line, self.shape, (wt_paths, mut_paths), self.mask,
+                        data_matrices=data_matrices, chunk_size=self.chunk_size, memory_budget=self.memory_budget)
 
 
 class VoxelDataLoader(DataLoader):
@@ -438,6 +575,7 @@ class VoxelDataLoader(DataLoader):
         - mask
         - Unravel
 
+        Up to load_workers volumes are loaded at once in threads. The order of paths is kept
 
         Parameters
         ----------
@@ -447,20 +585,18 @@ class VoxelDataLoader(DataLoader):
         Returns
         -------
         List of numpy arrays of blurred, masked, and raveled data
+        If there is a cache_dir, a VoxelMatrix backed by the cached data
         """
+        if self.cache_dir is not None:
+            self.shape = self.mask.shape
+            if self.voxel_cache is None:
+                self.voxel_cache = VoxelCache(self.cache_dir, self.mask, self.blur_fwhm, self.voxel_size,
+                                              self.config.get('voxel_cache_max_gb', DEFAULT_CACHE_MAX_GB))
+            return self.voxel_cache.matrix(paths, self._load, self._load_workers())
 
         images = []
 
-        for data_path in paths:
-            logging.info(f'loading data: {data_path.name}')
-            loader = common.LoadImage(data_path)
-
-            if not self.shape:
-                self.shape = loader.array.shape
-
-            blurred_array = blur(loader.array, self.blur_fwhm, self.voxel_size)
-            masked = blurred_array[self.mask != False]
-
+        for masked in common.prefetch(self._load, paths, self._load_workers()):
             if self.memmap:
                 t = tempfile.TemporaryFile()
                 m = np.memmap(t, dtype=masked.dtype, mode='w+', shape=masked.shape)
@@ -471,6 +607,35 @@ class VoxelDataLoader(DataLoader):
 
         return images
 
+    def _load(self, data_path: Path) -> np.ndarray:
+        """
+        Read a volume, blur, mask and unravel it
+        """
+        logging.info(f'loading data: {data_path.name}')
+        array = common.LoadImage(data_path).array
+
+        if not self.shape:
+            self.shape = array.shape
+
+        blurred_array = blur(array, self.blur_fwhm, self.voxel_size)
+        return blurred_array[self.mask != False]
+
+    def _load_workers(self) -> int:
+        """
+        Get the number of volumes to load at once. This is the load_workers config option, reduced if that many
+        volumes would not fit in the free memory
+        """
+        workers = self.config.get('load_workers', DEFAULT_LOAD_WORKERS)
+
+        volume_bytes = self.mask.size * LOAD_BYTES_PER_VOXEL
+        fit = max(1, int(common.available_memory() * LOAD_MEMORY_FRACTION // volume_bytes))
+
+        if fit < workers:
+            logging.info(f'Only loading {fit} volumes at once as there is not enough free memory for {workers}')
+            workers = fit
+
+        return workers
+
     def _get_data_file_path(self):
         """
         Return the path to the data for a specimen
@@ -647,7 +812,8 @@ class OrganVolumeDataGetter(DataLoader, ABC):
             if self.norm_to_mask_volume_on:
                 logging.info('normalising organ volume to whole embryo volumes')
                 data = data.div(staging['staging'], axis=0)
-            input_ = LineData(data, staging, line, self.shape, ([self.wt_dir], [self.mut_dir]))
+            input_ = LineData(data, staging, line, self.shape, ([self.wt_dir], [self.mut_dir]),
+                              chunk_size=self.chunk_size, memory_budget=self.memory_budget)
             yield input_
 
     def get_metadata(self):
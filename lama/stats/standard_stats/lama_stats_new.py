@@ -10,20 +10,29 @@ To do 060819
 
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Union, List
+from typing import Union, List, Dict, Tuple
 
 from logzero import logger as logging
 import logzero
+import numpy as np
+import pandas as pd
 
 from lama.common import cfg_load
-from lama.stats.standard_stats.stats_objects import Stats
-from lama.stats.standard_stats.data_loaders import DataLoader, load_mask, LineData
+from lama.stats.standard_stats.stats_objects import Stats, baseline_stats
+from lama.stats.standard_stats.data_loaders import DataLoader, VoxelDataLoader, load_mask, LineData, Baselines, \
+    ChunkPlanner
+from lama.stats.standard_stats.voxel_cache import VoxelMatrix
 from lama.stats.standard_stats.results_writer import ResultsWriter
 from lama import common
 from lama.stats import linear_model
 from lama.elastix.invert_volumes import InvertHeatmap
 from lama.img_processing.normalise import Normaliser
+from lama.img_processing.crop import find_crop_box, crop_array
+
+SHARED_COPY_BLOCK_SIZE = 2 ** 18  # Number of voxels to copy into the shared baseline matrix at once
 
 
 def run(config_path: Path,
@@ -81,6 +90,15 @@ def run(config_path: Path,
     label_map_file = target_dir / stats_config.get('label_map')
     label_map = common.LoadImage(label_map_file).array
 
+    # If the registrations were done on a cropped target, the data will be in the cropped frame
+    crop_box = find_crop_box(wt_dir)
+    if crop_box != find_crop_box(mut_dir):
+        raise common.LamaDataException('The baselines and mutants were registered with different crop boxes')
+    if crop_box:
+        logging.info(f"Registrations were cropped. Cropping mask and label map to {crop_box['size']}")
+        mask = crop_array(mask, crop_box)
+        label_map = crop_array(label_map, crop_box)
+
     memmap = stats_config.get('label_map')
     if memmap:
         logging.info('Memory mapping input data')
@@ -93,6 +111,10 @@ def run(config_path: Path,
     if mutant_file:
         mutant_file = config_path.parent / mutant_file
 
+    voxel_cache_dir = stats_config.get('voxel_cache')
+    if voxel_cache_dir:
+        voxel_cache_dir = config_path.parent / voxel_cache_dir
+
     # Run each data class through the pipeline.
     for stats_type in stats_config['stats_types']:
 
@@ -102,7 +124,8 @@ def run(config_path: Path,
         loader_class = DataLoader.factory(stats_type)
 
         loader = loader_class(wt_dir, mut_dir, mask, stats_config, label_info_file, lines_to_process=lines_to_process,
-                              baseline_file=baseline_file, mutant_file=mutant_file, memmap=memmap)
+                              baseline_file=baseline_file, mutant_file=mutant_file, memmap=memmap,
+                              cache_dir=voxel_cache_dir)
 
         if stats_config.get('normalise_organ_vol_to_mask') and hasattr(loader, 'norm_organ_vols_to_mask'):
             loader.norm_organ_vols_to_mask()
@@ -110,45 +133,167 @@ def run(config_path: Path,
         # Currently only the intensity stats get normalised
         loader.normaliser = Normaliser.factory(stats_config.get('normalise'), stats_type)  # move this into subclass
 
-        for line_input_data in loader.line_iterator():  # NOTE: This might be where we could parallelize
+        line_kwargs = dict(stats_type=stats_type, stats_config=stats_config, mask=mask, out_dir=out_dir,
+                           mut_dir=mut_dir, label_map=label_map, label_info_file=label_info_file, crop_box=crop_box)
+
+        line_workers = stats_config.get('line_workers', 1)
+
+        if line_workers > 1 and isinstance(loader, VoxelDataLoader):
+            _run_lines_parallel(loader, line_workers, line_kwargs)
+        else:
+            # The baselines are the same for each line, so their sums can be found once and shared by the lines
+            shared_baseline_stats = None
+
+            for line_input_data in loader.line_iterator():
+                if stats_config.get('shared_baseline') and shared_baseline_stats is None:
+                    shared_baseline_stats = baseline_stats(line_input_data)
+
+                _process_line(line_input_data, shared_baseline_stats, **line_kwargs)
+
+
+def _process_line(line_input_data: LineData,
+                  shared_baseline_stats: Union[linear_model.BaselineStats, None],
+                  stats_type: str,
+                  stats_config: Dict,
+                  mask: np.ndarray,
+                  out_dir: Path,
+                  mut_dir: Path,
+                  label_map: np.ndarray,
+                  label_info_file: Path,
+                  crop_box: Union[Dict, None]):
+    """
+    Run the stats on a line and write the results. The log for the line is written to its stats output folder
+    """
+    line_id = line_input_data.line
+
+    line_stats_out_dir = out_dir / line_id / stats_type
+
+    line_stats_out_dir.mkdir(parents=True, exist_ok=True)
+    line_log_file = line_stats_out_dir / f'{common.date_dhm()}_stats.log'
+    logzero.logfile(str(line_log_file))
+
+    logging.info(f"Processing line: {line_id}")
+
+    stats_class = Stats.factory(stats_type)
+    stats_obj = stats_class(line_input_data, stats_type, stats_config.get('use_staging', True))
+
+    stats_obj.stats_runner = linear_model.LM_ENGINES[stats_config.get('lm_engine', 'R')]
+
+    if shared_baseline_stats is not None:
+        stats_obj.baseline_stats = shared_baseline_stats
+
+    stats_obj.run_stats()
+
+    logging.info('statistical analysis finished. Writing results.')
+
+    rw = ResultsWriter.factory(stats_type)
+    writer = rw(stats_obj, mask, line_stats_out_dir, stats_type, label_map, label_info_file, crop_box=crop_box)
+
+    #
+    # if stats_type == 'organ_volumes':
+    #     c_data = {spec: data['t'] for spec, data in stats_obj.specimen_results.items()}
+    #     c_df = pd.DataFrame.from_dict(c_data)
+    #     # cluster_plots.tsne_on_raw_data(c_df, line_stats_out_dir)
+
+    if stats_config.get('invert_stats'):
+        if writer.line_heatmap:  # Organ vols wil not have this
+            # How do I now sensibily get the path to the invert.yaml
+            # get the invert_configs for each specimen in the line
+            logging.info('Propogating the heatmaps back onto the input images ')
+            line_heatmap = writer.line_heatmap
+            line_reg_dir = mut_dir / 'output' / line_id
+            invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data)
+
+    logging.info('All done')
+
+
+def _run_lines_parallel(loader: VoxelDataLoader, workers: int, line_kwargs: Dict):
+    """
+    Process the lines in a pool of worker processes.
+
+    The baselines are read once, into a voxel-major (masked voxels * baselines) matrix in shared memory. Each worker
+    attaches to it, then reads the mutants of its lines, runs the stats and writes the results.
+
+    Parameters
+    ----------
+    loader
+        The data loader for this stats type
+    workers
+        The number of lines to process at once
+    line_kwargs
+        Passed on to _process_line
+    """
+    baselines = loader.load_baselines()
+
+    # Each worker fits its chunks at the same time, so they share the memory budget
+    if loader.chunk_size is None and loader.memory_budget is None:
+        loader.memory_budget = common.available_memory() * ChunkPlanner.MEMORY_FRACTION / workers
+
+    num_voxels = baselines.vols[0].size
+    dtype = baselines.vols[0].dtype
+    shape = (num_voxels, len(baselines.vols))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, num_voxels * len(baselines.vols) * dtype.itemsize))
+
+    try:
+        shared_wt = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        for start in range(0, num_voxels, SHARED_COPY_BLOCK_SIZE):
+            end = start + SHARED_COPY_BLOCK_SIZE
+            shared_wt[start: end] = np.column_stack([x.reshape(-1)[start: end] for x in baselines.vols])
+
+        baselines = baselines._replace(vols=VoxelMatrix(shared_wt))
+
+        shared_baseline_stats = None
+        if line_kwargs['stats_config'].get('shared_baseline'):
+            logging.info(f'Getting the shared statistics for {shape[1]} baselines')
+            shared_baseline_stats = linear_model.BaselineStats(list(baselines.vols),
+                                                               baselines.staging.staging.values,
+                                                               ids=baselines.staging.index)
+
+        # Each worker makes its own cache index. It also holds a lock, which can't be sent to the workers
+        loader.voxel_cache = None
 
-            line_id = line_input_data.line
+        lines = list(loader.mutant_lines())
+        logging.info(f'Processing {len(lines)} lines with {workers} workers')
 
-            line_stats_out_dir = out_dir / line_id / stats_type
+        init_args = (loader, shm.name, shape, dtype, baselines._replace(vols=None), shared_baseline_stats,
+                     line_kwargs)
 
-            line_stats_out_dir.mkdir(parents=True, exist_ok=True)
-            line_log_file = line_stats_out_dir / f'{common.date_dhm()}_stats.log'
-            logzero.logfile(str(line_log_file))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_line_worker, initargs=init_args) as executor:
+            futures = {executor.submit(_process_line_in_worker, line, mut_df): line for line, mut_df in lines}
 
-            logging.info(f"Processing line: {line_id}")
+            for future in as_completed(futures):
+                future.result()
+                logging.info(f'Finished line: {futures[future]}')
+    finally:
+        # The shared memory can only be closed once there are no arrays using it
+        baselines = shared_wt = None
+        shm.close()
+        shm.unlink()
 
-            stats_class = Stats.factory(stats_type)
-            stats_obj = stats_class(line_input_data, stats_type, stats_config.get('use_staging', True))
 
-            stats_obj.stats_runner = linear_model.lm_r
-            stats_obj.run_stats()
+# The state of a line worker process, set by _init_line_worker
+_line_worker = {}
 
-            logging.info('statistical analysis finished. Writing results.')
 
-            rw = ResultsWriter.factory(stats_type)
-            writer = rw(stats_obj, mask, line_stats_out_dir, stats_type, label_map, label_info_file)
+def _init_line_worker(loader: VoxelDataLoader, shm_name: str, shape: Tuple[int, int], dtype: np.dtype,
+                      baselines: Baselines, shared_baseline_stats: Union[linear_model.BaselineStats, None],
+                      line_kwargs: Dict):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shared_wt = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
 
-            #
-            # if stats_type == 'organ_volumes':
-            #     c_data = {spec: data['t'] for spec, data in stats_obj.specimen_results.items()}
-            #     c_df = pd.DataFrame.from_dict(c_data)
-            #     # cluster_plots.tsne_on_raw_data(c_df, line_stats_out_dir)
+    _line_worker['shm'] = shm  # Keep the shared memory attached for the life of the worker
+    _line_worker['loader'] = loader
+    _line_worker['baselines'] = baselines._replace(vols=VoxelMatrix(shared_wt))
+    _line_worker['shared_baseline_stats'] = shared_baseline_stats
+    _line_worker['line_kwargs'] = line_kwargs
 
-            if stats_config.get('invert_stats'):
-                if writer.line_heatmap:  # Organ vols wil not have this
-                    # How do I now sensibily get the path to the invert.yaml
-                    # get the invert_configs for each specimen in the line
-                    logging.info('Propogating the heatmaps back onto the input images ')
-                    line_heatmap = writer.line_heatmap
-                    line_reg_dir = mut_dir / 'output' / line_id
-                    invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data)
 
-            logging.info('All done')
+def _process_line_in_worker(line: str, mut_df: pd.DataFrame):
+    loader = _line_worker['loader']
+    line_input_data = loader.line_data(line, mut_df, _line_worker['baselines'])
+    _process_line(line_input_data, _line_worker['shared_baseline_stats'], **_line_worker['line_kwargs'])
 
 
 def invert_heatmaps(heatmap: Path,
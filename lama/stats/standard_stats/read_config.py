@@ -50,6 +50,16 @@ def validate(config: Dict):
         if wrong:
             raise ValueError(f'{key} should be a number with min {min} and max {max}')
 
+    def int_(n, min=None):
+        if not isinstance(n, numbers.Integral) or isinstance(n, bool):
+            raise ValueError(f'{key} must be a whole number')
+        if min is not None and n < min:
+            raise ValueError(f'{key} should be a whole number with min {min}')
+
+    def str_(s):
+        if not isinstance(s, str):
+            raise ValueError(f'{key} must be a string')
+
     def bool_(b):
         return isinstance(b, bool)
 
@@ -112,6 +122,38 @@ def validate(config: Dict):
         'normalise_organ_vol_to_mask': {
             'required': False,
             'validate' : [bool_]
+        },
+        'lm_engine': {
+            'required': False,
+            'validate': [options, ['R', 'numpy']]  # numpy fits the linear models without R
+        },
+        'shared_baseline': {
+            'required': False,
+            'validate': [bool_]  # Find the baseline sums once and fit each line from its mutants. Does not use R
+        },
+        'voxel_cache': {
+            'required': False,
+            'validate': [str_]  # Folder to cache the blurred, masked voxel data in
+        },
+        'voxel_cache_max_gb': {
+            'required': False,
+            'validate': (num, 0)  # Size limit of the voxel cache in GB. Least recently used files are deleted
+        },
+        'load_workers': {
+            'required': False,
+            'validate': (int_, 1)  # Number of volumes to read and blur at once
+        },
+        'chunk_size': {
+            'required': False,
+            'validate': (int_, 1)  # Fixed number of data points to fit at once. Default: sized by measured memory
+        },
+        'memory_budget_gb': {
+            'required': False,
+            'validate': (num, 0)  # Memory to use for fitting each chunk. Default: half the available memory
+        },
+        'line_workers': {
+            'required': False,
+            'validate': (int_, 1)  # Number of lines to process at once in separate processes (voxel data only)
         }
 
 
@@ -10,7 +10,7 @@ Currently just the *_write* method is overridden in subclasses
 """
 
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, Dict
 
 import logzero
 from logzero import logger as logging
@@ -20,6 +20,7 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 
 from lama.common import write_array
+from lama.img_processing.crop import uncrop_array
 from lama.stats.standard_stats.stats_objects import Stats
 
 MINMAX_TSCORE = 50
@@ -37,7 +38,8 @@ class ResultsWriter:
                  out_dir: Path,
                  stats_name: str,
                  label_map: np.ndarray,
-                 label_info_path: Path):
+                 label_info_path: Path,
+                 crop_box: Dict = None):
         """
         TODO: map organ names back onto results
         Parameters
@@ -54,6 +56,9 @@ class ResultsWriter:
             for creating filtered labelmap overlays
         label_info_path
             Label map information
+        crop_box
+            If the data was registered to a cropped target, the crop box (see img_processing.crop).
+            Heatmaps are put back into the original target frame
 
         Returns
         -------
@@ -61,6 +66,7 @@ class ResultsWriter:
         """
         self.label_info_path = label_info_path
         self.label_map = label_map
+        self.crop_box = crop_box
         self.out_dir = out_dir
         self.results = results
         self.mask = mask
@@ -112,7 +118,7 @@ class ResultsWriter:
 
 
 class VoxelWriter(ResultsWriter):
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         """
          Write the line and specimen-level results.
 
@@ -131,13 +137,17 @@ class VoxelWriter(ResultsWriter):
              Not currently used
          """
         self.line_heatmap = None
-        super().__init__(*args)
+        super().__init__(*args, **kwargs)
 
     def _write(self, t_stats, pvals, qvals, outdir, name):
         filtered_tstats = result_cutoff_filter(t_stats, qvals)
         filtered_result = self.rebuild_array(filtered_tstats, self.shape, self.mask)
         unfiltered_result = self.rebuild_array(t_stats, self.shape, self.mask)
 
+        if self.crop_box:
+            filtered_result = uncrop_array(filtered_result, self.crop_box)
+            unfiltered_result = uncrop_array(unfiltered_result, self.crop_box)
+
         heatmap_path = outdir / f'{name}_{self.stats_name}_t_fdr5.nrrd'
         heatmap_path_unfiltered = outdir / f'{name}_{self.stats_name}_t.nrrd'
 
@@ -180,8 +190,8 @@ class VoxelWriter(ResultsWriter):
 
 
 class OrganVolumeWriter(ResultsWriter):
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.line_heatmap = None
 
         # Expose the results for clustering
@@ -8,10 +8,6 @@ I thought that each data type might need it's own subclass, however the differen
 """
 
 from collections import defaultdict
-import subprocess as sub
-import tempfile
-import os
-from pathlib import Path
 
 import numpy as np
 import addict
@@ -19,10 +15,9 @@ from logzero import logger as logging
 import pandas as pd
 
 
-from lama import common
 from lama.stats.standard_stats.data_loaders import LineData
-
-RSCRIPT_FDR = common.lama_root_dir / 'stats' / 'rscripts' / 'r_padjust.R'
+from lama.stats.multiple_testing import fdr
+from lama.stats.linear_model import BaselineStats
 
 
 class Stats:
@@ -49,6 +44,9 @@ class Stats:
         self.stats_runner = None
         self.use_staging = use_staging
 
+        # If set (linear_model.BaselineStats), the line is fitted from its mutants and the shared baseline statistics
+        self.baseline_stats = None
+
         # The final results will be stored in these attributes
         self.line_qvals = None
         self.line_pvalues = None
@@ -79,18 +77,12 @@ class Stats:
         specimen_pvals = defaultdict(list)
         specimen_tstats = defaultdict(list)
 
-        info = self.input_.info
-
-        num_chunks = self.input_.get_num_chunks(log=True)
-
-        for i, data_chunk in enumerate(self.input_.chunks()):
-            # Chunk the data and send sequentially to R to not use all the memory
-
-            logging.info(f'Chunk {i + 1}/{num_chunks}')
-
-            current_chunk_size = data_chunk.shape[1]  # Final chunk may not be same size
+        if self.baseline_stats is not None:
+            fitted_chunks = [self._fit_from_baseline_stats()]
+        else:
+            fitted_chunks = self._fit_chunks()
 
-            p_all, t_all = self.stats_runner(data_chunk, info, use_staging=self.use_staging)
+        for current_chunk_size, p_all, t_all in fitted_chunks:
 
             # Convert all NANs in the pvalues to 1.0. Need to check that this is appropriate
             p_all[np.isnan(p_all)] = 1.0
@@ -126,13 +118,19 @@ class Stats:
 
         self.line_tstats = line_tvals_array
 
-        # Join up the results chunks for the specimen-level analysis. Do FDR correction on the pvalues
+        # Join up the results chunks for the specimen-level analysis. Do FDR correction on the pvalues of all the
+        # specimens at once, one row per specimen
         self.specimen_results = addict.Dict()
 
+        spec_ids = list(specimen_pvals.keys())
+        if spec_ids:
+            spec_p = np.vstack([np.hstack(specimen_pvals[id_]) for id_ in spec_ids])
+        else:
+            spec_p = np.empty((0, len(line_pvals_array)), dtype=line_pvals_array.dtype)
+        spec_q = fdr(spec_p)
+
         try:
-            for id_, p in list(specimen_pvals.items()):
-                p = np.hstack(p)
-                q = fdr(p)
+            for id_, p, q in zip(spec_ids, spec_p, spec_q):
                 t = np.hstack(specimen_tstats[id_])
                 self.specimen_results[id_]['histogram'] = np.histogram(p, bins=100)[0]
                 self.specimen_results[id_]['q'] = q
@@ -142,61 +140,88 @@ class Stats:
             logging.info(p)
 
 
-class Intensity(Stats):
-    def __init__(self, *args):
-        super().__init__(*args)
+    def _fit_chunks(self):
+        """
+        Fit the baselines and mutants with the stats_runner.
+        Chunk the data and send sequentially to R to not use all the memory
 
+        Yields
+        ------
+        The number of data points in the chunk, p-values, t-statistics
+        """
+        info = self.input_.info
 
-class Jacobians(Stats):
-    def __init__(self, *args):
-        super().__init__(*args)
+        for data_chunk in self.input_.chunks():
 
+            current_chunk_size = data_chunk.shape[1]  # Final chunk may not be same size
 
-class OrganVolume(Stats):
-    def __init__(self, *args):
-        super().__init__(*args)
+            p_all, t_all = self.stats_runner(data_chunk, info, use_staging=self.use_staging)
 
+            yield current_chunk_size, p_all, t_all
 
-def fdr(pvals: np.ndarray) -> np.ndarray:
-    """
-    Use R for FDR correction
+    def _fit_from_baseline_stats(self):
+        """
+        Fit the line using the shared baseline statistics, so only the mutant data is used
 
-    ----------
-    pvals: The p-values to be corrected
+        Returns
+        -------
+        The number of data points, p-values, t-statistics
+        """
+        info = self.input_.info
 
-    Returns
-    -------
-    The corrected q-values
-    """
+        if list(info[info.genotype == 'wildtype'].index) != self.baseline_stats.ids:
+            raise ValueError('The shared baseline statistics were made from different baselines')
 
-    qval_outfile = tempfile.NamedTemporaryFile().name
-    pval_file = tempfile.NamedTemporaryFile().name
+        mut_rows = np.flatnonzero(info.genotype == 'mutant')
+        data = self.input_.data
 
-    try:
-        pvals.tofile(pval_file)
-    except IOError:
-        logging.error(f'Cannot save p-value file {pval_file}')
+        try:
+            data.shape
+        except AttributeError:  # List of numpy arrays
+            mut_data = [data[i] for i in mut_rows]
+        else:  # Dataframes
+            mut_data = data.values[mut_rows]
+
+        logging.info(f'Fitting {len(mut_rows)} mutants using the shared baseline statistics')
+        p_all, t_all = self.baseline_stats.fit_line(mut_data, info.staging.values[mut_rows],
+                                                    use_staging=self.use_staging)
 
+        return len(self.baseline_stats.mean), p_all, t_all
 
-    cmdFDR = ['Rscript',
-              str(RSCRIPT_FDR),
-              pval_file,
-              str(pvals.shape[0]),
-              qval_outfile
-              ]
+
+def baseline_stats(input_: LineData) -> BaselineStats:
+    """
+    Get the baseline sufficient statistics from the wildtype rows of a line's data
+
+    Parameters
+    ----------
+    input_
+        Any line from the DataLoader. The baselines are the same in each
+    """
+    info = input_.info
+    wt_rows = np.flatnonzero(info.genotype == 'wildtype')
 
     try:
-        sub.check_output(cmdFDR)
-    except sub.CalledProcessError as e:
-        logging.warn(f"R FDR calculation failed: {e}")
-        raise
+        input_.data.shape
+    except AttributeError:  # List of numpy arrays
+        wt_data = [input_.data[i] for i in wt_rows]
+    else:  # Dataframes
+        wt_data = input_.data.values[wt_rows]
+
+    logging.info(f'Getting the shared statistics for {len(wt_rows)} baselines')
+    return BaselineStats(wt_data, info.staging.values[wt_rows], ids=info.index[wt_rows])
 
-    result = np.fromfile(qval_outfile, dtype=np.float64).astype(np.float32)
 
-    os.remove(qval_outfile)
-    os.remove(pval_file)
+class Intensity(Stats):
+    def __init__(self, *args):
+        super().__init__(*args)
 
-    return result
 
+class Jacobians(Stats):
+    def __init__(self, *args):
+        super().__init__(*args)
 
 
+class OrganVolume(Stats):
+    def __init__(self, *args):
+        super().__init__(*args)
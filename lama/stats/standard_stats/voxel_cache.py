@@ -0,0 +1,269 @@
+"""
+A persistent cache of the blurred and masked voxel data used by the stats.
+
+Reading, blurring and masking the registered volumes is slow, and is the same on every stats run of a dataset. Two
+things are cached:
+
+The blurred, masked 1D data of each volume (volumes/<key>.npy). These are keyed by an md5 of the volume file's
+contents, along with the mask, the blur FWHM and the voxel size. So adding a specimen or a line to a dataset only blurs
+the new volumes. The contents are hashed, rather than using the file's size and modification time, so a volume that is
+rewritten or restored with its old modification time is never matched to stale data. Hashing still needs each volume
+to be read, but that is much quicker than loading and blurring it.
+
+The matrix for a set of volumes (<key>.npy), stored as (masked voxels * specimens), so the data for a range of voxels
+across all specimens is contiguous on disk (voxel-major). A chunk of the (specimens * voxels) data is then just a
+transposed slice of the memory-mapped matrix, with no copying. The matrix key is a checksum of the keys of its volumes,
+so a matrix is made from the cached volumes when the set of specimens changes.
+
+The cached matrix is opened copy-on-write, so the data can be normalised in place without changing the cache.
+
+The cache is kept under a size limit by deleting the least recently used files. A file's modification time is set
+whenever it's used, so the eviction order survives between runs.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from logzero import logger as logging
+import numpy as np
+
+from lama.common import prefetch
+from lama.utilities.config_checksum import file_md5
+
+VOXEL_CACHE_SUFFIX = '.npy'
+VOLUME_CACHE_DIR = 'volumes'
+DEFAULT_CACHE_MAX_GB = 50
+MATRIX_OPEN_ATTEMPTS = 3  # Times to remake a matrix that another process deletes before it can be opened
+TRANSPOSE_BLOCK_SIZE = 2 ** 18  # Number of voxels to move from specimen-major to voxel-major order at once
+
+
+class VoxelMatrix(list):
+    """
+    A list of the 1D data arrays of each specimen, which are column views of a voxel-major matrix
+
+    Attributes
+    ----------
+    matrix
+        masked voxels * specimens
+    """
+    def __init__(self, matrix: np.ndarray):
+        super().__init__(matrix[:, i] for i in range(matrix.shape[1]))
+        self.matrix = matrix
+
+
+def join_voxel_matrices(matrices: List[np.ndarray]) -> VoxelMatrix:
+    """
+    Join voxel-major matrices column-wise into one matrix in a temporary file, so the data for a range of voxels across
+    all their specimens is a single slice. The copy is made in blocks of voxels to keep the memory use down
+    """
+    matrices = [m for m in matrices if m.shape[1] > 0]
+    num_voxels = matrices[0].shape[0]
+    dtype = np.result_type(*matrices)
+
+    joined = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+',
+                       shape=(num_voxels, sum(m.shape[1] for m in matrices)))
+
+    for start in range(0, num_voxels, TRANSPOSE_BLOCK_SIZE):
+        np.concatenate([m[start: start + TRANSPOSE_BLOCK_SIZE] for m in matrices], axis=1,
+                       out=joined[start: start + TRANSPOSE_BLOCK_SIZE])
+
+    return VoxelMatrix(joined)
+
+
+class VoxelCache:
+    def __init__(self, cache_dir: Path, mask: np.ndarray, fwhm: float, voxel_size: float,
+                 max_gb: float = DEFAULT_CACHE_MAX_GB):
+        """
+        Parameters
+        ----------
+        cache_dir
+            Where the cache files are kept
+        mask
+            The mask applied to the volumes
+        fwhm
+            The blur FWHM applied to the volumes
+        voxel_size
+            The voxel size used for the blur
+        max_gb
+            The size limit of the cache. The least recently used files are deleted to keep under it
+        """
+        self.cache_dir = cache_dir
+        self.volume_dir = cache_dir / VOLUME_CACHE_DIR
+        self.volume_dir.mkdir(parents=True, exist_ok=True)
+
+        self.max_bytes = int(max_gb * 1024 ** 3)
+
+        md5 = hashlib.md5()
+        md5.update(str(mask.shape).encode())
+        md5.update(np.ascontiguousarray(mask != False).tobytes())
+        md5.update(f'{fwhm} {voxel_size}'.encode())
+        self._settings_key = md5.hexdigest()
+
+        # Cache file -> [last used time, size]. Volumes may be loaded in threads, so the index is locked
+        self._index: Dict[Path, List[int]] = {}
+        self._index_lock = threading.Lock()
+        self._volume_keys: Dict[Path, str] = {}  # Volume path: key. So each volume is only hashed once
+        for dir_ in (self.cache_dir, self.volume_dir):
+            for file_ in dir_.glob(f'*{VOXEL_CACHE_SUFFIX}'):
+                try:
+                    stat = file_.stat()
+                except FileNotFoundError:  # Just deleted by another process
+                    continue
+                self._index[file_] = [stat.st_mtime_ns, stat.st_size]
+
+    def volume_key(self, path: Path) -> str:
+        path = Path(path).resolve()
+        with self._index_lock:
+            key = self._volume_keys.get(path)
+        if key is None:
+            md5 = hashlib.md5()
+            md5.update(file_md5(path).encode())
+            md5.update(self._settings_key.encode())
+            key = md5.hexdigest()
+            with self._index_lock:
+                self._volume_keys[path] = key
+        return key
+
+    def matrix(self, paths: List[Path], load: Callable[[Path], np.ndarray], workers: int = 1) -> VoxelMatrix:
+        """
+        Get the voxel-major matrix of the data for some volumes, making it if it's not in the cache
+
+        Parameters
+        ----------
+        paths
+            The volumes. The columns of the matrix are in this order
+        load
+            Gets the blurred, masked 1D data for a volume. Only used for volumes that are not in the cache
+        workers
+            The number of volumes to get at once when making the matrix
+
+        Returns
+        -------
+        The specimen data, backed by the memory-mapped matrix
+        """
+        if not paths:
+            # Nothing to cache. Return an empty list of specimens, as for a loader without a cache
+            return VoxelMatrix(np.empty((0, 0), dtype=np.float32))
+
+        md5 = hashlib.md5()
+        for key in prefetch(self.volume_key, paths, workers):  # Hash the volumes in parallel
+            md5.update(key.encode())
+        cache_file = self.cache_dir / f'{md5.hexdigest()}{VOXEL_CACHE_SUFFIX}'
+
+        # Another process (line_workers) may delete the file between it being found and opened, so try again by
+        # remaking it. Once open, the memory map can still be read if the file is deleted
+        for attempt in range(MATRIX_OPEN_ATTEMPTS):
+            if cache_file.is_file():
+                try:
+                    matrix = np.load(cache_file, mmap_mode='c')
+                except FileNotFoundError:
+                    logging.info(f'{cache_file.name} was removed from the voxel cache while opening it')
+                else:
+                    self._touch(cache_file)
+                    logging.info(f'Using cached voxel data {cache_file}')
+                    return VoxelMatrix(matrix)
+
+            self._build(cache_file, paths, load, workers)
+            try:
+                matrix = np.load(cache_file, mmap_mode='c')
+            except FileNotFoundError:
+                continue
+            self._add(cache_file)
+            return VoxelMatrix(matrix)
+
+        raise RuntimeError(f'Could not keep {cache_file} in the voxel cache. Is the cache size limit too small?')
+
+    def volume(self, path: Path, load: Callable[[Path], np.ndarray]) -> np.ndarray:
+        """
+        Get the blurred, masked 1D data for a volume, loading it with load if it's not in the cache
+        """
+        cache_file = self.volume_dir / f'{self.volume_key(path)}{VOXEL_CACHE_SUFFIX}'
+
+        if cache_file.is_file():
+            try:
+                data = np.load(cache_file)
+                self._touch(cache_file)
+                return data
+            except FileNotFoundError:  # Evicted while another volume was being added
+                pass
+
+        data = load(path)
+
+        tmp = cache_file.with_name(cache_file.name + '.tmp')
+        with open(tmp, 'wb') as fh:
+            np.save(fh, data)
+        os.replace(tmp, cache_file)
+        self._add(cache_file)
+
+        return data
+
+    def _build(self, cache_file: Path, paths: List[Path], load: Callable[[Path], np.ndarray], workers: int):
+        """
+        Load each volume into a specimen-major temp file, then write it out in voxel-major blocks
+        """
+        logging.info(f'Making voxel data cache {cache_file}')
+
+        with tempfile.TemporaryDirectory(dir=cache_file.parent) as tmp_dir:
+            by_specimen = None
+
+            for i, data in enumerate(prefetch(lambda path: self.volume(path, load), paths, workers)):
+                if by_specimen is None:
+                    by_specimen = np.lib.format.open_memmap(Path(tmp_dir) / 'by_specimen.npy', mode='w+',
+                                                            dtype=data.dtype, shape=(len(paths), data.size))
+                by_specimen[i] = data
+
+            tmp_file = Path(tmp_dir) / cache_file.name
+            by_voxel = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=by_specimen.dtype,
+                                                 shape=by_specimen.shape[::-1])
+
+            for start in range(0, by_specimen.shape[1], TRANSPOSE_BLOCK_SIZE):
+                by_voxel[start: start + TRANSPOSE_BLOCK_SIZE] = by_specimen[:, start: start + TRANSPOSE_BLOCK_SIZE].T
+
+            by_voxel.flush()
+            del by_voxel, by_specimen
+
+            # Only put the file in the cache once it's complete
+            os.replace(tmp_file, cache_file)
+
+    def _touch(self, cache_file: Path):
+        try:
+            os.utime(cache_file)
+            stat = cache_file.stat()
+        except FileNotFoundError:  # Deleted by another process. Data that has already been opened is still readable
+            with self._index_lock:
+                self._index.pop(cache_file, None)
+            return
+        with self._index_lock:
+            self._index[cache_file] = [stat.st_mtime_ns, stat.st_size]
+
+    def _add(self, cache_file: Path):
+        """
+        Record a new cache file and delete the least recently used files if the cache is over its size limit.
+        The new file is never deleted
+        """
+        self._touch(cache_file)
+
+        with self._index_lock:
+            self._evict(cache_file)
+
+    def _evict(self, keep: Path):
+        total = sum(size for _, size in self._index.values())
+
+        for file_, (_, size) in sorted(self._index.items(), key=lambda x: x[1][0]):
+            if total <= self.max_bytes:
+                break
+            if file_ == keep:
+                continue
+            # Matrices already open are memory mapped, so they can still be read after they are deleted
+            file_.unlink(missing_ok=True)
+            del self._index[file_]
+            total -= size
+            logging.info(f'Removed {file_.name} from the voxel cache')
+
+        if total > self.max_bytes:
+            logging.warning(f'The voxel cache in {self.cache_dir} is over its size limit of '
+                            f'{round(self.max_bytes / 1024 ** 3, 3)} GB')
@@ -0,0 +1,61 @@
+"""
+Test the memory-based sizing of the stats chunks
+
+Usage:  pytest test_chunk_planner.py
+"""
+from lama.stats.standard_stats.data_loaders import ChunkPlanner
+
+BYTES_PER_POINT = 8
+
+
+def _planner(**kwargs):
+    # A budget that fits 5000 points with the first chunk's assumed overhead
+    budget = BYTES_PER_POINT * ChunkPlanner.FIRST_CHUNK_OVERHEAD * 5000
+    return ChunkPlanner(10 ** 7, BYTES_PER_POINT, memory_budget=budget, **kwargs)
+
+
+def test_growth_is_capped():
+    planner = _planner()
+    sizes = []
+    remaining = planner.num_points
+
+    # Fitting takes 2X the data size, so the budget fits 250000 points once the first chunk is measured
+    while remaining:
+        size = planner.next_chunk_size(remaining)
+        planner.record(size, size * BYTES_PER_POINT * 2)
+        sizes.append(size)
+        remaining -= size
+
+    assert sizes[:4] == [5000, 20000, 80000, 250000]
+    assert set(sizes[3:-1]) == {250000}
+    assert sum(sizes) == planner.num_points
+
+
+def test_only_first_chunk_is_measured():
+    planner = _planner()
+    planner.record(planner.next_chunk_size(planner.num_points), 5000 * BYTES_PER_POINT * 10)
+    per_point = planner.memory_per_point
+
+    # Later measurements under-report, as freed memory is kept by the process
+    planner.record(20000, 0)
+    assert planner.memory_per_point == per_point
+    assert planner.next_chunk_size(planner.num_points) == 50000
+
+
+def test_low_measurement_is_not_trusted():
+    planner = _planner()
+    planner.record(5000, 0)
+    assert planner.memory_per_point == BYTES_PER_POINT * ChunkPlanner.MIN_OVERHEAD
+
+
+def test_minimum_chunk_size():
+    planner = ChunkPlanner(10 ** 6, BYTES_PER_POINT, memory_budget=1)
+    assert planner.next_chunk_size(10 ** 6) == ChunkPlanner.MIN_CHUNK_SIZE
+    assert planner.next_chunk_size(10) == 10
+
+
+def test_fixed_chunk_size():
+    planner = _planner(chunk_size=3000)
+    planner.record(3000, 10 ** 12)
+    assert planner.next_chunk_size(10 ** 7) == 3000
+    assert planner.next_chunk_size(100) == 100
@@ -0,0 +1,60 @@
+"""
+Test cropping the target images to a mask bounding box and putting them back into the original frame
+
+Usage:  pytest test_crop.py
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from lama import common
+from lama.img_processing import crop
+
+
+@pytest.fixture()
+def mask():
+    mask = np.zeros((20, 30, 40), dtype=np.uint8)
+    mask[5:10, 8:20, 3:35] = 1
+    return mask
+
+
+def test_bounding_box(mask):
+    box = crop.bounding_box(mask, margin=2)
+    # Boxes are in (x, y, z) order and clipped to the image
+    assert box == {'start': [1, 6, 3], 'size': [36, 16, 9], 'original_size': [40, 30, 20]}
+
+
+def test_bounding_box_empty_mask():
+    with pytest.raises(common.LamaDataException):
+        crop.bounding_box(np.zeros((5, 5, 5)))
+
+
+def test_crop_array_round_trip(mask):
+    box = crop.bounding_box(mask, margin=1)
+    data = np.random.default_rng(0).uniform(size=mask.shape).astype(np.float32) * mask
+
+    cropped = crop.crop_array(data, box)
+    assert cropped.shape == tuple(box['size'][::-1])
+    np.testing.assert_array_equal(crop.uncrop_array(cropped, box), data)
+
+
+def test_crop_image_round_trip(mask):
+    box = crop.bounding_box(mask, margin=1)
+    data = np.random.default_rng(0).uniform(size=mask.shape).astype(np.float32) * mask
+    img = sitk.GetImageFromArray(data)
+    img.SetSpacing((2.0, 2.0, 2.0))
+
+    cropped = crop.crop_image(img, box)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(cropped), crop.crop_array(data, box))
+    # The cropped image stays in the same physical place
+    assert cropped.TransformIndexToPhysicalPoint((0, 0, 0)) == img.TransformIndexToPhysicalPoint(box['start'])
+
+    uncropped = crop.uncrop_image(cropped, box)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(uncropped), data)
+    assert uncropped.GetOrigin() == img.GetOrigin()
+
+
+def test_crop_box_io(tmp_path, mask):
+    box = crop.bounding_box(mask)
+    crop.write_crop_box(tmp_path / crop.CROP_BOX_FILE, box)
+    assert crop.read_crop_box(tmp_path / crop.CROP_BOX_FILE) == box
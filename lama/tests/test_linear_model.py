@@ -0,0 +1,167 @@
+"""
+Test the NumPy linear model engine against the R one (lmFast.R)
+
+The tests that run R are skipped if Rscript is not installed. Without R, lm_numpy is checked against reference p and
+t-values for the lmFast.R test data (test_data_for_R_LM/lm_reference.csv), in the lm_r output layout. The reference
+values were made with statsmodels OLS, which fits the same model as R's lm: genotype treatment-coded with 'mutant' as
+the reference level, and the t-statistic sign flipped as in lmFast.R. test_lm_r_matches_reference checks them against
+lm_r wherever R is installed.
+
+Usage:  pytest test_linear_model.py
+"""
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lama import common
+from lama.stats import linear_model
+
+lm_test_data_dir = common.lama_root_dir / 'stats' / 'rscripts' / 'test_data_for_R_LM'
+
+
+@pytest.fixture()
+def lm_data():
+    """
+    Returns
+    -------
+    data: specimens * data points
+    info: genotype and staging for each specimen
+    """
+    info = pd.read_csv(lm_test_data_dir / 'groups.csv', index_col=0)
+
+    # The binary format read by lmFast.R. Two ints for the shape followed by the data column-wise
+    with open(lm_test_data_dir / 'testpixelfile', 'rb') as fh:
+        shape = np.fromfile(fh, dtype=np.uint32, count=2)
+        data = np.fromfile(fh, dtype=np.float64).reshape(shape[::-1]).T
+
+    return data, info
+
+
+@pytest.fixture()
+def lm_reference():
+    return pd.read_csv(lm_test_data_dir / 'lm_reference.csv')
+
+
+def _reference(lm_reference, use_staging):
+    suffix = 'staging' if use_staging else 'no_staging'
+    return lm_reference[f'p_{suffix}'].values, lm_reference[f't_{suffix}'].values
+
+
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_lm_numpy_matches_reference(lm_data, lm_reference, use_staging):
+    data, info = lm_data
+    p_ref, t_ref = _reference(lm_reference, use_staging)
+
+    p_np, t_np = linear_model.lm_numpy(data, info, use_staging=use_staging)
+
+    assert p_np.shape == p_ref.shape == (data.shape[1] * (1 + sum(info.genotype == 'mutant')),)
+    np.testing.assert_allclose(p_np, p_ref, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(t_np, t_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='Rscript not installed')
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_lm_r_matches_reference(lm_data, lm_reference, use_staging):
+    data, info = lm_data
+    p_ref, t_ref = _reference(lm_reference, use_staging)
+
+    p_r, t_r = linear_model.lm_r(data, info, use_staging=use_staging)
+
+    np.testing.assert_allclose(p_r, p_ref, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(t_r, t_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='Rscript not installed')
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_lm_numpy_matches_r(lm_data, use_staging):
+    data, info = lm_data
+
+    p_r, t_r = linear_model.lm_r(data, info, use_staging=use_staging)
+    p_np, t_np = linear_model.lm_numpy(data, info, use_staging=use_staging)
+
+    # Line level followed by one set of results for each mutant
+    assert p_np.shape == p_r.shape == (data.shape[1] * (1 + sum(info.genotype == 'mutant')),)
+    np.testing.assert_allclose(p_np, p_r, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(t_np, t_r, rtol=1e-4, atol=1e-5)
+
+
+def test_lm_numpy_matches_lstsq(lm_data):
+    """
+    Check the shared QR fit against fitting each data point separately
+    """
+    data, info = lm_data
+
+    p, t = linear_model.lm_numpy(data, info)
+    p32, t32 = linear_model.lm_numpy(data.astype(np.float32), info)
+
+    x = np.column_stack([np.ones(len(info)), (info.genotype == 'wildtype').astype(float), info.staging])
+    y = np.abs(data)
+    df = x.shape[0] - x.shape[1]
+
+    for i in range(data.shape[1]):
+        beta, rss, _, _ = np.linalg.lstsq(x, y[:, i], rcond=None)
+        se = np.sqrt(np.linalg.inv(x.T @ x)[1, 1] * rss[0] / df)
+        # The sign is flipped to give the mutant effect
+        assert t[i] == pytest.approx(-beta[1] / se, rel=1e-5)
+
+    # Each specimen-level fit is the wildtypes plus one mutant
+    wt_rows = np.flatnonzero(info.genotype == 'wildtype')
+    num_points = data.shape[1]
+
+    for spec_num, mut_row in enumerate(np.flatnonzero(info.genotype == 'mutant')):
+        rows = np.append(wt_rows, mut_row)
+        x_spec = x[rows]
+        df_spec = len(rows) - x.shape[1]
+        t_spec = t[num_points * (spec_num + 1): num_points * (spec_num + 2)]
+
+        for i in range(0, num_points, 97):
+            beta, rss, _, _ = np.linalg.lstsq(x_spec, y[rows, i], rcond=None)
+            se = np.sqrt(np.linalg.inv(x_spec.T @ x_spec)[1, 1] * rss[0] / df_spec)
+            assert t_spec[i] == pytest.approx(-beta[1] / se, rel=1e-5)
+
+    np.testing.assert_allclose(t32, t, rtol=1e-3)
+    np.testing.assert_allclose(p32, p, rtol=1e-3, atol=1e-6)
+
+
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_lm_permutations_matches_lm_numpy(lm_data, use_staging):
+    """
+    Check the batched relabelling fit against fitting each relabelling separately
+    """
+    data, info = lm_data
+    wt_data = data[info.genotype == 'wildtype']
+    staging = info.staging[info.genotype == 'wildtype'].values
+
+    rng = np.random.default_rng(999)
+    labels = np.zeros((20, len(wt_data)), dtype=bool)
+    for row in labels:
+        row[rng.choice(len(wt_data), rng.integers(1, 5), replace=False)] = True
+
+    p, t = linear_model.lm_permutations(wt_data, staging, labels, use_staging=use_staging)
+
+    for i, row in enumerate(labels):
+        perm_info = pd.DataFrame({'genotype': np.where(row, 'synth_hom', 'wt'), 'staging': staging})
+        p_expected, t_expected = linear_model.lm_numpy(wt_data, perm_info, use_staging=use_staging)
+        np.testing.assert_allclose(p[i], p_expected, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(t[i], t_expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_baseline_stats_matches_lm_numpy(lm_data, use_staging):
+    """
+    Check that finishing the model from the shared baseline statistics gives the same line and specimen results
+    """
+    data, info = lm_data
+    wt = (info.genotype == 'wildtype').values
+
+    baseline = linear_model.BaselineStats(data[wt], info.staging.values[wt])
+    p, t = baseline.fit_line(data[~wt], info.staging.values[~wt], use_staging=use_staging)
+
+    # lm_numpy expects the baselines first as they are in LineData
+    order = np.r_[np.flatnonzero(wt), np.flatnonzero(~wt)]
+    p_expected, t_expected = linear_model.lm_numpy(data[order], info.iloc[order], use_staging=use_staging)
+
+    np.testing.assert_allclose(p, p_expected, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(t, t_expected, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,93 @@
+"""
+Test the NumPy multiple testing correction against R's p.adjust
+
+The R test is skipped if Rscript is not installed.
+
+Usage:  pytest test_multiple_testing.py
+"""
+import shutil
+import subprocess as sub
+
+import numpy as np
+import pytest
+
+from lama.stats import multiple_testing
+
+
+@pytest.fixture()
+def pvals():
+    rng = np.random.default_rng(999)
+    # Mostly nulls with some small p-values and a few ties
+    p = np.concatenate([rng.uniform(size=2000), rng.uniform(0, 1e-3, size=200), [0.5] * 10])
+    rng.shuffle(p)
+    return p
+
+
+def _p_adjust(p, by=False):
+    """
+    p.adjust(p, method='BH' or 'BY') written out as in R
+    """
+    n = len(p)
+    i = np.arange(n, 0, -1)
+    o = np.argsort(p, kind='stable')[::-1]
+    q = 1.0 / np.arange(1, n + 1) if by else [1.0]
+    adjusted = np.minimum(1, np.minimum.accumulate(np.sum(q) * n / i * p[o]))
+    out = np.empty(n)
+    out[o] = adjusted
+    return out
+
+
+@pytest.mark.parametrize('method', ['BH', 'BY'])
+def test_fdr_matches_p_adjust(pvals, method):
+    q = multiple_testing.fdr(pvals, method=method)
+    np.testing.assert_allclose(q, _p_adjust(pvals, by=method == 'BY'), rtol=1e-12)
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='Rscript not installed')
+@pytest.mark.parametrize('method', ['BH', 'BY'])
+def test_fdr_matches_r(pvals, method):
+    r_cmd = f'p <- as.numeric(strsplit(readLines("stdin"), ",")[[1]]); ' \
+            f'cat(format(p.adjust(p, method="{method}"), digits=17), sep=",")'
+    out = sub.run(['Rscript', '-e', r_cmd], input=','.join(repr(x) for x in pvals),
+                  capture_output=True, universal_newlines=True, check=True).stdout
+    np.testing.assert_allclose(multiple_testing.fdr(pvals, method=method), np.array(out.split(','), dtype=float),
+                               rtol=1e-10)
+
+
+def test_fdr_float32_in_place(pvals):
+    p32 = pvals.astype(np.float32)
+    expected = _p_adjust(p32.astype(np.float64))
+
+    q = multiple_testing.fdr(p32, out=p32)
+
+    assert q is p32
+    np.testing.assert_allclose(q, expected, rtol=1e-5)
+
+
+def test_fdr_nans_not_counted(pvals):
+    pvals[[5, 50]] = np.nan
+    q = multiple_testing.fdr(pvals)
+
+    assert np.isnan(q[[5, 50]]).all()
+    np.testing.assert_allclose(np.delete(q, [5, 50]), _p_adjust(np.delete(pvals, [5, 50])))
+
+
+@pytest.mark.parametrize('method', multiple_testing.FDR_METHODS)
+def test_fdr_batch(pvals, method):
+    batch = np.vstack([pvals, pvals[::-1] ** 2, np.roll(pvals, 7)])
+    q = multiple_testing.fdr(batch, method=method)
+
+    for row, q_row in zip(batch, q):
+        np.testing.assert_array_equal(q_row, multiple_testing.fdr(row, method=method))
+
+
+def test_qvalue(pvals):
+    pi0 = multiple_testing.storey_pi0(pvals)
+    assert 0.85 < pi0 < 1
+
+    np.testing.assert_allclose(multiple_testing.fdr(pvals, method='qvalue'), pi0 * _p_adjust(pvals))
+
+    # The smoothing spline should give back a straight line
+    lambdas = np.array(multiple_testing.QVALUE_LAMBDAS)
+    weights = multiple_testing._smoother_weights(multiple_testing.QVALUE_LAMBDAS, multiple_testing.QVALUE_SMOOTH_DF)
+    assert weights @ (2 * lambdas + 1) == pytest.approx(2 * lambdas[-1] + 1)
@@ -0,0 +1,133 @@
+"""
+Test the permutation null cache: reusing, extending and evicting cached nulls
+
+Usage:  pytest test_null_store.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+from lama.stats.permutation_stats import null_store
+from lama.stats.permutation_stats.null_store import NullCache
+
+
+def _perms(start, n, num_labels=3, num_baselines=6):
+    # Permutations seeded by their number, as when they are made
+    p = np.array([np.random.default_rng(i).uniform(size=num_labels) for i in range(start, start + n)])
+    labels = np.array([np.random.default_rng(i).permutation(num_baselines) < 2 for i in range(start, start + n)])
+    return p, labels
+
+
+def _all(store):
+    return np.concatenate(store.pvalues), np.concatenate(store.labels)
+
+
+def test_null_key():
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    staging = np.array([1.0, 2.0, 3.0])
+    key = null_store.null_key(data, staging, 1)
+
+    assert key == null_store.null_key(data.astype(np.float64), staging, 1)
+    assert key != null_store.null_key(data, staging, 2)
+    assert key != null_store.null_key(data, staging[::-1], 1)
+    assert key != null_store.null_key(data.reshape(4, 3), staging, 1)
+
+
+def test_cache_hit(tmp_path):
+    cache = NullCache(tmp_path, 'key')
+    spec_p = np.random.default_rng(0).uniform(size=(10, 3))
+    cache.set_spec_pvalues(spec_p)
+    p, labels = _perms(0, 5)
+    cache.line_store(2).append(p, labels)
+
+    reopened = NullCache(tmp_path, 'key')
+    np.testing.assert_array_equal(reopened.spec_pvalues, spec_p)
+    store = reopened.line_store(2)
+    assert store.num_perms == 5
+    np.testing.assert_array_equal(_all(store)[0], p)
+    np.testing.assert_array_equal(_all(store)[1], labels)
+
+    # Other line sizes and keys are not shared
+    assert reopened.line_store(3).num_perms == 0
+    assert NullCache(tmp_path, 'other_key').spec_pvalues is None
+
+
+def test_cache_extend(tmp_path):
+    NullCache(tmp_path, 'key').line_store(2).append(*_perms(0, 5))
+
+    store = NullCache(tmp_path, 'key').line_store(2)
+    store.append(*_perms(store.num_perms, 4))
+
+    store = NullCache(tmp_path, 'key').line_store(2)
+    assert store.num_perms == 9
+    assert store.state['num_chunks'] == 2
+    np.testing.assert_array_equal(_all(store)[0], _perms(0, 9)[0])
+
+
+def test_concurrent_runs_do_not_duplicate(tmp_path):
+    run_a = NullCache(tmp_path, 'key').line_store(2)
+    run_b = NullCache(tmp_path, 'key').line_store(2)
+
+    run_a.append(*_perms(0, 5))
+    # Run b made the same first 5 permutations and 3 more. Only the 3 new ones are added
+    run_b.append(*_perms(0, 8))
+
+    assert run_b.num_perms == 8
+    np.testing.assert_array_equal(_all(run_b)[0], _perms(0, 8)[0])
+
+    store = NullCache(tmp_path, 'key').line_store(2)
+    assert store.num_perms == 8
+    np.testing.assert_array_equal(_all(store)[0], _perms(0, 8)[0])
+
+    # Run a's next 3 permutations have already been added by run b
+    run_a.append(*_perms(run_a.num_perms, 3))
+    assert run_a.num_perms == 8
+    assert NullCache(tmp_path, 'key').line_store(2).num_perms == 8
+
+    # Run a's next permutations follow on after run b's
+    run_a.append(*_perms(run_a.num_perms, 2))
+    store = NullCache(tmp_path, 'key').line_store(2)
+    assert store.num_perms == 10
+    np.testing.assert_array_equal(_all(store)[0], _perms(0, 10)[0])
+
+
+def test_no_cache_dir():
+    cache = NullCache(None, 'key')
+    cache.set_spec_pvalues(np.ones(3))
+    cache.line_store(2).append(*_perms(0, 5))
+    assert cache.line_store(2).num_perms == 5
+
+
+@pytest.fixture()
+def full_cache(tmp_path):
+    """
+    Three null folders of about 80 KB each, from least to most recently used
+    """
+    for age, key in enumerate(['old', 'middle', 'new']):
+        NullCache(tmp_path, key).set_spec_pvalues(np.zeros(10000))
+        os.utime(tmp_path / key, (1000 + age, 1000 + age))
+    return tmp_path
+
+
+def _keys(cache_dir):
+    return sorted(d.name for d in cache_dir.iterdir() if d.is_dir())
+
+
+def test_evict_least_recently_used(full_cache):
+    # Room for two folders
+    NullCache(full_cache, 'new', max_gb=200000 / 1024 ** 3)
+    assert _keys(full_cache) == ['middle', 'new']
+
+
+def test_evict_keeps_opened_folder(full_cache):
+    # The oldest folder is opened, so it's the most recently used
+    NullCache(full_cache, 'old', max_gb=100000 / 1024 ** 3)
+    assert _keys(full_cache) == ['old']
+
+
+def test_evict_skips_locked_folders(full_cache):
+    lock = null_store._key_lock(full_cache / 'old')
+    with lock.acquire(timeout=0):
+        NullCache(full_cache, 'new', max_gb=100000 / 1024 ** 3)
+    assert _keys(full_cache) == ['new', 'old']
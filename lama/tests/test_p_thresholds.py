@@ -0,0 +1,83 @@
+"""
+Test the vectorised per-label p-value threshold search against a loop over the candidate thresholds
+
+Usage:  pytest test_p_thresholds.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from lama.stats.permutation_stats import p_thresholds
+
+
+def _loop_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_threshold: float = 0.05):
+    """
+    The threshold search as it was done before vectorising: fdr_calc at every candidate p-value
+    """
+    results = []
+
+    for label in null_dist:
+        wt_pvals = np.sort(null_dist[label].values)
+        mut_pvals = np.sort(alt_dist[label].values)
+
+        all_p = sorted(x for x in list(wt_pvals) + list(mut_pvals) if x <= 0.05)
+        pthresh_fdrs = [(p, fdr) for p in all_p
+                        for fdr in [p_thresholds.fdr_calc(wt_pvals, mut_pvals, p)] if fdr is not None]
+        p_fdr_df = pd.DataFrame.from_records(pthresh_fdrs, columns=['p', 'fdr'])
+
+        if len(p_fdr_df) > 0:
+            p_under_target_fdr = p_fdr_df[p_fdr_df.fdr <= target_threshold]
+            if len(p_under_target_fdr) < 1:
+                row = p_fdr_df.loc[p_fdr_df['fdr'].idxmax()]
+            else:
+                row = p_fdr_df.loc[p_under_target_fdr.p.idxmax()]
+            p_thresh, best_fdr = row['p'], row['fdr']
+            results.append([int(label), p_thresh, best_fdr, len(wt_pvals), int(np.sum(wt_pvals <= p_thresh)),
+                            len(mut_pvals), int(np.sum(mut_pvals <= p_thresh))])
+        else:
+            results.append([int(label), np.nan, 1, 'NA', 'NA', 'NA', 0])
+
+    header = ['label', 'p_thresh', 'fdr', 'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
+    return pd.DataFrame.from_records(results, columns=header, index='label').sort_values(by='label')
+
+
+@pytest.fixture()
+def dists():
+    rng = np.random.default_rng(42)
+    n_null, n_alt = 2000, 40
+    null = {}
+    alt = {}
+
+    # Uniform nulls with alternatives ranging from no signal to a strong signal
+    for label, effect in zip(range(1, 7), [0, 0.2, 0.5, 1, 2, 4]):
+        null[label] = rng.uniform(size=n_null)
+        alt[label] = rng.uniform(size=n_alt) ** (1 + effect)
+
+    # Tied p-values, as given by a coarse null
+    null[7] = np.round(rng.uniform(size=n_null), 3)
+    alt[7] = np.round(rng.uniform(size=n_alt) ** 3, 3)
+
+    # A null skewed to low p-values, so the FDR is clipped at 1 and no threshold passes
+    null[8] = rng.uniform(size=n_null) ** 4
+    alt[8] = rng.uniform(size=n_alt)
+
+    # No alternative p-values under 0.05
+    null[9] = rng.uniform(size=n_null)
+    alt[9] = rng.uniform(0.5, 1, size=n_alt)
+
+    return pd.DataFrame(null), pd.DataFrame(alt)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_thresholds_match_loop(dists, workers):
+    null, alt = dists
+    result = p_thresholds.get_thresholds(null, alt, workers=workers)
+    pd.testing.assert_frame_equal(result, _loop_thresholds(null, alt), check_exact=True)
+
+
+def test_label_without_threshold(dists):
+    null, alt = dists
+    row = p_thresholds.get_thresholds(null, alt).loc[9]
+    assert np.isnan(row['p_thresh'])
+    assert row['fdr'] == 1
+    assert row['num_alt_lt_thresh'] == 0
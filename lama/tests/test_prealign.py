@@ -0,0 +1,70 @@
+"""
+Test the moment-based rigid pre-alignment on a synthetic image with a known rotation and translation
+
+Usage:  pytest test_prealign.py
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from lama.elastix import prealign, ELX_TRANSFORM_PREFIX
+
+
+@pytest.fixture()
+def fixed():
+    """
+    An ellipsoid with a bump on one side, so its principal axes are distinct and it is not symmetric
+    """
+    z, y, x = np.mgrid[:48, :48, :48] - 24.0
+    arr = ((x / 16) ** 2 + (y / 10) ** 2 + (z / 6) ** 2 <= 1).astype(np.float32) * 100
+    arr[((x - 12) ** 2 + y ** 2 + z ** 2) <= 16] = 200
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing((2.0, 2.0, 2.0))
+    return img
+
+
+def _moving(fixed: sitk.Image) -> sitk.Image:
+    # Rotate by 70 degrees about z and 20 about x and shift it
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(fixed.TransformContinuousIndexToPhysicalPoint([24] * 3))
+    transform.SetRotation(np.deg2rad(20), 0, np.deg2rad(70))
+    transform.SetTranslation((6.0, -4.0, 2.0))
+    return sitk.Resample(fixed, fixed, transform, sitk.sitkLinear, 0.0)
+
+
+def test_image_moments(fixed):
+    com, axes = prealign.image_moments(fixed)
+
+    # The bump pulls the centre of mass along x
+    centre = np.array(fixed.TransformIndexToPhysicalPoint([24] * 3))
+    assert com[0] > centre[0]
+    assert np.allclose(com[1:], centre[1:], atol=0.1)
+    # Longest axis is x, then y then z
+    assert np.allclose(np.abs(axes), np.eye(3), atol=1e-6)
+    assert np.isclose(np.linalg.det(axes), 1)
+
+
+def test_alignment_is_recovered(fixed):
+    moving = _moving(fixed)
+    fixed_com, fixed_axes = prealign.image_moments(fixed)
+    mov_com, mov_axes = prealign.image_moments(moving)
+
+    transform, ncc = prealign._best_rotation(fixed, moving, fixed_com, fixed_axes, mov_com, mov_axes)
+
+    before = prealign._ncc(sitk.GetArrayFromImage(fixed), sitk.GetArrayFromImage(moving))
+    assert ncc > 0.95
+    assert ncc > before + 0.2
+
+
+def test_prealign_writes_transforms(tmp_path, fixed):
+    fixed_path = tmp_path / 'fixed.nrrd'
+    mov_path = tmp_path / 'spec1.nrrd'
+    sitk.WriteImage(fixed, str(fixed_path))
+    sitk.WriteImage(_moving(fixed), str(mov_path))
+
+    transforms = prealign.prealign(fixed_path, [mov_path], tmp_path / 'prealign')
+
+    assert transforms == {'spec1': tmp_path / 'prealign' / 'spec1' / ELX_TRANSFORM_PREFIX}
+    params = transforms['spec1'].read_text()
+    assert '(Transform "EulerTransform")' in params
+    assert '(Size 48 48 48)' in params
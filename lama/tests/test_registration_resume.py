@@ -0,0 +1,111 @@
+"""
+Test the done files that let a resumed registration skip specimens that are already registered
+
+Usage:  pytest test_registration_resume.py
+"""
+from pathlib import Path
+
+import pytest
+
+from lama.elastix import elastix_registration as er
+
+
+@pytest.fixture()
+def reg(tmp_path):
+    files = {'params.txt': '(Transform "EulerTransform")\n',
+             'fixed.nrrd': 'fixed',
+             'moving.nrrd': 'moving',
+             'mask.nrrd': 'mask',
+             'initial.txt': '(Transform "EulerTransform")\n(TransformParameters 0 0 0 0 0 0)\n'}
+    for name, text in files.items():
+        (tmp_path / name).write_text(text)
+
+    return er.ElastixRegistration(tmp_path / 'params.txt', tmp_path, tmp_path / 'stage', 'nrrd', resume=True)
+
+
+def _new_reg(reg: er.ElastixRegistration) -> er.ElastixRegistration:
+    # A fresh object so file checksums are not reused from the previous run
+    new = er.ElastixRegistration(reg.elxparam_file, reg.movdir, reg.stagedir, reg.filetype, resume=True)
+    new.fixed_mask = reg.fixed_mask
+    new.initial_transforms = dict(reg.initial_transforms)
+    new.downsample = reg.downsample
+    return new
+
+
+def _done(reg, tmp_path: Path) -> Path:
+    out_dir = tmp_path / 'stage' / 'moving'
+    out_dir.mkdir(parents=True, exist_ok=True)
+    output = out_dir / 'moving.nrrd'
+    output.write_text('registered')
+    er.write_registration_done(out_dir, reg.registration_key(tmp_path / 'moving.nrrd', tmp_path / 'fixed.nrrd'),
+                               output)
+    return out_dir
+
+
+def _is_done(reg, tmp_path: Path, out_dir: Path) -> bool:
+    return er.registration_done(out_dir, reg.registration_key(tmp_path / 'moving.nrrd', tmp_path / 'fixed.nrrd'))
+
+
+def test_unchanged_inputs_are_done(reg, tmp_path):
+    out_dir = _done(reg, tmp_path)
+    assert _is_done(_new_reg(reg), tmp_path, out_dir)
+
+
+def test_not_done_without_done_file(reg, tmp_path):
+    out_dir = tmp_path / 'stage' / 'moving'
+    out_dir.mkdir(parents=True)
+    assert not _is_done(reg, tmp_path, out_dir)
+
+
+def test_missing_output_is_not_done(reg, tmp_path):
+    out_dir = _done(reg, tmp_path)
+    (out_dir / 'moving.nrrd').unlink()
+    assert not _is_done(reg, tmp_path, out_dir)
+
+
+@pytest.mark.parametrize('changed', ['params.txt', 'fixed.nrrd', 'moving.nrrd'])
+def test_changed_input_file_invalidates(reg, tmp_path, changed):
+    out_dir = _done(reg, tmp_path)
+    with open(tmp_path / changed, 'a') as fh:
+        fh.write('changed\n')
+    assert not _is_done(_new_reg(reg), tmp_path, out_dir)
+
+
+def test_fixed_mask_invalidates(reg, tmp_path):
+    out_dir = _done(reg, tmp_path)
+    new = _new_reg(reg)
+    new.fixed_mask = tmp_path / 'mask.nrrd'
+    assert not _is_done(new, tmp_path, out_dir)
+
+
+def test_initial_transform_invalidates(reg, tmp_path):
+    reg.set_initial_transforms({'moving': tmp_path / 'initial.txt'})
+    out_dir = _done(reg, tmp_path)
+    assert _is_done(_new_reg(reg), tmp_path, out_dir)
+
+    # A changed initial transform
+    with open(tmp_path / 'initial.txt', 'a') as fh:
+        fh.write('(NumberOfParameters 6)\n')
+    assert not _is_done(_new_reg(reg), tmp_path, out_dir)
+
+    # No initial transform
+    new = _new_reg(reg)
+    new.set_initial_transforms({})
+    assert not _is_done(new, tmp_path, out_dir)
+
+
+def test_downsample_invalidates(reg, tmp_path):
+    out_dir = _done(reg, tmp_path)
+    new = _new_reg(reg)
+    new.downsample = 2
+    assert not _is_done(new, tmp_path, out_dir)
+
+
+def test_remove_stale_dirs(reg, tmp_path):
+    stage = tmp_path / 'stage'
+    for name in ('keep', 'dropped', er.RESOLUTION_IMG_FOLDER):
+        (stage / name).mkdir(parents=True)
+
+    reg.remove_stale_dirs(stage, ['keep'])
+
+    assert sorted(p.name for p in stage.iterdir()) == sorted(['keep', er.RESOLUTION_IMG_FOLDER])
@@ -0,0 +1,114 @@
+"""
+Test the post-registration step executor
+
+Usage:  pytest test_task_graph.py
+"""
+import threading
+
+import pytest
+
+from lama.registration_pipeline.task_graph import TaskGraph
+
+
+def _record(log, lock, name, value=None):
+    with lock:
+        log.append(name)
+    return value
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_steps_run_after_their_dependencies(workers):
+    log = []
+    lock = threading.Lock()
+
+    graph = TaskGraph()
+    graph.add('a', _record, log, lock, 'a', 1)
+    graph.add('b', _record, log, lock, 'b', 2, deps=['a'])
+    graph.add('c', _record, log, lock, 'c', 3, deps=['a'])
+    graph.add('d', _record, log, lock, 'd', 4, deps=['b', 'c'])
+    graph.add('e', _record, log, lock, 'e', 5)
+
+    results = graph.run(workers=workers)
+
+    assert results == {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5}
+    assert log.index('a') < log.index('b') < log.index('d')
+    assert log.index('c') < log.index('d')
+    if workers == 1:
+        assert log == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_dependent_waits_for_slow_dependency():
+    release = threading.Event()
+    log = []
+    lock = threading.Lock()
+
+    def slow():
+        # Only finishes once the independent step has run, so they must be running at the same time
+        assert release.wait(5)
+        _record(log, lock, 'slow')
+
+    def fast():
+        _record(log, lock, 'fast')
+        release.set()
+
+    graph = TaskGraph()
+    graph.add('slow', slow)
+    graph.add('fast', fast)
+    graph.add('after_slow', _record, log, lock, 'after_slow', deps=['slow'])
+    graph.run(workers=2)
+
+    assert log == ['fast', 'slow', 'after_slow']
+
+
+def test_error_stops_new_steps():
+    log = []
+    lock = threading.Lock()
+
+    def fail():
+        raise RuntimeError('step failed')
+
+    graph = TaskGraph()
+    graph.add('ok', _record, log, lock, 'ok')
+    graph.add('fail', fail, deps=['ok'])
+    graph.add('after_fail', _record, log, lock, 'after_fail', deps=['fail'])
+    graph.add('after_ok', _record, log, lock, 'after_ok', deps=['ok'])
+
+    with pytest.raises(RuntimeError, match='step failed'):
+        graph.run(workers=1)
+
+    assert log == ['ok']
+
+
+def test_running_steps_finish_before_error_is_raised():
+    started = threading.Event()
+    log = []
+    lock = threading.Lock()
+
+    def slow():
+        started.set()
+        threading.Event().wait(0.2)
+        _record(log, lock, 'slow')
+
+    def fail():
+        assert started.wait(5)
+        raise RuntimeError('step failed')
+
+    graph = TaskGraph()
+    graph.add('slow', slow)
+    graph.add('fail', fail)
+
+    with pytest.raises(RuntimeError):
+        graph.run(workers=2)
+
+    assert log == ['slow']
+
+
+def test_bad_graphs():
+    graph = TaskGraph()
+    graph.add('a', print)
+
+    with pytest.raises(ValueError):
+        graph.add('a', print)
+
+    with pytest.raises(ValueError):
+        graph.add('b', print, deps=['missing'])
@@ -0,0 +1,129 @@
+"""
+Test the cache of blurred, masked voxel data used by the stats
+
+Usage:  pytest test_voxel_cache.py
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from lama.stats.standard_stats.voxel_cache import VoxelCache, join_voxel_matrices, VOLUME_CACHE_DIR
+
+NUM_VOXELS = 1000
+FILE_SIZE = NUM_VOXELS * 4 + 128  # A float32 .npy file
+MASK = np.ones((10, 10, 10), dtype=np.uint8)
+
+
+class Loader:
+    """
+    Stands in for reading and blurring a volume. Records which volumes were loaded
+    """
+    def __init__(self):
+        self.loaded = []
+
+    def __call__(self, path: Path) -> np.ndarray:
+        self.loaded.append(path.name)
+        seed = int.from_bytes(path.read_bytes()[:4], 'little')
+        return np.random.default_rng(seed).uniform(size=NUM_VOXELS).astype(np.float32)
+
+
+@pytest.fixture()
+def volumes(tmp_path):
+    vol_dir = tmp_path / 'vols'
+    vol_dir.mkdir()
+    paths = []
+    for i, name in enumerate('abcd'):
+        path = vol_dir / f'{name}.nrrd'
+        path.write_bytes(i.to_bytes(4, 'little'))
+        paths.append(path)
+    return paths
+
+
+def _cache(tmp_path, num_files=100):
+    return VoxelCache(tmp_path / 'cache', MASK, fwhm=100, voxel_size=14, max_gb=num_files * FILE_SIZE / 1024 ** 3)
+
+
+def _cached_volumes(tmp_path, cache, paths):
+    return sorted(f.name for f in (tmp_path / 'cache' / VOLUME_CACHE_DIR).glob('*.npy')
+                  if f.name in {f'{cache.volume_key(p)}.npy' for p in paths})
+
+
+def test_matrix(tmp_path, volumes):
+    load = Loader()
+    matrix = _cache(tmp_path).matrix(volumes[:3], load)
+
+    expected = np.array([Loader()(p) for p in volumes[:3]])
+    assert matrix.matrix.shape == (NUM_VOXELS, 3)
+    np.testing.assert_array_equal(np.array(matrix), expected)
+    assert load.loaded == ['a.nrrd', 'b.nrrd', 'c.nrrd']
+
+    # Cached, so nothing is loaded. In a different order, only the new matrix is made from the cached volumes
+    load = Loader()
+    _cache(tmp_path).matrix(volumes[:3], load)
+    reordered = _cache(tmp_path).matrix(volumes[2::-1], load)
+    assert load.loaded == []
+    np.testing.assert_array_equal(np.array(reordered), expected[::-1])
+
+
+def test_changed_volume_is_reloaded(tmp_path, volumes):
+    _cache(tmp_path).matrix(volumes[:2], Loader())
+
+    # Same size, with the old modification time
+    stat = volumes[0].stat()
+    volumes[0].write_bytes((99).to_bytes(4, 'little'))
+    os.utime(volumes[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    load = Loader()
+    matrix = _cache(tmp_path).matrix(volumes[:2], load)
+    assert load.loaded == ['a.nrrd']
+    np.testing.assert_array_equal(matrix[0], Loader()(volumes[0]))
+
+
+def test_empty_matrix(tmp_path):
+    assert len(_cache(tmp_path).matrix([], Loader())) == 0
+
+
+def test_evict_least_recently_used(tmp_path, volumes):
+    cache = _cache(tmp_path)
+    for age, path in enumerate(volumes[:3]):
+        cache.volume(path, Loader())
+        os.utime(tmp_path / 'cache' / VOLUME_CACHE_DIR / f'{cache.volume_key(path)}.npy', (1000 + age, 1000 + age))
+
+    # Room for two volumes. Adding d removes a and b, the least recently used
+    cache = _cache(tmp_path, num_files=2)
+    cache.volume(volumes[3], Loader())
+    assert _cached_volumes(tmp_path, cache, volumes) == sorted(f'{cache.volume_key(p)}.npy' for p in volumes[2:])
+
+
+def test_using_a_file_keeps_it(tmp_path, volumes):
+    cache = _cache(tmp_path)
+    for age, path in enumerate(volumes[:3]):
+        cache.volume(path, Loader())
+        os.utime(tmp_path / 'cache' / VOLUME_CACHE_DIR / f'{cache.volume_key(path)}.npy', (1000 + age, 1000 + age))
+
+    # a is used, so b is now the least recently used
+    cache = _cache(tmp_path, num_files=3)
+    load = Loader()
+    cache.volume(volumes[0], load)
+    cache.volume(volumes[3], load)
+    assert load.loaded == ['d.nrrd']
+    assert _cached_volumes(tmp_path, cache, volumes) == sorted(f'{cache.volume_key(p)}.npy'
+                                                               for p in [volumes[0], volumes[2], volumes[3]])
+
+
+def test_newest_file_is_kept_over_limit(tmp_path, volumes):
+    cache = _cache(tmp_path, num_files=0)
+    data = cache.volume(volumes[0], Loader())
+    assert _cached_volumes(tmp_path, cache, volumes) == [f'{cache.volume_key(volumes[0])}.npy']
+    np.testing.assert_array_equal(data, Loader()(volumes[0]))
+
+
+def test_join_voxel_matrices():
+    rng = np.random.default_rng(0)
+    a = rng.uniform(size=(50, 3)).astype(np.float32)
+    b = rng.uniform(size=(50, 2)).astype(np.float32)
+    joined = join_voxel_matrices([a, np.empty((0, 0), dtype=np.float32), b])
+    np.testing.assert_array_equal(joined.matrix, np.hstack([a, b]))
+    assert len(joined) == 5
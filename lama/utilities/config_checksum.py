@@ -3,7 +3,22 @@ Get a checksum for the contents of a config file. This can be used to make sure
 """
 import hashlib
 import json
-from typing import Dict
+from pathlib import Path
+from typing import Dict, Union
+
+BLOCK_SIZE = 2 ** 20
+
 
 def md5(data: Dict) -> str:
-    return hashlib.md5(json.dumps(data, sort_keys=True)).hexdigest()
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_md5(path: Union[str, Path]) -> str:
+    """
+    Get the checksum of a file's contents. The file is read in blocks so large volumes are not loaded into memory
+    """
+    h = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
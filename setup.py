@@ -9,6 +9,7 @@ setup(
     packages=find_packages(exclude=("dev")),
     package_data={'': ['current_commit',
                        'stats/rscripts/lmFast.R',
+                       'stats/rscripts/lm_worker.R',
                        'stats/rscripts/r_padjust.R']},  # Puts it in the wheel dist. MANIFEST.in gets it in source dist
     include_package_data=True,
     install_requires=[
@@ -17,7 +18,7 @@ setup(
         'numpy>=1.15.0',
         'pandas>=0.23.4',
         'scikit-learn>=0.19.2',
-        'scipy>=1.1.0',
+        'scipy>=1.10',  # make_smoothing_spline, used by multiple_testing
         'scikit-image>=0.15.0',
         'seaborn>=0.9.0',
         'statsmodels>=0.9.0',